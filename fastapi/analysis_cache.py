@@ -0,0 +1,107 @@
+# fastapi/analysis_cache.py
+# content-addressed analysis cache: answers re-uploads of identical files without publishing a worker job
+# keep the key derivation in sync with worker/analysis_cache.py (separate build context, same Firestore collection)
+
+import os
+import hashlib
+from typing import Optional
+from google.cloud import firestore
+
+from utils import firestore_client, storage_client, _job_doc, _parse_gs_uri
+
+ANALYSIS_CACHE_ENABLED    = os.getenv("ANALYSIS_CACHE", "1") == "1"
+ANALYSIS_CACHE_COLLECTION = os.getenv("ANALYSIS_CACHE_COLLECTION", "analysisCache")
+STATS_DOC                 = "_stats"
+VERSIONS_DOC              = "_versions"  # current analysis version per mode, published by the worker
+
+# job fields a cache hit copies into the new job, per mode
+CACHED_FIELDS = {
+    "vertex": ("shotEvents", "analysisGcsUri"),
+    "old":    ("shotEvents", "analysisGcsUri", "outputGcsUri", "videoDurationSec"),
+}
+# fields pointing at job-owned objects: a hit copies them under the new job's prefix
+OBJECT_FIELDS = ("analysisGcsUri", "outputGcsUri")
+
+
+def _cache_key(gcs_uri: str, mode: str) -> Optional[str]:
+    """sha256 of mode + the object's MD5 (or CRC32C for composite objects) and size."""
+    bucket_name, blob_name = _parse_gs_uri(gcs_uri)
+    blob = storage_client.bucket(bucket_name).get_blob(blob_name)
+    if blob is None:
+        return None
+    if blob.md5_hash:
+        fingerprint = f"md5:{blob.md5_hash}:{blob.size}"
+    elif blob.crc32c:
+        fingerprint = f"crc32c:{blob.crc32c}:{blob.size}"
+    else:
+        return None
+    return hashlib.sha256(f"{mode}|{fingerprint}".encode("utf-8")).hexdigest()
+
+def _count(counter: str, mode: str):
+    firestore_client.collection(ANALYSIS_CACHE_COLLECTION).document(STATS_DOC).set(
+        {mode: {counter: firestore.Increment(1)}}, merge=True
+    )
+
+def _copy_objects(fields: dict, job_id: str) -> dict:
+    """Server-side copies of the entry's output objects to gs://<bucket>/<job_id>/<name>."""
+    copied = {}
+    for field in OBJECT_FIELDS:
+        uri = fields.get(field)
+        if not uri:
+            continue
+        bucket_name, blob_name = _parse_gs_uri(uri)
+        bucket = storage_client.bucket(bucket_name)
+        new_name = f"{job_id}/{os.path.basename(blob_name)}"
+        if new_name != blob_name:
+            bucket.copy_blob(bucket.blob(blob_name), bucket, new_name)
+        copied[field] = f"gs://{bucket_name}/{new_name}"
+    return copied
+
+def clone_cached_analysis(job_id: str, gcs_uri: str, mode: str) -> bool:
+    """
+    If an identical upload was already analysed (same content hash and mode, under the
+    analysis version the worker currently publishes), copies its result into job_id, marks the job done and returns True. The
+    source job's output objects are copied under job_id's prefix, not shared.
+    Returns False when the job still has to be published. Never raises.
+    """
+    if not ANALYSIS_CACHE_ENABLED or mode not in CACHED_FIELDS:
+        return False
+    try:
+        key = _cache_key(gcs_uri, mode)
+        if key is None:
+            return False
+        cache_ref = firestore_client.collection(ANALYSIS_CACHE_COLLECTION).document(key)
+        snap = cache_ref.get()
+        if not snap.exists:
+            _count("misses", mode)
+            return False
+        entry = snap.to_dict() or {}
+        versions_snap = firestore_client.collection(ANALYSIS_CACHE_COLLECTION).document(VERSIONS_DOC).get()
+        current = (versions_snap.to_dict() or {}).get(mode) if versions_snap.exists else None
+        if current is None or entry.get("version") != current:
+            _count("misses", mode)  # written by an older prompt/model/settings combination
+            return False
+        fields = {f: entry[f] for f in CACHED_FIELDS[mode] if f in entry}
+        fields.update(_copy_objects(fields, job_id))
+        _job_doc(job_id).set({
+            **fields,
+            "analysisCache": {"hit": True, "key": key, "sourceJobId": entry.get("sourceJobId")},
+            "status": "done",
+            "finishedAt": firestore.SERVER_TIMESTAMP,
+        }, merge=True)
+        cache_ref.set({"hits": firestore.Increment(1)}, merge=True)
+        _count("hits", mode)
+        print(f"DEBUG: analysis cache hit for {job_id}, copied from job {entry.get('sourceJobId')}")
+        return True
+    except Exception as e:
+        print(f"Warning: analysis cache lookup failed for {job_id}: {e}")
+        return False
+
+def analysis_cache_stats() -> dict:
+    """Hit/miss counters per mode, with the upload-time hit rate."""
+    snap = firestore_client.collection(ANALYSIS_CACHE_COLLECTION).document(STATS_DOC).get()
+    stats = snap.to_dict() if snap.exists else {}
+    for counters in stats.values():
+        lookups = counters.get("hits", 0) + counters.get("misses", 0)
+        counters["hitRate"] = round(counters.get("hits", 0) / lookups, 4) if lookups else None
+    return stats
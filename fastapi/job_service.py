@@ -110,6 +110,7 @@ def highlight_data(job_id: str):
         "sourceVideoUrl": video_url,
         "rawEvents": raw_events,
         "ranges": ranges,
+        "idleSpans": data.get("idleSpans", []),
     }
 
 # adding shot events to a job
@@ -30,6 +30,7 @@ from utils import (_make_keys,
                    _sign_get_url,
                    _parse_gs_uri,
                    ts_to_seconds)
+from analysis_cache import clone_cached_analysis, analysis_cache_stats
 
 # IMPORTING SERVICE ROUTERS
 from vertex_service import router as vertex_router
@@ -226,7 +227,7 @@ async def upload_video(
     """
     1) Streams the uploaded file directly to GCS (RAW)
     2) Creates a job record in Firestore (status=queued)
-    3) Publishes a Pub/Sub message for the Worker
+    3) Publishes a Pub/Sub message for the Worker (skipped if an identical upload was already analysed)
     4) Returns { jobId, status } for the frontend to poll /jobs/{id}
     """
     try:
@@ -263,7 +264,17 @@ async def upload_video(
             "viewsCount": 0,
         }, merge=True)
 
-        # 4) Publish to Pub/Sub so the Background Worker starts processing
+        # 4) Identical upload already analysed -> copy its result, no worker job needed
+        if clone_cached_analysis(job_id, raw_gcs_uri, "old"):
+            return {
+                "ok": True,
+                "jobId": job_id,
+                "status": "done",
+                "videoGcsUri": raw_gcs_uri,
+                "cached": True,
+            }
+
+        # 5) Publish to Pub/Sub so the Background Worker starts processing
         try:
             _publish_job(job_id, raw_gcs_uri, user_id=userId, owner_email=owner_email, mode="old")
         except Exception as e:
@@ -475,6 +486,11 @@ def healthz():
     """Used by Render for health checks."""
     return {"ok": True}
 
+@app.get("/analysis_cache/stats")
+def get_analysis_cache_stats():
+    """Per-mode analysis cache hits/misses and hit rate for uploads (plus worker-side checks)."""
+    return {"ok": True, "stats": analysis_cache_stats()}
+
 
 #The runs that are public shows up in the 'Join a Run' page - runs set to public visibility
 @app.get("/public-runs")
@@ -23,6 +23,7 @@ from utils import (
     ts_to_seconds,
 )
 from sheetsData import write_to_sheet
+from analysis_cache import clone_cached_analysis
 
 # Environment
 PROJECT_ID = os.environ["GCP_PROJECT_ID"]
@@ -94,7 +95,11 @@ async def vertex_upload(
             merge=True,
         )
 
-        # 4. Publish to worker
+        # 4. Identical upload already analysed -> copy its result instead of re-running the model
+        if clone_cached_analysis(job_id, gcs_uri, "vertex"):
+            return {"ok": True, "jobId": job_id, "status": "done", "videoGcsUri": gcs_uri, "cached": True}
+
+        # 5. Publish to worker
         try:
             _publish_job(
                 job_id,
@@ -164,7 +169,8 @@ def vertex_result(job_id: str):
         "sourceVideoUrl": video_url,
         "rawEvents": raw_events,
         "ranges": ranges,
-        "videoDurationSec": video_duration_sec
+        "videoDurationSec": video_duration_sec,
+        "idleSpans": data.get("idleSpans", []),  # low-motion spans the worker skipped (MOTION_TRIM)
     }
 
 
@@ -317,12 +323,20 @@ async def complete_vertex_upload(
             detail="Upload incomplete - file not found in GCS"
         )
     
-    # 3. Update status to queued
-    _job_doc(jobId).update({
-        "status": "queued",
-        "uploadCompletedAt": firestore.SERVER_TIMESTAMP,
-    })
-    # 4. Publish to worker for analysis
+    _job_doc(jobId).update({"uploadCompletedAt": firestore.SERVER_TIMESTAMP})
+
+    # 3. Identical upload already analysed -> copy its result instead of re-running the model
+    if clone_cached_analysis(jobId, gcs_uri, "vertex"):
+        return {
+            "ok": True,
+            "jobId": jobId,
+            "status": "done",
+            "cached": True,
+        }
+
+    # 4. Update status to queued
+    _job_doc(jobId).update({"status": "queued"})
+    # 5. Publish to worker for analysis
     try:
         _publish_job(
             jobId,
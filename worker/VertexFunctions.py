@@ -10,73 +10,195 @@ import json, re
 import glob
 import tempfile
 import logging
+import mimetypes
 load_dotenv()
-from moviepy.editor import VideoFileClip, vfx, concatenate_videoclips
-from prompts import prompt_4, json_input, prompt_shot_outcomes_only, prompt_shot_outcomes_only2
+from prompts import prompt_4, json_input, prompt_shot_outcomes_only, prompt_shot_outcomes_only2, prompt_shot_outcomes_segment
+from concurrent.futures import ThreadPoolExecutor
 from uuid import uuid4 
 from utils import convert_to_mp4, format_gemini_output
 
-from VideoInputTest import strip_code_fences, timestamp_maker, CreateHighlightVideo2
+from VideoInputTest import timestamp_maker, CreateHighlightVideo2, convert_timestamp_to_seconds
+from genai_clients import get_vertex_client, generate_text
+from shot_schema import structured_output_config, parse_shot_events, count_retry, ShotParseError, PARSE_RETRIES
+
+VERTEX_MODEL = "gemini-2.5-flash"  # part of the analysis cache version
+
+# Segmented analysis of long videos: overlapping windows analysed concurrently, then stitched
+SEGMENT_SEC         = int(os.getenv("ANALYSIS_SEGMENT_SEC", "600"))
+SEGMENT_OVERLAP_SEC = int(os.getenv("ANALYSIS_SEGMENT_OVERLAP_SEC", "15"))
+SEGMENT_MIN_SEC     = int(os.getenv("ANALYSIS_SEGMENT_MIN_SEC", "900"))  # shorter videos use one call
+SEGMENT_CONCURRENCY = int(os.getenv("ANALYSIS_SEGMENT_CONCURRENCY", "4"))
+SEGMENT_DEDUPE_SEC  = float(os.getenv("ANALYSIS_SEGMENT_DEDUPE_SEC", "3"))
 
 # MAIN VERTEX FUNCTION: READS FROM GCS URI, RETURNS GEMINI OUTPUT AS DICT
 
-def vertex_summarize(gcs_uri, videoDurationSec=0):
-    vertex_client = genai.Client(
-        vertexai=True,
-        project="hooptuber-dev-1234",
-        location="us-central1",
-        http_options=types.HttpOptions(timeout=600000)
-    )
+def vertex_summarize(gcs_uri, videoDurationSec=0, window=None, on_events=None, stats=None):
+    """
+    window=(start_sec, end_sec) restricts the call to that part of the video
+    (server-side clip offsets, no re-upload or cutting).
+    on_events(list) streams the response and receives raw events as they are parsed.
+    Returns validated ShotEvent dicts; output that isn't a JSON array of events is
+    re-requested up to ANALYSIS_PARSE_RETRIES times (counted in stats).
+    """
+    vertex_client = get_vertex_client() # shared across jobs, project/location from env
     print(f"VERTEX SUMMARIZATION: VIDEO LENGTH BEING INPUTTED: {videoDurationSec}")
     try:
-        max_retries = 2
-        for attempt in range(max_retries):
-            logging.info(f"DEBUG: Vertex summarize, attempt {attempt+1}")
-            model = "gemini-2.5-flash"
+        model = VERTEX_MODEL
+        video_part = types.Part.from_uri(
+            file_uri = gcs_uri,
+            mime_type = mimetypes.guess_type(gcs_uri)[0] or "video/mp4" # raw uploads may be .mov
+        )
+        if window is None:
             prompt = prompt_shot_outcomes_only2(videoDurationSec)
-            response = vertex_client.models.generate_content(
+        else:
+            prompt = prompt_shot_outcomes_segment(window[0], window[1])
+            video_part.video_metadata = types.VideoMetadata(
+                start_offset=f"{window[0]}s",
+                end_offset=f"{window[1]}s",
+            )
+        max_attempts = 1 + PARSE_RETRIES
+        for attempt in range(max_attempts):
+            logging.info(f"DEBUG: Vertex summarize, attempt {attempt+1}")
+            raw_text = generate_text(
+                vertex_client, "vertex.generate_content", on_objects=on_events,
                 model=model,
                 contents=[
                     prompt,
-                    types.Part.from_uri(
-                        file_uri = gcs_uri,
-                        mime_type = "video/mp4"
-                    ),
+                    video_part,
                 ],
+                config=structured_output_config(),
             )
             logging.info(f"VERTEX: Response received.")
-            break
-            
-        print(type(response))
-
-        text_response = response.text
-        raw_text = getattr(response, "text", None)
-        if not raw_text:
+            print("VERTEX RAW GEMINI OUTPUT:", raw_text)
             try:
-                raw_text = response.candidates[0].content.parts[0].text
-            except Exception as e:
-                return {"ok": False, "error": f"VERTEX: No text in Gemini response: {e}"}
-        clean_text = strip_code_fences(raw_text).strip() # return output as a string for now
-        print("VERTEX RAW GEMINI OUTPUT:", strip_code_fences(raw_text))
-        try:
-            return json.loads(clean_text)
-        except json.JSONDecodeError as e:
-            logging.info(f"(VERTEX_SUMMARIZE): Failed to parse Gemini output as JSON: {e} ")
-            return clean_text
+                return parse_shot_events(raw_text or "", stats=stats)
+            except ShotParseError as e:
+                logging.warning(f"(VERTEX_SUMMARIZE): attempt {attempt+1}/{max_attempts}: {e}")
+                if attempt == max_attempts - 1:
+                    return {"ok": False, "error": f"VERTEX: unparseable model output after {max_attempts} attempts: {e}"}
+                count_retry(stats)
     except FileNotFoundError:
         return {"ok": False, "error": f"VERTEX: File not found: {gcs_uri}"}
     except Exception as e:
         return {"ok": False, "VERTEX: error": str(e)}
     
 
+def segment_windows(duration_sec, segment_sec=SEGMENT_SEC, overlap_sec=SEGMENT_OVERLAP_SEC):
+    """Overlapping (start, end) windows covering [0, duration_sec]."""
+    windows = []
+    start = 0
+    while start < duration_sec:
+        end = min(duration_sec, start + segment_sec)
+        windows.append((start, end))
+        if end >= duration_sec:
+            break
+        start = end - overlap_sec
+    return windows
+
+def _segment_events(events, window, segment_idx):
+    """
+    Checks one window's events against the full-video timeline. The segment prompt asks for
+    timestamps from the start of the full video, so they are used as-is; anything outside
+    the window is dropped.
+    """
+    start, end = window
+    mapped = []
+    for event in events:
+        try:
+            ts = convert_timestamp_to_seconds(event["TimeStamp"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if start <= ts <= end:
+            mapped.append({**event, "TimeStamp": ts, "_segment": segment_idx})
+    return mapped
+
+def dedupe_overlap_events(events, tolerance_sec=SEGMENT_DEDUPE_SEC):
+    """
+    Sorts stitched events and drops the copy of a shot reported by two neighbouring
+    windows (same shot seen in the overlap). Each kept event absorbs at most one copy
+    from another window; close shots from the same window are all kept.
+    """
+    kept = []
+    matched = set()
+    for event in sorted(events, key=lambda e: e["TimeStamp"]):
+        duplicate_of = None
+        for idx in range(len(kept) - 1, -1, -1):
+            previous = kept[idx]
+            if event["TimeStamp"] - previous["TimeStamp"] > tolerance_sec:
+                break
+            if previous["_segment"] != event["_segment"] and idx not in matched:
+                duplicate_of = idx
+                break
+        if duplicate_of is not None:
+            matched.add(duplicate_of)
+            continue
+        kept.append(event)
+    return [{k: v for k, v in e.items() if k != "_segment"} for e in kept]
+
+def _window_callback(on_events, window, segment_idx):
+    if on_events is None:
+        return None
+    def forward(events):
+        mapped = _segment_events(events, window, segment_idx)
+        if mapped:
+            on_events([{k: v for k, v in e.items() if k != "_segment"} for e in mapped])
+    return forward
+
+def vertex_summarize_segmented(gcs_uri, videoDurationSec, windows=None, on_events=None, stats=None):
+    """
+    Analyses (start, end) windows concurrently (at most ANALYSIS_SEGMENT_CONCURRENCY calls
+    at once) and stitches them into one de-duplicated, time-sorted event list.
+    Returns an error dict if any window fails. Streamed events passed to on_events are
+    already on the full-video timeline but not yet de-duplicated across overlaps.
+    """
+    windows = windows or segment_windows(videoDurationSec)
+    logging.info(f"VERTEX: segmented analysis of {len(windows)} windows: {windows}")
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, min(SEGMENT_CONCURRENCY, len(windows)))) as pool:
+        results = list(pool.map(
+            lambda iw: vertex_summarize(gcs_uri, videoDurationSec, window=iw[1],
+                                        on_events=_window_callback(on_events, iw[1], iw[0]), stats=stats),
+            enumerate(windows),
+        ))
+
+    stitched = []
+    for idx, (window, result) in enumerate(zip(windows, results)):
+        if not isinstance(result, list):
+            return {"ok": False, "error": f"VERTEX: segment {window} failed: {result}"}
+        stitched.extend(_segment_events(result, window, idx))
+    events = dedupe_overlap_events(stitched)
+    logging.info(f"VERTEX: {len(windows)} segments -> {len(stitched)} events, {len(events)} after overlap "
+                 f"de-dup, {time.perf_counter() - started:.1f}s")
+    return events
+
+
 """
 
 MAIN VERTEX FUNCTION: READS FROM GCS URI, RETURNS CLEANED DATA FOR HIGHLIGHT CREATION
 
 """
-def vertex_data_cleaned(gcs_uri, videoDurationSec=0):
-    # 1. Run Vertex
-    vertex_output = vertex_summarize(gcs_uri, videoDurationSec)
+def split_windows(windows, segment_sec=SEGMENT_SEC, overlap_sec=SEGMENT_OVERLAP_SEC):
+    """Cuts (start, end) windows longer than segment_sec into overlapping pieces."""
+    pieces = []
+    for start, end in windows:
+        pieces.extend((start + a, start + b) for a, b in segment_windows(end - start, segment_sec, overlap_sec))
+    return pieces
+
+def vertex_shot_events(gcs_uri, videoDurationSec=0, on_events=None, stats=None, windows=None):
+    """
+    Raw shot events for the video at gcs_uri; long videos are split into overlapping windows
+    analysed in parallel. windows=[(start, end), ...] analyses only those parts of the video.
+    """
+    if windows:
+        return vertex_summarize_segmented(gcs_uri, videoDurationSec, windows=split_windows(windows),
+                                          on_events=on_events, stats=stats)
+    if videoDurationSec and videoDurationSec >= SEGMENT_MIN_SEC:
+        return vertex_summarize_segmented(gcs_uri, videoDurationSec, on_events=on_events, stats=stats)
+    return vertex_summarize(gcs_uri, videoDurationSec, on_events=on_events, stats=stats)
+
+def vertex_data_cleaned(gcs_uri, videoDurationSec=0, on_events=None, stats=None, windows=None):
+    # 1. Run Vertex (optionally on candidate windows only)
+    vertex_output = vertex_shot_events(gcs_uri, videoDurationSec, on_events=on_events, stats=stats, windows=windows)
     # 2. If Vertex returned error
     if isinstance(vertex_output, dict) and not vertex_output.get("ok", True):
         return vertex_output  # pass error up unchanged
@@ -10,11 +10,16 @@ import json, re
 import glob
 import tempfile
 import logging
+from concurrent.futures import ThreadPoolExecutor
 load_dotenv()
-from moviepy.editor import VideoFileClip, vfx, concatenate_videoclips
 from prompts import prompt_4, json_input, prompt_shot_outcomes_only, prompt_shot_outcomes_only2
 from uuid import uuid4 
-from utils import convert_to_mp4
+from utils import convert_to_mp4, has_audio_stream
+from intervals import event_timestamps, to_numbers, merge_timestamps
+from watermark import watermark_enabled, watermark_png, overlay_filter
+from keyframes import KeyframeIndex, RENDER_CUT_MODE, probe_streams, smart_cut_supported, render_smart_cut
+from genai_clients import get_gemini_client, generate_text
+from shot_schema import STRUCTURED_OUTPUT, PARSE_RETRIES, structured_output_config, parse_shot_events, count_retry, ShotParseError
 
 
 # NEW: turning Gemini call to async, avoid repeated API calls
@@ -30,7 +35,8 @@ os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = os.getenv('GOOGLE_VERTEX_CREDS')
 if not api_key:
     raise ValueError("GEMINI_API_KEY environment variable not set")
 
-client = genai.Client()
+client = get_gemini_client()
+GEMINI_MODEL = "gemini-2.5-flash"  # Files API analysis model, part of the analysis cache version
 vertexai.init(project=os.getenv("GOOGLE_CLOUD_PROJECT"), location="us-central1")
 
 
@@ -54,6 +60,7 @@ class SlowVideo:
         self.output_path = output_path
         self.speed_factor = speed_factor
     def slow_down_video(self):
+        from moviepy.editor import VideoFileClip, vfx  # imported here: MoviePy is slow to import and only this helper needs it
         clip = VideoFileClip(self.input_path)
         slowed_clip = clip.fx(vfx.speedx, self.speed_factor)
         slowed_clip.write_videofile(self.output_path, audio=True)
@@ -66,88 +73,98 @@ def strip_code_fences(s):
 
 
 
-def process_video_and_summarize(file_path):
+FILES_POLL_FIRST_SEC = float(os.environ.get("FILES_POLL_FIRST_SEC", "1"))
+FILES_POLL_MAX_SEC   = float(os.environ.get("FILES_POLL_MAX_SEC", "10"))
+FILES_POLL_TIMEOUT   = float(os.environ.get("FILES_POLL_TIMEOUT_SEC", "900"))
+
+def wait_for_file_processing(name, stats=None, first_delay=FILES_POLL_FIRST_SEC, max_delay=FILES_POLL_MAX_SEC, timeout=FILES_POLL_TIMEOUT):
+    """
+    Polls a Files API upload until it leaves PROCESSING and returns its final state name.
+    The delay starts short and grows 1.5x per poll (capped), so short clips are picked
+    up quickly without hammering the API on long ones.
+    """
+    started = time.perf_counter()
+    delay = first_delay
+    polls = 0
+    while True:
+        state = client.files.get(name=name).state
+        polls += 1
+        state = getattr(state, "name", None) or str(state)
+        if state != "PROCESSING":
+            break
+        if time.perf_counter() - started + delay > timeout:
+            state = "TIMEOUT"
+            break
+        print(f"File is still processing, checking again in {delay:.1f} seconds...")
+        time.sleep(delay)
+        delay = min(max_delay, delay * 1.5)
+    if stats is not None:
+        stats["filesProcessingSec"] = round(time.perf_counter() - started, 3)
+        stats["filesPolls"] = polls
+    return state
+
+def process_video_and_summarize(file_path, on_events=None, stats=None):
     """
     Uploads a video file and asks a Gemini model to summarize it.
-    This method is for all file sizes.
+    This method is for all file sizes. on_events(list) streams the response and
+    receives raw shot events as they are parsed. Returns validated ShotEvent dicts,
+    or an {"ok": False} dict; upload/processing times, parse failures and retries
+    are recorded in stats.
     """
     try:
         #td = "videoDataset/"
         print(f"Uploading file: {file_path}...")
         #tester = convert_to_mp4(file_path, td)
+        started = time.perf_counter()
         uploaded_file =  client.files.upload(file=file_path)
-        
+        if stats is not None:
+            stats["filesUploadSec"] = round(time.perf_counter() - started, 3)
         print(f"File uploaded successfully with name: {uploaded_file.name}")
 
         print("Waiting for file to be processed...")
-        while client.files.get(name=uploaded_file.name).state == "PROCESSING":
-            print("File is still processing, waiting for 5 seconds...")
-            time.sleep(5)
-        if client.files.get(name=uploaded_file.name).state == "FAILED":
-            return {"ok" : False, "error": "File processing failed."}
+        state = wait_for_file_processing(uploaded_file.name, stats)
+        if state != "ACTIVE":
+            return {"ok" : False, "error": f"File processing failed (state {state})."}
         print("File processing complete.")
 
         print("Generating summary...")
 
         # CHANGE SCRIPT IN CONTENTS ARRAY
-        # prompt_shot_outcomes_only
-        prompt4 = prompt_shot_outcomes_only() # prompts are saved in prompts.py
-
-        # Retry logic with exponential backoff for 503 errors
-        max_retries = 2
-        retry_delay = 5  # Start with 5 seconds
+        # prompt_shot_outcomes_only2 asks for integer seconds, matching the ShotEvent response schema
+        prompt4 = prompt_shot_outcomes_only2(0) if STRUCTURED_OUTPUT else prompt_shot_outcomes_only() # prompts are saved in prompts.py
 
-        for attempt in range(max_retries):
+        def generate():
+            # quota waits and 429/503/timeout retries are handled by the gemini model gateway
             try:
-                logging.info(f"DEBUG (process_video func): attempt {attempt+1} to call Gemini API")
-                resp = client.models.generate_content(
-                    model="gemini-2.5-flash",
+                logging.info(f"DEBUG (process_video func): calling Gemini API")
+                raw_text = generate_text(
+                    client, "gemini.generate_content", on_objects=on_events,
+                    model=GEMINI_MODEL,
                     contents=[uploaded_file, prompt4],
-                    #request_options = {"timeout": 600} # testing 10 min timeout
-                    #,generation_config={"response_mime_type": "application/json,"}
+                    config=structured_output_config(),
                 )
-                
-                logging.info(f"DEBUG (process_video): Gemini API call successful on attempt {attempt+1}")
-                break  # Success, exit retry loop
+                logging.info(f"DEBUG (process_video): Gemini API call successful")
+                return raw_text
             except Exception as e:
-                error_str = str(e)
-                if "503" in error_str or "UNAVAILABLE" in error_str or "timed out" in error_str.lower():
-                    if attempt < max_retries - 1:
-                        print(f"Attempt {attempt + 1} failed with timeout/503. Retrying in {retry_delay} seconds...")
-                        time.sleep(retry_delay)
-                        retry_delay *= 2  # Exponential backoff
-                    else:
-                        print(f"All {max_retries} attempts failed.")
-                        return {"ok": False, "error": f"Gemini API timeout after {max_retries} attempts: {error_str}"}
-                else:
-                    # Different error, don't retry
-                    return {"ok": False, "error": error_str}
-        text_respone = resp.text
-        raw_text = getattr(resp, "text", None)
-        if not raw_text:
+                print(f"Gemini API call failed: {e}")
+                return {"ok": False, "error": f"Gemini API call failed: {e}"}
+
+        # unparseable output is re-requested, each retry is a full re-analysis of the video
+        parse_stats = stats.setdefault("parse", {}) if stats is not None else None
+        max_attempts = 1 + PARSE_RETRIES
+        for parse_attempt in range(max_attempts):
+            raw_text = generate()
+            if isinstance(raw_text, dict):
+                return raw_text
+            print("RAW GEMINI OUTPUT:", raw_text)
             try:
-                raw_text = resp.candidates[0].content.parts[0].text
-            except Exception as e:
-                return json.dumps({"ok": False, "error": f"No text in Gemini response: {e}"})
+                return parse_shot_events(raw_text or "", stats=parse_stats)
+            except ShotParseError as e:
+                logging.warning(f"(PROCESS_VIDEO_SUMMARIZE): attempt {parse_attempt+1}/{max_attempts}: {e}")
+                if parse_attempt == max_attempts - 1:
+                    return {"ok": False, "error": f"Unparseable Gemini output after {max_attempts} attempts: {e}"}
+                count_retry(parse_stats)
 
-        clean_text = strip_code_fences(raw_text).strip() # return output as a string for now
-        print("RAW GEMINI OUTPUT:", strip_code_fences(raw_text))
-        try:
-            parsed = json.loads(clean_text)
-        except json.JSONDecodeError as e:
-            logging.info(f"(PROCESS_VIDEO_SUMMARIZE): Failed to parse Gemini output as JSON: {e} ")
-            return clean_text
-        #list_test = json.loads(clean_text)
-        return parsed
-        
-        parsed = None
-        try:
-            parsed = json.loads(strip_code_fences(raw_text))
-        except json.JSONDecodeError:
-            return {"ok": False, "error": "Gemini returned non-JSON output"}
-
-        return {"ok": True, "results": parsed}
-        
     except FileNotFoundError:
         return {"ok": False, "error": f"File not found: {file_path}"}
     except Exception as e:
@@ -204,33 +221,19 @@ def timestamp_maker(gem_output):
         # If dict but not an error, might be a valid response, treat as parsed data
         parsed = gem_output
     elif isinstance(gem_output, str):
-        # String input - parse it
+        # String input - validate it against the ShotEvent schema
         try:
-            gem_output_stripped = strip_code_fences(gem_output)
-            parsed = json.loads(gem_output_stripped)
-            if isinstance(parsed, str):
-                parsed = json.loads(parsed) # try to parse again if it's a string
-        except json.JSONDecodeError as e:
+            parsed = parse_shot_events(gem_output)
+        except ShotParseError as e:
             raise ValueError(f"Gemini output is a str but not valid JSON: {e}")
 
-    # Now process the parsed data
-    #if isinstance(parsed, list):
-    makes_timestamps = [] # ONLY MAKES TIMESTAMPS
-
-    for idx, shot in enumerate(parsed):
-        try:
-            if "TimeStamp" in shot and "Outcome" in shot:
-                #if shot["Outcome"].lower() == "make" or shot["Outcome"].lower() == "miss" or shot["Outcome"].lower() == "made" or shot["Outcome"].lower() == "missed": # TESTING ALL TIMESTAMPSs
-                if shot["Outcome"]:
-                    # make_timestamps.append(shot["TimeStamp"])
-                    test_timestamp = shot["TimeStamp"]
-                    timestamp_undefined = convert_timestamp_to_seconds(test_timestamp)
-                    print(f"DEBUG for timestamp conversion: converted timestamp: {timestamp_undefined}")
-                    makes_timestamps.append(timestamp_undefined)
-        except Exception as e:
-            logging.error(f"Error processing shot at index {idx}: {shot}. Error: {e}")
-            # Continue processing other shots even if one fails
-            continue
+    # Now process the parsed data (all at once, see intervals.parse_timestamps)
+    events = parsed if isinstance(parsed, list) else [parsed]
+    seconds, kept = event_timestamps(events)
+    makes_timestamps = to_numbers(seconds) # ONLY MAKES TIMESTAMPS
+    skipped = sum(1 for e in events if isinstance(e, dict) and "TimeStamp" in e and e.get("Outcome")) - len(kept)
+    if skipped:
+        logging.error(f"Skipped {skipped} shot(s) with unparseable timestamps")
 
     if not makes_timestamps:
         logging.warning("No valid timestamps extracted from Gemini output")
@@ -261,89 +264,236 @@ def return_enhanced_timestamps(gem_output):
         return {"ok": False, "error": str(e)}
 
 
+def clip_worker_count(num_clips, max_workers=None):
+    """
+    Number of concurrent ffmpeg cuts: capped by max_workers (or HIGHLIGHT_CLIP_WORKERS),
+    the CPU count and the number of clips.
+    """
+    if max_workers is None:
+        max_workers = int(os.getenv("HIGHLIGHT_CLIP_WORKERS", "0")) or (os.cpu_count() or 1)
+    return max(1, min(max_workers, os.cpu_count() or 1, num_clips))
+
+
 class CreateHighlightVideo2:
     def __init__(self, clip_duration=5):
         self.clip_duration = clip_duration
+        self.render_stats = {}  # smart-cut segment counts of the last render
     
     def converting_tester(self, timestamp_list, start_before=1, merge_gap=0): # RETURNS THE TUPLE ARRAY (STARTTIME,ENDTIME)
         try:
             if not timestamp_list:
                     print(f"No timestamps")
                     return []
-            timestamps_first = sorted(timestamp_list)
-            timestamps = []
-            curr_start = max(0, timestamps_first[0]-start_before)
-            curr_end = curr_start + self.clip_duration
-            for i in range(1, len(timestamps_first)):
-                start_time = max(0, timestamps_first[i]-start_before)
-                end_time = start_time + self.clip_duration
-                # here we are checking for overlapping timestamps
-                if start_time <= curr_end + merge_gap:
-                    curr_end = max(curr_end, end_time)
-                else:
-                    timestamps.append((curr_start, curr_end))
-                    curr_start, curr_end = start_time, end_time
-            timestamps.append((curr_start, curr_end))
+            timestamps = merge_timestamps(timestamp_list, self.clip_duration, start_before, merge_gap)
             print(f"Final merged timestamps (in seconds) with time range: {timestamps}")
             return timestamps
         except Exception as e:
             print(f"Error: {e}")
             return []
     
-    def create_highlights_ffmpeg(self, timestamps_input, in_path, out_path):
+    def create_highlights_ffmpeg(self, timestamps_input, in_path, out_path, max_workers=None, keyframes=None):
         """
         Creates highlight video from timestamps and saves to out_path
-        
+
         Args:
-            timestamps: List of timestamp strings (e.g., ["00:00:11", "00:00:26"])
+            timestamps: List of (start, end) tuples in seconds
             in_path: Input video file path
             out_path: Output highlight video file path
+            max_workers: Max concurrent ffmpeg cuts (defaults to HIGHLIGHT_CLIP_WORKERS env / CPU count)
+            keyframes: KeyframeIndex of in_path (built on the fly if None)
         """
         if not timestamps_input:
             print("No timestamps provided")
             return False
-        
+
+        # the watermark is drawn in the single-pass encode; clips mode would need a second encode for it
+        if watermark_enabled():
+            return self.create_highlights_single_pass(timestamps_input, in_path, out_path, keyframes)
+
+        # stream-copied clips silently start at the keyframe before each cut; use the smart cut instead
+        index = (keyframes or KeyframeIndex()).ensure(in_path, [start for start, _ in timestamps_input])
+        if not all(index.on_keyframe(start) for start, _ in timestamps_input) and RENDER_CUT_MODE != "encode":
+            streams = probe_streams(in_path)
+            if smart_cut_supported(streams):
+                ok, self.render_stats = render_smart_cut(
+                    timestamps_input, in_path, out_path, index, streams,
+                    max_workers=clip_worker_count(2 * len(timestamps_input), max_workers),
+                )
+                return ok
+
         # Use temporary directory for intermediate clips
         with tempfile.TemporaryDirectory() as temp_dir:
-            clip_files = []
-            
             try:
                 timestamps = timestamps_input
-                
-                # Create individual clips
-                for i, (start, end) in enumerate(timestamps):
-                    clip_path = os.path.join(temp_dir, f"clip_{i+1}.mp4")
-                    duration = end - start
-                    cmd = [
-                        'ffmpeg',
-                        '-ss', str(start),           # Start time (HH:MM:SS)
-                        '-i', in_path,                  # Input video
-                        '-t', str(duration),  # Duration in seconds
-                        '-c', 'copy',                   # No re-encoding
-                        '-avoid_negative_ts', 'make_zero',
-                        '-y',                           # Overwrite
-                        clip_path
-                    ]
-                    result = subprocess.run(cmd, capture_output=True, text=True)
-
-                    if result.returncode == 0:
-                        clip_files.append(clip_path)
-                        print(f"✓ Created clip {i+1}: {start} seconds to {end} seconds.")
-                    else:
-                        print(f"✗ Error creating clip {i+1}: {result.stderr}")
+                workers = clip_worker_count(len(timestamps), max_workers)
+                print(f"Extracting {len(timestamps)} clips with {workers} worker(s)...")
+
+                batch_start = time.perf_counter()
+                # Create individual clips concurrently; results keep the input order
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    results = list(pool.map(
+                        lambda job: self._extract_clip(job[0], job[1][0], job[1][1], in_path, temp_dir),
+                        enumerate(timestamps),
+                    ))
+                batch_elapsed = time.perf_counter() - batch_start
+
+                clip_files = [clip_path for clip_path, _ in results if clip_path]
+                serial_elapsed = sum(elapsed for _, elapsed in results)
+                print(f"Clip extraction took {batch_elapsed:.2f}s wall / {serial_elapsed:.2f}s summed "
+                      f"({workers} workers, {len(clip_files)}/{len(timestamps)} clips ok)")
 
                 # If we have clips, combine them
                 if clip_files:
                     return self._combine_clips(clip_files, out_path, temp_dir)
-                    
+
                 else:
                     print("No clips were created successfully")
                     return False
-                    
+
             except Exception as e:
                 print(f"✗ General error: {e}")
                 return False
 
+    def _extract_clip(self, i, start, end, in_path, temp_dir):
+        """
+        Cuts a single clip with stream copy. Returns (clip_path or None, elapsed seconds).
+        """
+        clip_path = os.path.join(temp_dir, f"clip_{i+1}.mp4")
+        duration = end - start
+        cmd = [
+            'ffmpeg',
+            '-ss', str(start),           # Start time (seconds)
+            '-i', in_path,                  # Input video
+            '-t', str(duration),  # Duration in seconds
+            '-c', 'copy',                   # No re-encoding
+            '-avoid_negative_ts', 'make_zero',
+            '-y',                           # Overwrite
+            clip_path
+        ]
+        clip_start = time.perf_counter()
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        elapsed = time.perf_counter() - clip_start
+
+        if result.returncode == 0:
+            print(f"✓ Created clip {i+1}: {start} seconds to {end} seconds ({elapsed:.2f}s).")
+            return clip_path, elapsed
+        print(f"✗ Error creating clip {i+1} ({elapsed:.2f}s): {result.stderr}")
+        return None, elapsed
+
+    def create_highlights_single_pass(self, timestamps_input, in_path, out_path, keyframes=None):
+        """
+        Builds the whole highlight reel without intermediate clip files.
+
+        When every cut starts on a keyframe the ranges are stream-copied through the concat
+        demuxer (inpoint/outpoint entries). Otherwise, with RENDER_CUT_MODE "smart"/"snap" and
+        a source codec we can match, only the partial GOP at each cut is re-encoded and the
+        rest is copied (keyframes.render_smart_cut). Failing that each range is input-seeked
+        and joined with a concat filter graph, which re-encodes once but stays frame-accurate.
+        With WATERMARK_TEXT set the concat-filter encode is always used and draws the watermark.
+
+        Args:
+            timestamps_input: List of (start, end) tuples in seconds
+            in_path: Input video file path (or URL ffmpeg can read)
+            out_path: Output highlight video file path
+            keyframes: KeyframeIndex of in_path (built on the fly if None)
+        """
+        if not timestamps_input:
+            print("No timestamps provided")
+            return False
+
+        try:
+            os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+            render_start = time.perf_counter()
+            starts = [start for start, _ in timestamps_input]
+            # a watermark needs decoded frames anyway, so it's cut and drawn in the one encode
+            index = None if watermark_enabled() else (keyframes or KeyframeIndex()).ensure(in_path, starts)
+            if index is None:
+                mode = "encode+watermark"
+                ok = self._render_concat_filter(timestamps_input, in_path, out_path, watermark=watermark_png())
+            elif all(index.on_keyframe(start) for start in starts):
+                mode = "copy"
+                ok = self._render_concat_copy(timestamps_input, in_path, out_path)
+            elif RENDER_CUT_MODE != "encode" and smart_cut_supported(streams := probe_streams(in_path)):
+                mode = RENDER_CUT_MODE
+                ok, self.render_stats = render_smart_cut(timestamps_input, in_path, out_path, index, streams)
+            else:
+                mode = "encode"
+                ok = self._render_concat_filter(timestamps_input, in_path, out_path)
+            print(f"Single-pass render ({mode}) of {len(timestamps_input)} ranges took "
+                  f"{time.perf_counter() - render_start:.2f}s")
+            return ok
+        except Exception as e:
+            print(f"✗ General error: {e}")
+            return False
+
+    def _render_concat_copy(self, timestamps, in_path, out_path):
+        """Stream-copies every range in a single concat-demuxer pass."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filelist_path = os.path.join(temp_dir, "ranges.txt")
+            source = in_path if "://" in in_path else os.path.abspath(in_path)
+            with open(filelist_path, 'w') as f:
+                for start, end in timestamps:
+                    f.write(f"file '{source}'\n")
+                    f.write(f"inpoint {start}\n")
+                    f.write(f"outpoint {end}\n")
+
+            cmd = [
+                'ffmpeg',
+                '-f', 'concat',
+                '-safe', '0',
+                '-protocol_whitelist', 'file,http,https,tcp,tls',
+                '-i', filelist_path,
+                '-c', 'copy',
+                '-avoid_negative_ts', 'make_zero',
+                '-movflags', '+faststart',
+                '-y',
+                out_path
+            ]
+            result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode == 0:
+            print(f"✓ Highlight video saved as: {out_path}")
+            return True
+        print(f"✗ Error rendering highlight (copy): {result.stderr}")
+        return False
+
+    def _render_concat_filter(self, timestamps, in_path, out_path, watermark=None):
+        """
+        Input-seeks each range and joins them with the concat filter in one encode.
+        watermark (a PNG path) is overlaid on the joined video in the same encode.
+        """
+        audio = has_audio_stream(in_path)
+        cmd = ['ffmpeg']
+        for start, end in timestamps:
+            cmd += ['-ss', str(start), '-t', str(end - start), '-i', in_path]
+        if watermark:
+            cmd += ['-i', watermark]
+
+        streams = "".join(
+            f"[{i}:v:0][{i}:a:0]" if audio else f"[{i}:v:0]" for i in range(len(timestamps))
+        )
+        video_out = "vc" if watermark else "v"
+        outputs = f"[{video_out}][a]" if audio else f"[{video_out}]"
+        graph = f"{streams}concat=n={len(timestamps)}:v=1:a={1 if audio else 0}{outputs}"
+        if watermark:
+            graph += ";" + overlay_filter(video_out, len(timestamps), "v")
+        cmd += ['-filter_complex', graph, '-map', '[v]']
+        if audio:
+            cmd += ['-map', '[a]', '-c:a', 'aac']
+        cmd += [
+            '-c:v', 'libx264',
+            '-preset', 'veryfast',
+            '-crf', '20',
+            '-movflags', '+faststart',
+            '-y',
+            out_path
+        ]
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode == 0:
+            print(f"✓ Highlight video saved as: {out_path}")
+            return True
+        print(f"✗ Error rendering highlight (encode): {result.stderr}")
+        return False
+
     def _combine_clips(self, clip_files, out_path, temp_dir):
         """
         Combines individual clips into final highlight video
@@ -0,0 +1,146 @@
+# worker/analysis_cache.py - content-addressed cache of finished analyses, keyed by upload hash and checked against the analysis version
+# keep the key derivation in sync with fastapi/analysis_cache.py (separate build context, same Firestore collection)
+
+import os
+import json
+import hashlib
+import logging
+from google.cloud import firestore
+
+ANALYSIS_CACHE_ENABLED    = os.environ.get("ANALYSIS_CACHE", "1") == "1"
+ANALYSIS_CACHE_COLLECTION = os.environ.get("ANALYSIS_CACHE_COLLECTION", "analysisCache")
+ANALYSIS_VERSION          = os.environ.get("ANALYSIS_VERSION", "1")  # extra salt; prompt/model/flag changes are picked up automatically
+STATS_DOC                 = "_stats"
+VERSIONS_DOC              = "_versions"  # current analysis version per mode, read by the upload endpoints
+
+# sources whose text reaches the model or shapes its output (prompts, response schema)
+VERSIONED_SOURCES = ("prompts.py", "shot_schema.py")
+
+# job fields a cache hit copies into the new job, per mode
+CACHED_FIELDS = {
+    "vertex": ("shotEvents", "analysisGcsUri"),
+    "old":    ("shotEvents", "analysisGcsUri", "outputGcsUri", "videoDurationSec"),
+}
+# fields pointing at job-owned objects: a hit copies them under the new job's prefix
+OBJECT_FIELDS = ("analysisGcsUri", "outputGcsUri")
+
+
+def content_fingerprint(blob):
+    """Hash identifying the object's bytes: MD5 when GCS has one, else CRC32C + size (composite objects)."""
+    if blob.md5_hash:
+        return f"md5:{blob.md5_hash}:{blob.size}"
+    if blob.crc32c:
+        return f"crc32c:{blob.crc32c}:{blob.size}"
+    return None
+
+def cache_key(fingerprint, mode):
+    return hashlib.sha256(f"{mode}|{fingerprint}".encode("utf-8")).hexdigest()
+
+def analysis_version(mode, settings):
+    """
+    Version of the result a fresh analysis in mode would store: a hash of the prompt and
+    schema sources, ANALYSIS_VERSION and settings (model id plus every flag that changes
+    the stored result). Entries written under any other version are treated as misses.
+    """
+    digest = hashlib.sha256()
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in VERSIONED_SOURCES:
+        with open(os.path.join(here, name), "rb") as f:
+            digest.update(f.read())
+    digest.update(json.dumps({"mode": mode, "salt": ANALYSIS_VERSION, **settings}, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+class AnalysisCache:
+    """
+    Firestore collection of finished analyses. Entries are written by the worker after a
+    successful job and read both by the upload endpoints (before publishing) and by the
+    worker (before calling the model), so a re-upload of the same file under a new job id
+    is answered by copying the stored result. Output objects are copied into the new job's
+    prefix, so deleting either job never breaks the other.
+
+    versions maps mode -> analysis_version(); entries are stamped with it and only reused
+    while it matches. publish_versions() records it for the upload endpoints.
+    """
+
+    def __init__(self, firestore_client, storage_client, versions, collection=ANALYSIS_CACHE_COLLECTION, enabled=ANALYSIS_CACHE_ENABLED):
+        self.collection = firestore_client.collection(collection)
+        self.storage_client = storage_client
+        self.versions = versions
+        self.enabled = enabled
+
+    def publish_versions(self):
+        if self.enabled:
+            self.collection.document(VERSIONS_DOC).set(self.versions, merge=True)
+            logging.info(f"Analysis cache versions: {self.versions}")
+
+    def key_for(self, gcs_uri, mode):
+        """Cache key for the object at gcs_uri, or None if caching is off or it has no hash."""
+        if not self.enabled or mode not in CACHED_FIELDS:
+            return None
+        bucket_name, _, name = gcs_uri[len("gs://"):].partition("/")
+        blob = self.storage_client.bucket(bucket_name).get_blob(name)
+        fingerprint = content_fingerprint(blob) if blob is not None else None
+        return cache_key(fingerprint, mode) if fingerprint else None
+
+    def lookup(self, key, mode, job_id):
+        """Job fields to copy into job_id for a hit, else None (counted as workerHits / workerMisses)."""
+        if key is None:
+            return None
+        snap = self.collection.document(key).get()
+        if not snap.exists:
+            self._count("workerMisses", mode)
+            return None
+        entry = snap.to_dict() or {}
+        if entry.get("version") != self.versions[mode]:
+            logging.info(f"Analysis cache entry {key[:12]} ({mode}) is from version {entry.get('version')}, "
+                         f"current is {self.versions[mode]}")
+            self._count("workerMisses", mode)
+            return None
+        fields = {f: entry[f] for f in CACHED_FIELDS[mode] if f in entry}
+        try:
+            fields.update(self._copy_objects(fields, job_id))
+        except Exception as e:
+            # e.g. the source job's outputs were deleted: run the job instead
+            logging.warning(f"Analysis cache entry {key[:12]} unusable for {job_id}: {e}")
+            self._count("workerMisses", mode)
+            return None
+        self._count("workerHits", mode)
+        self.collection.document(key).set({"hits": firestore.Increment(1)}, merge=True)
+        logging.info(f"Analysis cache hit {key[:12]} ({mode}), from job {entry.get('sourceJobId')}")
+        return {
+            **fields,
+            "analysisCache": {"hit": True, "key": key, "sourceJobId": entry.get("sourceJobId")},
+        }
+
+    def _copy_objects(self, fields, job_id):
+        """Server-side copies of the entry's output objects to gs://<bucket>/<job_id>/<name>."""
+        copied = {}
+        for field in OBJECT_FIELDS:
+            uri = fields.get(field)
+            if not uri:
+                continue
+            bucket_name, _, name = uri[len("gs://"):].partition("/")
+            bucket = self.storage_client.bucket(bucket_name)
+            new_name = f"{job_id}/{os.path.basename(name)}"
+            if new_name != name:
+                bucket.copy_blob(bucket.blob(name), bucket, new_name)
+            copied[field] = f"gs://{bucket_name}/{new_name}"
+        return copied
+
+    def store(self, key, mode, job_id, fields):
+        if key is None or not fields.get("shotEvents"):
+            return  # nothing worth reusing (or a failed merge that fell back to [])
+        self.collection.document(key).set({
+            **{f: fields[f] for f in CACHED_FIELDS[mode] if f in fields},
+            "mode": mode,
+            "version": self.versions[mode],
+            "sourceJobId": job_id,
+            "createdAt": firestore.SERVER_TIMESTAMP,
+        }, merge=True)
+
+    def _count(self, counter, mode):
+        try:
+            self.collection.document(STATS_DOC).set({mode: {counter: firestore.Increment(1)}}, merge=True)
+        except Exception as e:
+            logging.warning(f"Failed to update analysis cache stats: {e}")
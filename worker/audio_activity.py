@@ -0,0 +1,166 @@
+# worker/audio_activity.py - CPU-only audio pre-pass: onset/energy detection -> candidate shot windows
+
+import os
+import time
+import logging
+import subprocess
+
+import numpy as np
+
+from utils import has_audio_stream
+
+AUDIO_SAMPLE_RATE   = int(os.environ.get("AUDIO_PREFILTER_SAMPLE_RATE", "8000"))
+AUDIO_FRAME_SEC     = float(os.environ.get("AUDIO_PREFILTER_FRAME_SEC", "0.032"))
+AUDIO_ONSET_Z       = float(os.environ.get("AUDIO_PREFILTER_ONSET_Z", "4"))     # flux threshold in robust std devs
+AUDIO_ENERGY_DB     = float(os.environ.get("AUDIO_PREFILTER_ENERGY_DB", "6"))   # loud-second threshold over the median
+AUDIO_MIN_ONSETS    = int(os.environ.get("AUDIO_PREFILTER_MIN_ONSETS", "2"))    # onsets per second to call it active
+AUDIO_WINDOW_PAD    = float(os.environ.get("AUDIO_PREFILTER_PAD_SEC", "8"))
+AUDIO_WINDOW_GAP    = float(os.environ.get("AUDIO_PREFILTER_MERGE_GAP_SEC", "12"))
+AUDIO_BLOCK_FRAMES  = int(os.environ.get("AUDIO_PREFILTER_BLOCK_FRAMES", "4096"))  # frames per FFT block (~2 min)
+
+
+def decode_audio(in_path, block_samples, sample_rate=AUDIO_SAMPLE_RATE):
+    """
+    Yields mono float32 sample blocks in [-1, 1] of block_samples each (the last may be
+    shorter), piped straight out of ffmpeg (no temp file, never the whole track in memory).
+    """
+    proc = subprocess.Popen([
+        "ffmpeg", "-v", "error",
+        "-i", in_path,
+        "-map", "0:a:0", "-vn",
+        "-ac", "1", "-ar", str(sample_rate),
+        "-f", "s16le", "-"
+    ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        while chunk := proc.stdout.read(block_samples * 2):
+            yield np.frombuffer(chunk, dtype="<i2").astype(np.float32) / 32768.0
+    except GeneratorExit:
+        proc.kill()
+        raise
+    finally:
+        proc.stdout.close()
+        stderr = proc.stderr.read()
+        proc.wait()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, "ffmpeg", stderr=stderr)
+
+def onset_features(blocks, frame_len):
+    """
+    Per-frame RMS energy (dB) and half-wave rectified spectral flux over non-overlapping
+    Hann-windowed frames. Sharp transients (rim, backboard, bounces, whistles) show up
+    as flux peaks; crowd noise raises the energy. blocks are sample arrays whose length is
+    a multiple of frame_len (a trailing partial frame is dropped); the spectrum is computed
+    one block at a time, carrying the last frame over for the flux at block boundaries.
+    """
+    window = np.hanning(frame_len).astype(np.float32)
+    energy_db, flux = [], []
+    previous = None
+    for samples in blocks:
+        n_frames = len(samples) // frame_len
+        if n_frames == 0:
+            continue
+        frames = samples[:n_frames * frame_len].reshape(n_frames, frame_len)
+        energy_db.append(10.0 * np.log10(np.mean(frames ** 2, axis=1) + 1e-10))
+        spectrum = np.abs(np.fft.rfft(frames * window, axis=1))
+        spectrum = np.log1p(spectrum * 100.0)  # compress so quiet transients still register
+        if previous is None:
+            previous = spectrum[:1]  # the first frame has no flux
+        flux.append(np.maximum(0.0, np.diff(np.vstack((previous, spectrum)), axis=0)).sum(axis=1))
+        previous = spectrum[-1:]
+    if sum(len(e) for e in energy_db) < 2:
+        return np.zeros(0, np.float32), np.zeros(0, np.float32)
+    return np.concatenate(energy_db), np.concatenate(flux)
+
+def detect_onsets(flux, z=AUDIO_ONSET_Z):
+    """Frame indices of flux peaks more than z robust standard deviations above the median."""
+    if len(flux) < 3:
+        return np.zeros(0, dtype=np.int64)
+    median = np.median(flux)
+    mad = np.median(np.abs(flux - median)) * 1.4826 + 1e-9
+    score = (flux - median) / mad
+    is_peak = (score[1:-1] > z) & (flux[1:-1] >= flux[:-2]) & (flux[1:-1] > flux[2:])
+    return np.flatnonzero(is_peak) + 1
+
+def activity_windows(active_seconds, duration_sec, pad=AUDIO_WINDOW_PAD, merge_gap=AUDIO_WINDOW_GAP):
+    """Pads each active second and merges nearby ones into sorted integer (start, end) windows."""
+    windows = []
+    for sec in np.flatnonzero(active_seconds):
+        start, end = max(0.0, sec - pad), min(duration_sec, sec + 1 + pad)
+        if windows and start <= windows[-1][1] + merge_gap:
+            windows[-1][1] = max(windows[-1][1], end)
+        else:
+            windows.append([start, end])
+    return [(int(start), int(np.ceil(end))) for start, end in windows]
+
+def candidate_windows(in_path, duration_sec=None, sample_rate=AUDIO_SAMPLE_RATE):
+    """
+    Candidate activity windows for in_path from its audio track. Returns a dict with
+    windows, coverage (fraction of the video inside a window), onset count and timings,
+    or None if the file has no audio (the caller should then analyse everything).
+    """
+    started = time.perf_counter()
+    if not has_audio_stream(in_path):
+        return None
+    frame_len = max(64, int(sample_rate * AUDIO_FRAME_SEC))
+    energy_db, flux = onset_features(decode_audio(in_path, frame_len * AUDIO_BLOCK_FRAMES, sample_rate), frame_len)
+    if len(energy_db) == 0:
+        return None
+    audio_sec = len(energy_db) * frame_len / sample_rate
+    duration_sec = duration_sec or audio_sec
+
+    onsets = detect_onsets(flux)
+    frames_per_sec = sample_rate / frame_len
+    n_seconds = int(np.ceil(audio_sec))
+
+    # per-second onset count and peak energy
+    onset_counts = np.bincount((onsets / frames_per_sec).astype(np.int64), minlength=n_seconds)[:n_seconds]
+    second_of_frame = (np.arange(len(energy_db)) / frames_per_sec).astype(np.int64)
+    loudness = np.full(n_seconds, -100.0)
+    np.maximum.at(loudness, second_of_frame, energy_db)
+    loud = loudness > np.median(loudness) + AUDIO_ENERGY_DB
+    active = (onset_counts >= AUDIO_MIN_ONSETS) | (loud & (onset_counts > 0))
+
+    windows = activity_windows(active, duration_sec)
+    covered = sum(end - start for start, end in windows)
+    profile = {
+        "windows": windows,
+        "coverage": round(covered / duration_sec, 4) if duration_sec else 0.0,
+        "analysedSec": covered,
+        "durationSec": round(duration_sec, 3),
+        "onsets": int(len(onsets)),
+        "activeSeconds": int(active.sum()),
+        "scanSec": round(time.perf_counter() - started, 3),
+    }
+    logging.info(f"Audio pre-filter: {len(windows)} windows covering {profile['coverage']:.1%} of "
+                 f"{duration_sec:.0f}s ({profile['onsets']} onsets) in {profile['scanSec']:.2f}s")
+    return profile
+
+
+def _seconds(ts):
+    if isinstance(ts, (int, float)):
+        return float(ts)
+    total = 0.0
+    for part in str(ts).split(":"):
+        total = total * 60 + float(part)
+    return total
+
+def window_recall(events, windows):
+    """
+    Fraction of events from a full-video analysis that fall inside windows. Accepts raw
+    events ({"TimeStamp"}) or frontend shotEvents ({"timestamp_start", "timestamp_end"},
+    counted when the range overlaps a window). None if there are no events to compare.
+    """
+    spans = []
+    for event in events or []:
+        try:
+            if "TimeStamp" in event:
+                t = _seconds(event["TimeStamp"])
+                spans.append((t, t))
+            elif event.get("timestamp_start") is not None:
+                spans.append((_seconds(event["timestamp_start"]), _seconds(event["timestamp_end"])))
+        except (TypeError, ValueError):
+            continue
+    if not spans:
+        return None
+    hits = sum(any(start <= w_end and end >= w_start for w_start, w_end in windows) for start, end in spans)
+    return round(hits / len(spans), 4)
@@ -0,0 +1,96 @@
+# worker/bench_intervals.py - micro-benchmark: list-based timestamp parsing/merging vs intervals.py
+# usage: python bench_intervals.py [events ...]   (defaults to 10k, 50k and 200k events, i.e. multi-game batches)
+
+import sys
+import time
+import random
+
+from intervals import event_timestamps, merge_timestamps, events_by_range, to_numbers
+
+
+# --- the per-event code this replaced (timestamp_maker -> converting_tester -> format_gemini_output), minus logging ---
+
+def legacy_convert(timestamp):
+    if isinstance(timestamp, (int, float)):
+        return int(timestamp)
+    parts = timestamp.split(":")
+    if len(parts) == 3:
+        hours, minutes, seconds = map(int, parts)
+        return hours * 3600 + minutes * 60 + seconds
+    if len(parts) == 2:
+        minutes, seconds = map(int, parts)
+        return minutes * 60 + seconds
+    return int(parts[0])
+
+def legacy_timestamps(events):
+    out = []
+    for shot in events:
+        try:
+            if "TimeStamp" in shot and "Outcome" in shot and shot["Outcome"]:
+                out.append(legacy_convert(shot["TimeStamp"]))
+        except Exception:
+            continue
+    return out
+
+def legacy_merge(timestamp_list, clip_duration=5, start_before=1, merge_gap=0):
+    timestamps_first = sorted(timestamp_list)
+    timestamps = []
+    curr_start = max(0, timestamps_first[0] - start_before)
+    curr_end = curr_start + clip_duration
+    for t in timestamps_first[1:]:
+        start_time = max(0, t - start_before)
+        end_time = start_time + clip_duration
+        if start_time <= curr_end + merge_gap:
+            curr_end = max(curr_end, end_time)
+        else:
+            timestamps.append((curr_start, curr_end))
+            curr_start, curr_end = start_time, end_time
+    timestamps.append((curr_start, curr_end))
+    return timestamps
+
+def legacy_outcomes(events, ranges):
+    return [(events[i] if i < len(events) else {}).get("Outcome") for i in range(len(ranges))]
+
+
+def make_events(n, seed=0):
+    """n shot events from a multi-game batch: ~150 shots per game, each game up to 3 hours of video."""
+    rng = random.Random(seed)
+    events = []
+    for i in range(n):
+        t = (i // 150) * 4 * 3600 + rng.randint(0, 3 * 3600)  # games laid end to end on one timeline
+        events.append({
+            "TimeStamp": f"{t // 3600:02}:{t % 3600 // 60:02}:{t % 60:02}",
+            "Outcome": rng.choice(("Make", "Miss", "Undetermined")),
+        })
+    return events
+
+def timed(fn, *args, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+def bench(n):
+    events = make_events(n)
+    old_parse, old_ts = timed(legacy_timestamps, events)
+    new_parse, (seconds, _) = timed(event_timestamps, events)
+    assert old_ts == to_numbers(seconds), "parsed timestamps differ"
+
+    old_merge, old_ranges = timed(legacy_merge, old_ts)
+    new_merge, new_ranges = timed(merge_timestamps, seconds)
+    assert old_ranges == new_ranges, "merged ranges differ"
+
+    old_map, _ = timed(legacy_outcomes, events, old_ranges)
+    new_map, _ = timed(events_by_range, events, new_ranges)
+
+    print(f"{n:>8} events -> {len(new_ranges):>7} ranges | "
+          f"parse {old_parse * 1e3:8.2f} -> {new_parse * 1e3:7.2f} ms | "
+          f"merge {old_merge * 1e3:7.2f} -> {new_merge * 1e3:6.2f} ms | "
+          f"outcomes {old_map * 1e3:6.2f} (by index, wrong) -> {new_map * 1e3:7.2f} ms (by membership)")
+
+
+if __name__ == "__main__":
+    for n in [int(a) for a in sys.argv[1:]] or [10_000, 50_000, 200_000]:
+        bench(n)
@@ -0,0 +1,85 @@
+# worker/checkpoints.py - per-stage checkpoints on the job doc, so a redelivered job resumes at its first incomplete stage
+
+import os
+import json
+import time
+import logging
+from google.cloud import firestore
+
+CHECKPOINT_STAGES = ("analysis", "ranges", "render")
+MAX_ATTEMPTS      = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))       # deliveries before a job fails for good
+RETRY_DELAY_SEC   = int(os.environ.get("JOB_RETRY_DELAY_SEC", "60"))   # redelivery delay after a failed attempt
+
+RETRY = "retry"  # handler result: the message was handed back for another attempt
+
+
+class JobCheckpoints:
+    """
+    Stage markers (stages.<name>) and the delivery counter (attempts) of one job doc.
+    Stage data is persisted to gs://<bucket>/<job>/checkpoints/<name>.json, so a later
+    delivery of the same job reloads it instead of redoing the stage.
+
+    Usage:
+        checkpoints = JobCheckpoints(doc_ref, bucket).begin()
+        parsed = checkpoints.run("analysis", analyse)   # skipped if an earlier attempt finished it
+        ...
+        if failed and checkpoints.should_retry(): defer the message
+    """
+
+    def __init__(self, doc_ref, bucket):
+        self.doc_ref = doc_ref
+        self.bucket = bucket
+        self.stages = {}
+        self.attempts = 0
+
+    def begin(self):
+        """Counts this delivery on the job doc and loads the stages earlier ones completed."""
+        self.doc_ref.set({"attempts": firestore.Increment(1)}, merge=True)
+        snap = self.doc_ref.get()
+        data = (snap.to_dict() or {}) if snap.exists else {}
+        self.stages = data.get("stages") or {}
+        self.attempts = data.get("attempts") or 1
+        if self.completed():
+            logging.info(f"Resuming {self.doc_ref.id} (attempt {self.attempts}), completed stages: {self.completed()}")
+        return self
+
+    def done(self, name):
+        return bool((self.stages.get(name) or {}).get("done"))
+
+    def completed(self):
+        return [name for name in CHECKPOINT_STAGES if self.done(name)]
+
+    def save(self, name, started, data=None, **fields):
+        """Marks a stage done with its duration (and data, if given); returns the stage entry."""
+        seconds = round(time.perf_counter() - started, 3)
+        entry = {"done": True, "sec": seconds, **fields}
+        if data is not None:
+            key = f"{self.doc_ref.id}/checkpoints/{name}.json"
+            self.bucket.blob(key).upload_from_string(json.dumps(data), content_type="application/json", timeout=600)
+            entry["uri"] = f"gs://{self.bucket.name}/{key}"
+        self.doc_ref.set({"stages": {name: entry}, "stageDurations": {name: seconds}}, merge=True)
+        self.stages[name] = entry
+        logging.info(f"Checkpoint {name} saved for {self.doc_ref.id} ({seconds}s)")
+        return entry
+
+    def read(self, name):
+        """Data saved with stage name by an earlier attempt."""
+        _, _, blob_name = self.stages[name]["uri"][len("gs://"):].partition("/")
+        return json.loads(self.bucket.blob(blob_name).download_as_text())
+
+    def run(self, name, compute, started=None):
+        """
+        compute()'s result for stage name, saved as its checkpoint, or the saved result of an
+        earlier attempt (compute is then not called). started overrides the stage's start time.
+        """
+        if self.done(name):
+            logging.info(f"Loaded {name} from checkpoint for {self.doc_ref.id}")
+            return self.read(name)
+        started = time.perf_counter() if started is None else started
+        data = compute()
+        self.save(name, started, data=data)
+        return data
+
+    def should_retry(self):
+        """True while this job has deliveries left (JOB_MAX_ATTEMPTS)."""
+        return self.attempts < MAX_ATTEMPTS
@@ -0,0 +1,233 @@
+# worker/frame_cache.py - decode-once, memory-mapped low-res grayscale frames shared by local analysers
+
+import os
+import json
+import time
+import fcntl
+import hashlib
+import logging
+import subprocess
+import threading
+from contextlib import contextmanager
+from uuid import uuid4
+
+import numpy as np
+
+FRAME_WIDTH  = int(os.environ.get("FRAME_CACHE_WIDTH", "96"))
+FRAME_HEIGHT = int(os.environ.get("FRAME_CACHE_HEIGHT", "54"))
+FRAME_FPS    = float(os.environ.get("FRAME_CACHE_FPS", "8"))
+FRAME_THREADS = os.environ.get("FRAME_CACHE_THREADS", "1")
+
+
+def frame_stream(in_path, width, height, fps, batch_frames=256, threads=FRAME_THREADS):
+    """
+    Yields uint8 arrays of shape (n, height, width): the video resampled to fps, scaled down
+    and converted to gray by ffmpeg, read from its stdout as it decodes (nothing on disk).
+    """
+    frame_bytes = width * height
+    proc = subprocess.Popen([
+        "ffmpeg", "-v", "error",
+        "-threads", threads,
+        "-skip_loop_filter", "all",  # deblocking doesn't matter at this size, skipping it speeds up decode
+        "-i", in_path,
+        "-an", "-sn",
+        "-vf", f"fps={fps},scale={width}:{height}:flags=area,format=gray",
+        "-f", "rawvideo", "-pix_fmt", "gray", "-"
+    ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        while True:
+            data = proc.stdout.read(frame_bytes * batch_frames)
+            n = len(data) // frame_bytes
+            if n:
+                yield np.frombuffer(data[:n * frame_bytes], dtype=np.uint8).reshape(n, height, width)
+            if len(data) < frame_bytes * batch_frames:
+                break
+    finally:
+        proc.stdout.close()
+        stderr = proc.stderr.read().decode("utf-8", "replace")
+        if proc.wait() != 0:
+            raise RuntimeError(f"ffmpeg frame stream failed: {stderr.strip()[:500]}")
+
+def probe_start_time(in_path):
+    """Container start_time in seconds (0.0 if unknown), to map frame times back to source PTS."""
+    result = subprocess.run([
+        "ffprobe", "-v", "error",
+        "-show_entries", "format=start_time",
+        "-of", "csv=p=0",
+        in_path
+    ], capture_output=True, text=True)
+    try:
+        return float(result.stdout.strip())
+    except ValueError:
+        return 0.0
+
+
+class FrameArray:
+    """
+    Read-only view of a cached decode: frames is an np.memmap of shape (n, height, width),
+    frame i shows the video at time_at(i) seconds (timeline starting at 0, like the model's
+    timestamps); source PTS is start_time + time_at(i).
+    """
+
+    def __init__(self, data_path, meta):
+        self.meta = meta
+        self.fps = meta["fps"]
+        self.width = meta["width"]
+        self.height = meta["height"]
+        self.start_time = meta["startTime"]
+        n = meta["frames"]
+        self.frames = (np.memmap(data_path, dtype=np.uint8, mode="r", shape=(n, self.height, self.width))
+                       if n else np.zeros((0, self.height, self.width), np.uint8))
+
+    def __len__(self):
+        return len(self.frames)
+
+    @property
+    def duration(self):
+        return len(self.frames) / self.fps
+
+    def time_at(self, index):
+        return index / self.fps
+
+    def index_at(self, seconds):
+        """Nearest frame index for a timeline position, clamped to the decoded range."""
+        return int(min(max(0, round(seconds * self.fps)), max(0, len(self.frames) - 1)))
+
+    def window(self, start_sec, end_sec):
+        """(first frame index, frames) covering [start_sec, end_sec); a view, nothing is copied."""
+        first = self.index_at(start_sec)
+        last = max(first, min(len(self.frames), int(np.ceil(end_sec * self.fps))))
+        return first, self.frames[first:last]
+
+    def batches(self, batch_frames=256):
+        for i in range(0, len(self.frames), batch_frames):
+            yield self.frames[i:i + batch_frames]
+
+
+class FrameCache:
+    """
+    Decodes a video once into <key>.u8 (raw uint8 frames) + <key>.json (metadata) under root
+    and hands out memory-mapped FrameArrays, so every local analyser (motion, shot refinement,
+    thumbnails, ...) in every worker process reads the same pages instead of running its own
+    ffmpeg decode. A per-key file lock makes concurrent processes share one decode.
+
+    Files are evicted least recently used first once the cache exceeds max_bytes. Removing
+    a file another process still has mapped is safe: its mapping stays valid until closed.
+    """
+
+    def __init__(self, root, max_bytes, width=FRAME_WIDTH, height=FRAME_HEIGHT, fps=FRAME_FPS):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._stats_lock = threading.Lock()  # counters are shared by every job thread
+        os.makedirs(root, exist_ok=True)
+
+    def _paths(self, source_key):
+        key = hashlib.sha256(f"{source_key}|{self.width}x{self.height}@{self.fps}".encode("utf-8")).hexdigest()[:32]
+        base = os.path.join(self.root, key)
+        return f"{base}.u8", f"{base}.json", f"{base}.lock"
+
+    @contextmanager
+    def _locked(self, lock_path):
+        with open(lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def has(self, source_key):
+        return os.path.exists(self._paths(source_key)[1])
+
+    def get(self, source_key, in_path):
+        """
+        FrameArray for the video at in_path, decoding it first if source_key (e.g. gs:// URI +
+        generation) isn't cached yet.
+        """
+        data_path, meta_path, lock_path = self._paths(source_key)
+        if not os.path.exists(meta_path):
+            with self._locked(lock_path):
+                if not os.path.exists(meta_path):  # another process may have built it meanwhile
+                    self._count("misses")
+                    self._build(in_path, source_key, data_path, meta_path)
+                    self._evict(keep=data_path)
+                    return self._open(data_path, meta_path)
+        self._count("hits")
+        return self._open(data_path, meta_path)
+
+    def _open(self, data_path, meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        now = time.time()
+        os.utime(data_path, (now, now))  # LRU order for eviction
+        return FrameArray(data_path, meta)
+
+    def _build(self, in_path, source_key, data_path, meta_path):
+        started = time.perf_counter()
+        tmp_path = f"{data_path}.part-{uuid4().hex[:8]}"
+        frames = 0
+        try:
+            with open(tmp_path, "wb") as out:
+                for batch in frame_stream(in_path, self.width, self.height, self.fps):
+                    out.write(batch.tobytes())
+                    frames += len(batch)
+            os.replace(tmp_path, data_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        elapsed = time.perf_counter() - started
+        meta = {
+            "source": source_key,
+            "width": self.width,
+            "height": self.height,
+            "fps": self.fps,
+            "frames": frames,
+            "startTime": probe_start_time(in_path),
+            "decodeSec": round(elapsed, 3),
+            "createdAt": time.time(),
+        }
+        with open(f"{meta_path}.tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(f"{meta_path}.tmp", meta_path)  # metadata last: its presence marks a complete entry
+        video_sec = frames / self.fps
+        logging.info(f"Frame cache: decoded {frames} frames ({video_sec:.0f}s of video, "
+                     f"{os.path.getsize(data_path) / 1024**2:.1f} MB) in {elapsed:.2f}s "
+                     f"({video_sec / elapsed if elapsed > 0 else 0:.1f}x realtime)")
+
+    def _evict(self, keep=None):
+        entries = []
+        for name in os.listdir(self.root):
+            if name.endswith(".u8"):
+                path = os.path.join(self.root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, path, stat.st_size))
+        total = sum(size for _, _, size in entries)
+        for _, path, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            for victim in (path, path[:-len(".u8")] + ".json", path[:-len(".u8")] + ".lock"):
+                try:
+                    os.remove(victim)
+                except FileNotFoundError:
+                    pass
+            total -= size
+            self._count("evictions")
+            logging.info(f"Frame cache: evicted {os.path.basename(path)} ({size / 1024**2:.1f} MB)")
+
+    def _count(self, counter):
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self):
+        with self._stats_lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
@@ -0,0 +1,121 @@
+# worker/genai_clients.py - process-wide registry of authenticated GenAI clients + call latency timing
+
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+import google.genai as genai
+from google.genai import types
+
+from json_stream import IncrementalJsonArrayParser
+from model_gateway import get_gateway
+
+VERTEX_PROJECT    = os.environ.get("VERTEX_PROJECT") or os.environ.get("GOOGLE_CLOUD_PROJECT") or "hooptuber-dev-1234"
+VERTEX_LOCATION   = os.environ.get("VERTEX_LOCATION", "us-central1")
+VERTEX_TIMEOUT_MS = int(os.environ.get("VERTEX_TIMEOUT_MS", "600000"))
+
+_lock = threading.Lock()
+_clients = {}
+_latency = {}
+
+
+def get_vertex_client(project=None, location=None, timeout_ms=None):
+    """
+    Shared Vertex AI client for (project, location, timeout). Built once per process so
+    credentials and connections are reused across jobs; safe to call from any
+    subscriber callback thread.
+    """
+    key = ("vertex", project or VERTEX_PROJECT, location or VERTEX_LOCATION, timeout_ms or VERTEX_TIMEOUT_MS)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            _, project, location, timeout_ms = key
+            logging.info(f"Creating Vertex GenAI client for {project}/{location}")
+            client = genai.Client(
+                vertexai=True,
+                project=project,
+                location=location,
+                http_options=types.HttpOptions(timeout=timeout_ms),
+            )
+            _clients[key] = client
+    return client
+
+def get_gemini_client():
+    """Shared Gemini Developer API client (GEMINI_API_KEY), used for the Files API path."""
+    with _lock:
+        client = _clients.get("gemini")
+        if client is None:
+            client = _clients["gemini"] = genai.Client()
+    return client
+
+
+@contextmanager
+def timed_call(label):
+    """Records wall-clock latency of the wrapped model call under label."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        with _lock:
+            stats = _latency.setdefault(label, {"calls": 0, "totalSec": 0.0, "maxSec": 0.0})
+            stats["calls"] += 1
+            stats["totalSec"] += elapsed
+            stats["maxSec"] = max(stats["maxSec"], elapsed)
+        logging.info(f"{label} took {elapsed:.2f}s")
+
+def _with_timeout(config, timeout_sec):
+    """Copy of config whose request timeout fits in what is left of the call deadline."""
+    http_options = types.HttpOptions(timeout=int(max(1.0, min(timeout_sec * 1000, VERTEX_TIMEOUT_MS))))
+    if config is None:
+        return types.GenerateContentConfig(http_options=http_options)
+    return config.model_copy(update={"http_options": http_options})
+
+def generate_text(client, label, on_objects=None, **kwargs):
+    """
+    Runs client.models.generate_content(**kwargs) through the backend's model gateway
+    (label "vertex.*" or "gemini.*") and returns the response text (None if the response
+    has none). With on_objects the response is streamed instead, and on_objects(list) is
+    called with each batch of complete JSON objects as they arrive.
+    """
+    gateway = get_gateway(label.split(".")[0])
+
+    def attempt(timeout_sec):
+        request = {**kwargs, "config": _with_timeout(kwargs.get("config"), timeout_sec)}
+        if on_objects is None:
+            resp = client.models.generate_content(**request)
+            text = getattr(resp, "text", None)
+            if not text:
+                try:
+                    text = resp.candidates[0].content.parts[0].text
+                except (AttributeError, IndexError, TypeError):
+                    text = None
+            return text
+
+        parser = IncrementalJsonArrayParser()
+        pieces = []
+        for chunk in client.models.generate_content_stream(**request):
+            piece = getattr(chunk, "text", None) or ""
+            pieces.append(piece)
+            objects = parser.feed(piece)
+            if objects:
+                try:
+                    on_objects(objects)
+                except Exception as e:
+                    # a failed progress write must not lose the analysis itself
+                    logging.warning(f"{label}: streamed event callback failed: {e}")
+        logging.info(f"{label}: streamed {len(pieces)} chunks, skipped {parser.skipped} malformed object(s)")
+        return "".join(pieces) or None
+
+    with timed_call(label):
+        return gateway.call(attempt, label)
+
+def call_stats():
+    """Per-label call count, total/avg/max latency in seconds."""
+    with _lock:
+        return {
+            label: {**stats, "avgSec": stats["totalSec"] / stats["calls"]}
+            for label, stats in _latency.items()
+        }
@@ -0,0 +1,173 @@
+# worker/intervals.py - vectorised timestamp parsing, clip-range merging and event -> range mapping (NumPy)
+
+import numpy as np
+
+# when a merged range holds several shots, the range is labelled with the first outcome found in this order
+OUTCOME_PRIORITY = ("make", "miss")
+
+
+def parse_timestamps(values):
+    """
+    Seconds (float64 array) for "HH:MM:SS" / "MM:SS" / "SS" strings or numbers; NaN for
+    anything unparseable. "H...H:MM:SS" strings (what the model is asked for) are decoded
+    together as a uint8 matrix; anything else goes through the scalar fallback.
+    """
+    values = list(values)
+    out = np.full(len(values), np.nan)
+    if not values:
+        return out
+    lengths = np.fromiter((len(v) if type(v) is str else 0 for v in values), np.int64, len(values))
+    fast = (lengths >= 7) & (lengths <= 16)
+    if fast.any():
+        try:
+            strings = [v for v, f in zip(values, fast) if f]
+            width = int(lengths[fast].max())
+            raw = np.array(strings, dtype=f"S{width}").view(np.uint8).reshape(-1, width)
+            n = lengths[fast]
+            rows = np.arange(len(raw))
+            digits = raw.astype(np.int64) - ord("0")
+            is_digit = (digits >= 0) & (digits <= 9)
+            pos = np.arange(width)
+            hour_part = pos < (n - 6)[:, None]  # everything before ":MM:SS"
+            ok = ((raw[rows, n - 3] == ord(":")) & (raw[rows, n - 6] == ord(":"))
+                  & is_digit[rows, n - 1] & is_digit[rows, n - 2] & is_digit[rows, n - 4] & is_digit[rows, n - 5]
+                  & (is_digit | ~hour_part).all(axis=1))
+            place = np.where(hour_part, 10.0 ** np.maximum(0, (n - 7)[:, None] - pos), 0.0)
+            hours = (np.where(hour_part, digits, 0) * place).sum(axis=1)
+            minutes = digits[rows, n - 5] * 10 + digits[rows, n - 4]
+            seconds = digits[rows, n - 2] * 10 + digits[rows, n - 1]
+            out[fast] = np.where(ok, hours * 3600 + minutes * 60 + seconds, np.nan)
+            fast[np.flatnonzero(fast)[~ok]] = False  # e.g. "1:2:3.45": let the fallback try
+        except UnicodeEncodeError:
+            fast[:] = False
+    for i in np.flatnonzero(~fast):
+        out[i] = _parse_one(values[i])
+    return out
+
+def _parse_one(value):
+    if isinstance(value, bool):
+        return np.nan
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        parts = str(value).strip().split(":")
+        if len(parts) > 3 or not parts[-1]:
+            return np.nan
+        total = 0.0
+        for part in parts:
+            total = total * 60 + float(part or 0)
+        return total
+    except ValueError:
+        return np.nan
+
+def event_timestamps(events):
+    """
+    (seconds, indices) for the model events timestamp_maker would keep: dicts with a
+    TimeStamp and a non-empty Outcome and a parseable time. indices point into events.
+    """
+    idx = [i for i, e in enumerate(events) if isinstance(e, dict) and "TimeStamp" in e and e.get("Outcome")]
+    seconds = parse_timestamps(events[i]["TimeStamp"] for i in idx)
+    keep = ~np.isnan(seconds)
+    return seconds[keep], np.asarray(idx, dtype=np.int64)[keep]
+
+def merge_intervals(starts, ends, merge_gap=0):
+    """
+    Merges (start, end) intervals that overlap or lie within merge_gap of each other.
+    Returns (merged_starts, merged_ends, membership) where membership[i] is the merged
+    range holding input interval i.
+    """
+    starts = np.asarray(starts, dtype=np.float64)
+    ends = np.asarray(ends, dtype=np.float64)
+    if len(starts) == 0:
+        return starts, ends, np.zeros(0, np.int64)
+    order = np.argsort(starts, kind="stable")
+    s, e = starts[order], ends[order]
+    reach = np.maximum.accumulate(e)
+    new_group = np.concatenate(([True], s[1:] > reach[:-1] + merge_gap))
+    group_first = np.flatnonzero(new_group)
+    membership = np.empty(len(s), np.int64)
+    membership[order] = np.cumsum(new_group) - 1
+    return s[group_first], np.maximum.reduceat(e, group_first), membership
+
+def fixed_windows(timestamps, clip_duration=5, start_before=1):
+    """converting_tester's window per timestamp: [t - start_before, + clip_duration), clamped at 0."""
+    starts = np.maximum(0, np.asarray(timestamps, dtype=np.float64) - start_before)
+    return starts, starts + clip_duration
+
+def to_numbers(values):
+    """Plain Python numbers, whole seconds as ints like the old list-based code returned."""
+    values = np.asarray(values, dtype=np.float64)
+    whole = values == np.floor(values)
+    if whole.all():
+        return values.astype(np.int64).tolist()
+    return [int(x) if w else x for x, w in zip(values.tolist(), whole.tolist())]
+
+def to_ranges(starts, ends):
+    """Plain (start, end) tuples of to_numbers values."""
+    return list(zip(to_numbers(starts), to_numbers(ends)))
+
+def merge_timestamps(timestamps, clip_duration=5, start_before=1, merge_gap=0):
+    """Merged clip ranges for timestamps (seconds), as converting_tester returns them."""
+    starts, ends, _ = merge_intervals(*fixed_windows(timestamps, clip_duration, start_before), merge_gap)
+    return to_ranges(starts, ends)
+
+def assign_to_ranges(timestamps, starts, ends):
+    """
+    Index of the range each timestamp belongs to: the sorted, disjoint range containing it,
+    or the nearest one (refined ranges may sit just beside the model's whole-second time).
+    """
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    starts, ends = np.asarray(starts, dtype=np.float64), np.asarray(ends, dtype=np.float64)
+    if len(starts) == 0:
+        return np.full(len(timestamps), -1, np.int64)
+    order = np.argsort(starts, kind="stable")
+    s, e = starts[order], ends[order]
+    left = np.clip(np.searchsorted(s, timestamps, side="right") - 1, 0, len(s) - 1)
+    right = np.clip(left + 1, 0, len(s) - 1)
+    dist_left = np.maximum(0, np.maximum(s[left] - timestamps, timestamps - e[left]))
+    dist_right = np.maximum(0, np.maximum(s[right] - timestamps, timestamps - e[right]))
+    return order[np.where(dist_right < dist_left, right, left)]
+
+def aggregate_outcomes(outcomes, membership, n_ranges):
+    """
+    Per range: (label, counts) where counts maps each outcome (as the model wrote it) to
+    how many events in the range had it, and label is the first OUTCOME_PRIORITY outcome
+    present (else the most common one).
+    """
+    membership = np.asarray(membership, dtype=np.int64)
+    keep = np.fromiter((bool(o) for o in outcomes), bool, len(outcomes)) & (membership >= 0) & (membership < n_ranges)
+    names, codes = np.unique(np.array([o for o, k in zip(outcomes, keep) if k], dtype=object).astype(str),
+                             return_inverse=True)
+    if len(names) == 0:
+        return [(None, {}) for _ in range(n_ranges)]
+    counts = np.zeros((n_ranges, len(names)), np.int64)
+    np.add.at(counts, (membership[keep], codes.reshape(-1)), 1)
+
+    # label column per range: highest-priority outcome present, else the most common one
+    label_col = np.where(counts.any(axis=1), counts.argmax(axis=1), -1)
+    lowered = [n.lower() for n in names.tolist()]
+    for priority in reversed(OUTCOME_PRIORITY):
+        for col in [c for c, n in enumerate(lowered) if n == priority]:
+            label_col = np.where(counts[:, col] > 0, col, label_col)
+
+    names = names.tolist()
+    single = (counts > 0).sum(axis=1) <= 1  # the common case: every shot in the range had the same outcome
+    label_count = counts[np.arange(n_ranges), np.maximum(label_col, 0)].tolist()
+    result = []
+    for r, (col, alone) in enumerate(zip(label_col.tolist(), single.tolist())):
+        if col < 0:
+            result.append((None, {}))
+        elif alone:
+            result.append((names[col], {names[col]: label_count[r]}))
+        else:
+            result.append((names[col], {n: c for n, c in zip(names, counts[r].tolist()) if c}))
+    return result
+
+def events_by_range(events, ranges):
+    """(label, counts) aggregated outcomes of the model events that fall in each of ranges."""
+    seconds, idx = event_timestamps(events)
+    starts = [s for s, _ in ranges]
+    ends = [e for _, e in ranges]
+    membership = assign_to_ranges(seconds, starts, ends)
+    outcomes = [events[i].get("Outcome") or events[i].get("outcome") for i in idx.tolist()]
+    return aggregate_outcomes(outcomes, membership, len(ranges))
@@ -0,0 +1,136 @@
+# worker/job_lease.py - Firestore lease on the job document so Pub/Sub redeliveries don't rerun jobs
+
+import os
+import socket
+import logging
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+from google.cloud import firestore
+
+LEASE_SEC = int(os.environ.get("JOB_LEASE_SEC", "300"))
+DEFER_SEC = int(os.environ.get("JOB_LEASE_DEFER_SEC", "60"))  # redelivery delay while a lease is held
+WORKER_ID = os.environ.get("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
+CLAIMED = "claimed"
+DUPLICATE_DONE = "duplicate_done"      # this message was already fully handled -> ack
+DUPLICATE_ACTIVE = "duplicate_active"  # a live lease is held (by any worker) -> redeliver after DEFER_SEC
+
+_stats_lock = threading.Lock()
+LEASE_STATS = {"claimed": 0, "skippedDone": 0, "deferredActive": 0, "leasesLost": 0}
+
+def _count(key):
+    with _stats_lock:
+        LEASE_STATS[key] += 1
+
+def lease_stats():
+    with _stats_lock:
+        return dict(LEASE_STATS)
+
+
+@firestore.transactional
+def _claim_in_transaction(transaction, doc_ref, mode, message_id, owner, token, lease_sec):
+    snap = doc_ref.get(transaction=transaction)
+    data = snap.to_dict() if snap.exists else {}
+    lease = ((data or {}).get("leases") or {}).get(mode)
+    now = datetime.now(timezone.utc)
+    if lease:
+        if lease.get("messageId") == message_id and lease.get("state") == "done":
+            return DUPLICATE_DONE
+        expires_at = lease.get("expiresAt")
+        # any live lease blocks, including one held by this process for an earlier delivery
+        if lease.get("state") == "active" and expires_at and expires_at > now:
+            return DUPLICATE_ACTIVE
+    transaction.set(doc_ref, {"leases": {mode: {
+        "messageId": message_id,
+        "owner": owner,
+        "token": token,
+        "state": "active",
+        "claimedAt": now,
+        "expiresAt": now + timedelta(seconds=lease_sec),
+    }}}, merge=True)
+    return CLAIMED
+
+@firestore.transactional
+def _update_if_owner(transaction, doc_ref, mode, token, fields):
+    snap = doc_ref.get(transaction=transaction)
+    lease = (((snap.to_dict() or {}) if snap.exists else {}).get("leases") or {}).get(mode) or {}
+    if lease.get("token") != token:
+        return False
+    transaction.set(doc_ref, {"leases": {mode: fields}}, merge=True)
+    return True
+
+
+class JobLease:
+    """
+    Claim on leases.<mode> of a job document, written in a transaction.
+
+    A worker claims the lease before running a job and renews it from a heartbeat thread
+    while the job runs. If the worker dies, the lease expires after lease_sec and the next
+    delivery of the message can take over. Each claim gets its own token, so renewals only
+    touch the lease this claim wrote, even when the same process is redelivered the message.
+    A redelivery of a message that already finished is reported as DUPLICATE_DONE and
+    counted on the job (duplicateDeliveriesSkipped).
+    """
+
+    def __init__(self, firestore_client, doc_ref, mode, message_id, lease_sec=LEASE_SEC, owner=WORKER_ID):
+        self.firestore_client = firestore_client
+        self.doc_ref = doc_ref
+        self.mode = mode
+        self.message_id = message_id
+        self.lease_sec = lease_sec
+        self.owner = owner
+        self.token = uuid.uuid4().hex
+        self.lost = False
+        self.release_state = "done"  # "failed" leaves the lease claimable by the redelivery
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def claim(self):
+        outcome = _claim_in_transaction(
+            self.firestore_client.transaction(), self.doc_ref,
+            self.mode, self.message_id, self.owner, self.token, self.lease_sec,
+        )
+        if outcome == CLAIMED:
+            _count("claimed")
+        elif outcome == DUPLICATE_DONE:
+            _count("skippedDone")
+            self.doc_ref.set({"duplicateDeliveriesSkipped": firestore.Increment(1)}, merge=True)
+            logging.info(f"Skipping duplicate delivery {self.message_id} ({self.mode}): already done")
+        else:
+            _count("deferredActive")
+            logging.info(f"Deferring delivery {self.message_id} ({self.mode}): lease is held")
+        return outcome
+
+    def _renew(self, state="active"):
+        now = datetime.now(timezone.utc)
+        fields = {"state": state, "expiresAt": now + timedelta(seconds=self.lease_sec)}
+        if state != "active":
+            fields["releasedAt"] = now
+        owned = _update_if_owner(
+            self.firestore_client.transaction(), self.doc_ref,
+            self.mode, self.token, fields,
+        )
+        if not owned and not self.lost:
+            self.lost = True
+            _count("leasesLost")
+            logging.warning(f"Lost lease on {self.doc_ref.id} ({self.mode}) to another claim")
+        return owned
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(self.lease_sec / 3):
+            try:
+                self._renew()
+            except Exception as e:
+                logging.warning(f"Lease heartbeat failed for {self.doc_ref.id}: {e}")
+
+    def __enter__(self):
+        self._heartbeat = threading.Thread(target=self._heartbeat_loop, daemon=True)
+        self._heartbeat.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._heartbeat.join()
+        self._renew(self.release_state)
+        return False
@@ -0,0 +1,61 @@
+# worker/json_stream.py - tolerant incremental parsing of a streamed JSON array of shot events
+
+import json
+import logging
+
+
+class IncrementalJsonArrayParser:
+    """
+    Feed it text chunks as they stream in; each feed() returns the complete top-level
+    JSON objects finished so far. Code fences, the surrounding [ ], commas and other
+    junk between objects are ignored, and an object that fails to parse is skipped
+    instead of failing the whole response.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._pos = 0          # next char of _buffer to scan
+        self._depth = 0        # brace depth (objects only)
+        self._start = None     # start index of the current top-level object
+        self._in_string = False
+        self._escaped = False
+        self.skipped = 0
+
+    def feed(self, text):
+        self._buffer += text or ""
+        objects = []
+        buf = self._buffer
+        for i in range(self._pos, len(buf)):
+            ch = buf[i]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == "\\":
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+            if ch == '"' and self._depth > 0:
+                self._in_string = True
+            elif ch == "{":
+                if self._depth == 0:
+                    self._start = i
+                self._depth += 1
+            elif ch == "}" and self._depth > 0:
+                self._depth -= 1
+                if self._depth == 0:
+                    raw = buf[self._start:i + 1]
+                    try:
+                        objects.append(json.loads(raw))
+                    except json.JSONDecodeError:
+                        self.skipped += 1
+                        logging.warning(f"Skipping malformed streamed object: {raw[:200]}")
+                    self._start = None
+        # drop everything already consumed so the buffer stays small
+        keep_from = self._start if self._start is not None else len(buf)
+        self._buffer = buf[keep_from:]
+        self._pos = len(buf) - keep_from
+        if self._start is not None:
+            self._start = 0
+        return objects
+
@@ -0,0 +1,239 @@
+# worker/keyframes.py - per-source keyframe index (ffprobe packet scan) and keyframe-aware "smart cut" rendering
+
+import os
+import json
+import time
+import bisect
+import logging
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+RENDER_CUT_MODE      = os.environ.get("RENDER_CUT_MODE", "smart")      # "smart", "snap" (copy from the keyframe before) or "encode"
+KEYFRAME_TOLERANCE   = float(os.environ.get("KEYFRAME_TOLERANCE_SEC", "0.1"))   # a cut this close to a keyframe counts as on it
+KEYFRAME_SNAP_MAX    = float(os.environ.get("KEYFRAME_SNAP_MAX_SEC", "1.0"))    # "snap": how early a clip may start
+KEYFRAME_SCAN_WINDOW = float(os.environ.get("KEYFRAME_SCAN_WINDOW_SEC", "15"))  # partial scans read this far around each cut
+SMART_CUT_MIN_COPY   = float(os.environ.get("SMART_CUT_MIN_COPY_SEC", "0.5"))   # shorter copyable tails are just re-encoded
+
+# codec -> bitstream filter that puts parameter sets in-band, so re-encoded and copied segments concat cleanly
+ANNEXB_FILTERS = {"h264": "h264_mp4toannexb", "hevc": "hevc_mp4toannexb"}
+ENCODERS = {"h264": "libx264", "hevc": "libx265"}
+
+
+def probe_streams(in_path):
+    """Codec details needed to re-encode segments that concat with stream-copied ones."""
+    result = subprocess.run([
+        "ffprobe", "-v", "error",
+        "-show_entries", "stream=codec_type,codec_name,pix_fmt,width,height,sample_rate,channels:format=start_time",
+        "-of", "json",
+        in_path
+    ], capture_output=True, text=True, check=True)
+    data = json.loads(result.stdout)
+    info = {"video": None, "audio": None, "startTime": float(data.get("format", {}).get("start_time") or 0.0)}
+    for stream in data.get("streams", []):
+        kind = stream.get("codec_type")
+        if kind in ("video", "audio") and info[kind] is None:
+            info[kind] = stream
+    return info
+
+
+class KeyframeIndex:
+    """
+    Video keyframe times for one source, on the 0-based timeline the cuts use (PTS minus
+    the container start time). Built lazily: ensure() scans only the neighbourhoods of the
+    requested cut points with ffprobe -read_intervals (packet headers only, no decode) and
+    records which spans are covered, so later renders of the same source reuse the scan.
+    to_dict()/from_dict() round-trip it through the job's keyframes.json.
+    """
+
+    def __init__(self, source=None, keyframes=None, covered=None, start_time=None):
+        self.source = source
+        self.keyframes = sorted(keyframes or [])
+        self.covered = [tuple(span) for span in covered or []]
+        self.start_time = start_time
+        self.dirty = False
+        self.scans = 0
+        self.scan_sec = 0.0
+
+    @classmethod
+    def from_dict(cls, data, source=None):
+        if not data or (source and data.get("source") != source):
+            return cls(source)  # different upload generation: start over
+        return cls(data.get("source"), data.get("keyframes"), data.get("covered"), data.get("startTime"))
+
+    def to_dict(self):
+        return {
+            "source": self.source,
+            "keyframes": [round(k, 6) for k in self.keyframes],
+            "covered": [[round(s, 3), round(e, 3)] for s, e in self.covered],
+            "startTime": self.start_time,
+        }
+
+    def is_covered(self, start, end):
+        return any(s <= start and end <= e for s, e in self.covered)
+
+    def ensure(self, in_path, points, window=KEYFRAME_SCAN_WINDOW):
+        """Scans whatever part of [p - window, p + window] around each point isn't indexed yet."""
+        missing = []
+        for p in sorted(points):
+            span = (max(0.0, p - window), p + window)
+            if self.is_covered(*span):
+                continue
+            if missing and span[0] <= missing[-1][1]:
+                missing[-1] = (missing[-1][0], max(missing[-1][1], span[1]))
+            else:
+                missing.append(span)
+        if missing:
+            self.scan(in_path, missing)
+        return self
+
+    def scan(self, in_path, spans=None):
+        """Adds keyframes from an ffprobe packet scan of spans (timeline seconds), or the whole file."""
+        started = time.perf_counter()
+        if self.start_time is None:
+            self.start_time = probe_streams(in_path)["startTime"]
+        cmd = ["ffprobe", "-v", "error", "-select_streams", "v:0"]
+        if spans:
+            # read_intervals takes absolute PTS; ffprobe seeks to the keyframe before each start
+            cmd += ["-read_intervals", ",".join(f"{s + self.start_time:.3f}%{e + self.start_time:.3f}" for s, e in spans)]
+        cmd += ["-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", in_path]
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"Keyframe scan failed: {result.stderr.strip()[:500]}")
+        found = set(self.keyframes)
+        last_pts = 0.0
+        for line in result.stdout.splitlines():
+            pts_time, _, flags = line.partition(",")
+            if pts_time in ("", "N/A"):
+                continue
+            t = float(pts_time) - self.start_time
+            last_pts = max(last_pts, t)
+            if flags.startswith("K"):
+                found.add(round(t, 6))
+        self.keyframes = sorted(found)
+        self._cover(spans or [(0.0, max(last_pts, 0.0) + 1e6)])  # a full scan covers everything
+        self.dirty = True
+        self.scans += 1
+        self.scan_sec += time.perf_counter() - started
+        logging.info(f"Keyframe scan of {len(spans) if spans else 'all'} span(s): {len(self.keyframes)} keyframes "
+                     f"indexed in {time.perf_counter() - started:.2f}s")
+
+    def _cover(self, spans):
+        merged = []
+        for s, e in sorted(self.covered + [tuple(span) for span in spans]):
+            if merged and s <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], e))
+            else:
+                merged.append((s, e))
+        self.covered = merged
+
+    def at_or_before(self, t):
+        i = bisect.bisect_right(self.keyframes, t + KEYFRAME_TOLERANCE)
+        return self.keyframes[i - 1] if i else 0.0
+
+    def after(self, t):
+        i = bisect.bisect_right(self.keyframes, t + KEYFRAME_TOLERANCE)
+        return self.keyframes[i] if i < len(self.keyframes) else None
+
+    def on_keyframe(self, t):
+        return t <= KEYFRAME_TOLERANCE or abs(self.at_or_before(t) - t) <= KEYFRAME_TOLERANCE
+
+
+def plan_cuts(ranges, index, mode=RENDER_CUT_MODE):
+    """
+    Splits each (start, end) range into ("copy" | "encode", start, end) segments:
+    ranges starting on a keyframe are copied whole; in "snap" mode a range may start up
+    to KEYFRAME_SNAP_MAX early so it can be copied; otherwise ("smart") only the partial
+    GOP up to the next keyframe is re-encoded and the rest is copied.
+    """
+    segments = []
+    for start, end in ranges:
+        if index.on_keyframe(start):
+            segments.append(("copy", index.at_or_before(start) if start > KEYFRAME_TOLERANCE else start, end))
+            continue
+        before = index.at_or_before(start)
+        if mode == "snap" and start - before <= KEYFRAME_SNAP_MAX:
+            segments.append(("copy", before, end))
+            continue
+        boundary = index.after(start)
+        if boundary is not None and end - boundary >= SMART_CUT_MIN_COPY:
+            segments.append(("encode", start, boundary))
+            segments.append(("copy", boundary, end))
+        else:
+            segments.append(("encode", start, end))
+    return segments
+
+def smart_cut_supported(streams):
+    """Re-encoded heads can only be joined to copied bodies for codecs we can re-encode to and annex-B."""
+    video, audio = streams["video"], streams["audio"]
+    return (video is not None and video.get("codec_name") in ENCODERS
+            and (audio is None or audio.get("codec_name") == "aac"))
+
+def _segment_cmd(kind, start, end, in_path, seg_path, streams):
+    video, audio = streams["video"], streams["audio"]
+    cmd = ["ffmpeg", "-v", "error", "-ss", f"{start:.6f}", "-i", in_path, "-t", f"{end - start:.6f}",
+           "-map", "0:v:0"]
+    if audio is not None:
+        cmd += ["-map", "0:a:0"]
+    if kind == "copy":
+        cmd += ["-c", "copy"]
+    else:
+        # match the source so the decoder sees one continuous stream across segment joins
+        cmd += ["-c:v", ENCODERS[video["codec_name"]], "-preset", "veryfast", "-crf", "18",
+                "-pix_fmt", video.get("pix_fmt") or "yuv420p"]
+        if audio is not None:
+            cmd += ["-c:a", "aac", "-ar", str(audio.get("sample_rate") or 48000),
+                    "-ac", str(audio.get("channels") or 2)]
+    cmd += ["-bsf:v", ANNEXB_FILTERS[video["codec_name"]], "-avoid_negative_ts", "make_zero",
+            "-f", "mpegts", "-y", seg_path]
+    return cmd
+
+def render_smart_cut(ranges, in_path, out_path, index, streams=None, mode=RENDER_CUT_MODE, max_workers=None):
+    """
+    Frame-accurate render at close to stream-copy speed: plans the cuts against index,
+    writes each segment (copied, or re-encoded boundary GOP) as MPEG-TS concurrently,
+    then joins them with a single concat-demuxer copy into out_path.
+    Returns (ok, stats).
+    """
+    streams = streams or probe_streams(in_path)
+    segments = plan_cuts(ranges, index, mode)
+    workers = max(1, min(max_workers or os.cpu_count() or 1, len(segments)))
+    stats = {
+        "cutMode": mode,
+        "segments": len(segments),
+        "encodedSegments": sum(kind == "encode" for kind, _, _ in segments),
+        "encodedSec": round(sum(e - s for kind, s, e in segments if kind == "encode"), 3),
+        "copiedSec": round(sum(e - s for kind, s, e in segments if kind == "copy"), 3),
+    }
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        paths = [os.path.join(temp_dir, f"seg_{i:04d}.ts") for i in range(len(segments))]
+
+        def run(i):
+            kind, start, end = segments[i]
+            return subprocess.run(_segment_cmd(kind, start, end, in_path, paths[i], streams),
+                                  capture_output=True, text=True)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(run, range(len(segments))))
+        failed = [r.stderr.strip()[:300] for r in results if r.returncode != 0]
+        if failed:
+            print(f"✗ Error cutting {len(failed)}/{len(segments)} segments: {failed[0]}")
+            return False, stats
+
+        filelist_path = os.path.join(temp_dir, "segments.txt")
+        with open(filelist_path, "w") as f:
+            for path in paths:
+                f.write(f"file '{path}'\n")
+        cmd = ["ffmpeg", "-v", "error", "-f", "concat", "-safe", "0", "-i", filelist_path, "-c", "copy"]
+        if streams["audio"] is not None:
+            cmd += ["-bsf:a", "aac_adtstoasc"]
+        cmd += ["-movflags", "+faststart", "-y", out_path]
+        result = subprocess.run(cmd, capture_output=True, text=True)
+    stats["renderSec"] = round(time.perf_counter() - started, 3)
+    if result.returncode != 0:
+        print(f"✗ Error joining smart-cut segments: {result.stderr}")
+        return False, stats
+    print(f"✓ Smart cut: {stats['encodedSegments']}/{stats['segments']} segments re-encoded "
+          f"({stats['encodedSec']}s of {stats['encodedSec'] + stats['copiedSec']:.1f}s) in {stats['renderSec']:.2f}s")
+    return True, stats
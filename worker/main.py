@@ -1,15 +1,34 @@
 # worker/main.py -downloads from GCS, “processes” the file, uploads back to GCS, and updates Firestore
 
-import os, json, time, tempfile, shutil
+import os, json, time, tempfile, shutil, threading, posixpath
+from contextlib import ExitStack
 from google.cloud import pubsub_v1, storage, firestore
-from VideoInputTest import process_video_and_summarize, client, CreateHighlightVideo2, timestamp_maker, strip_code_fences
+from VideoInputTest import process_video_and_summarize, client, CreateHighlightVideo2, timestamp_maker, strip_code_fences, convert_timestamp_to_seconds, GEMINI_MODEL
 import subprocess
 import logging # for render logs
-from utils import convert_to_mp4, add_watermark
+from utils import convert_to_mp4, make_analysis_proxy
 import math
+from concurrent.futures import ThreadPoolExecutor
 
 # vertex version of process_video_and_summarize
-from VertexFunctions import vertex_data_cleaned
+from VertexFunctions import (vertex_data_cleaned, vertex_shot_events, VERTEX_MODEL,
+                             SEGMENT_SEC, SEGMENT_OVERLAP_SEC, SEGMENT_MIN_SEC, SEGMENT_DEDUPE_SEC)
+from range_source import RangedSource
+from audio_activity import candidate_windows, window_recall
+from motion_activity import motion_profile, intersect_windows
+from source_cache import SourceCache
+from frame_cache import FrameCache
+from shot_refine import refine_timestamps
+from keyframes import KeyframeIndex, RENDER_CUT_MODE
+from watermark import watermark_enabled
+from transfer import sliced_download, parallel_upload
+from scheduler import LaneScheduler, defer
+from checkpoints import JobCheckpoints, RETRY, RETRY_DELAY_SEC
+from job_lease import JobLease, DUPLICATE_DONE, DUPLICATE_ACTIVE, DEFER_SEC, lease_stats
+from genai_clients import call_stats
+from model_gateway import gateway_stats
+from analysis_cache import AnalysisCache, analysis_version
+from shot_schema import parse_shot_events, parse_stats, ShotParseError, STRUCTURED_OUTPUT
 
 
 from utils import format_gemini_output # COMBINES GEMINI OUTPUT AND TUPLE ARRAY FOR FRONTEND
@@ -28,6 +47,18 @@ RAW_BUCKET         = os.environ["GCS_RAW_BUCKET"]
 OUT_BUCKET         = os.environ["GCS_OUT_BUCKET"]
 COLLECTION         = os.environ.get("FIRESTORE_COLLECTION", "jobs")
 PUBSUB_TOPIC = os.environ.get("PUBSUB_TOPIC", "video-jobs")
+RENDER_MODE        = os.environ.get("HIGHLIGHT_RENDER_MODE", "single")  # "single" (one ffmpeg run) or "clips"
+RENDER_SOURCE_MODE = os.environ.get("RENDER_SOURCE_MODE", "ranged")     # "ranged" (byte ranges) or "download"
+ANALYSIS_PROXY     = os.environ.get("ANALYSIS_PROXY", "0") == "1"         # send a low-res proxy to the model
+ANALYSIS_PROXY_HEIGHT = int(os.environ.get("ANALYSIS_PROXY_HEIGHT", "360"))
+ANALYSIS_PROXY_FPS    = float(os.environ.get("ANALYSIS_PROXY_FPS", "5"))
+AUDIO_PREFILTER       = os.environ.get("AUDIO_PREFILTER", "off")          # "off", "shadow" (measure only) or "on"
+AUDIO_PREFILTER_MAX_COVERAGE = float(os.environ.get("AUDIO_PREFILTER_MAX_COVERAGE", "0.85"))
+MOTION_TRIM           = os.environ.get("MOTION_TRIM", "0") == "1"           # drop idle spans before analysis
+SHOT_REFINE           = os.environ.get("SHOT_REFINE", "0") == "1"           # snap clip ranges to motion around each timestamp
+OLD_ANALYSIS_SOURCE   = os.environ.get("OLD_ANALYSIS_SOURCE", "gcs")      # "gcs" (by reference, overlapped) or "files" (Files API upload)
+ANALYSIS_STREAMING    = os.environ.get("ANALYSIS_STREAMING", "1") == "1"     # publish shot events while the model runs
+STREAM_PUBLISH_SEC    = float(os.environ.get("ANALYSIS_STREAM_PUBLISH_SEC", "2"))
 
 
 storage_client   = storage.Client(project=PROJECT_ID)
@@ -35,39 +66,219 @@ firestore_client = firestore.Client(project=PROJECT_ID)
 
 Creator = CreateHighlightVideo2()
 
+# Local LRU cache of downloaded sources, shared by all jobs on this worker
+SOURCE_CACHE = SourceCache(
+    os.environ.get("SOURCE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "hooptuber-source-cache")),
+    int(float(os.environ.get("SOURCE_CACHE_MAX_GB", "20")) * 1024**3),
+)
+
+# Decode-once low-res grayscale frames (memory-mapped), shared by the local analysers
+FRAME_CACHE = FrameCache(
+    os.environ.get("FRAME_CACHE_DIR", os.path.join(tempfile.gettempdir(), "hooptuber-frame-cache")),
+    int(float(os.environ.get("FRAME_CACHE_MAX_GB", "4")) * 1024**3),
+)
+
+def analysis_settings(mode: str) -> dict:
+    """Model id and every setting that changes what a job in mode stores (the cache version)."""
+    settings = {
+        "model": GEMINI_MODEL if mode == "old" and OLD_ANALYSIS_SOURCE == "files" else VERTEX_MODEL,
+        "structuredOutput": STRUCTURED_OUTPUT,
+        "segments": [SEGMENT_SEC, SEGMENT_OVERLAP_SEC, SEGMENT_MIN_SEC, SEGMENT_DEDUPE_SEC],
+        "proxy": [ANALYSIS_PROXY_HEIGHT, ANALYSIS_PROXY_FPS] if ANALYSIS_PROXY else None,
+        "audioPrefilter": AUDIO_PREFILTER_MAX_COVERAGE if AUDIO_PREFILTER == "on" else None,
+        "motionTrim": MOTION_TRIM,
+    }
+    if mode == "old":  # the cached entry also carries the rendered highlight
+        settings.update({"shotRefine": SHOT_REFINE, "watermark": watermark_enabled(), "cutMode": RENDER_CUT_MODE})
+    return settings
+
+# Finished analyses keyed by upload content hash, shared with the upload endpoints
+ANALYSIS_CACHE = AnalysisCache(firestore_client, storage_client,
+                               {mode: analysis_version(mode, analysis_settings(mode)) for mode in ("vertex", "old")})
+
 def update_job(job_id: str, data: dict):
     firestore_client.collection(COLLECTION).document(job_id).set(data, merge=True)
 
-def download_from_gcs(gcs_uri: str, dest_path: str):
+def cache_lookup(job_id: str, input_gcs_uri: str, mode: str):
+    """
+    (cache key, hit) for the upload. On a hit the stored result is copied into the job and
+    marked done, so the caller only has to ack. Cache errors never fail the job.
+    """
+    try:
+        key = ANALYSIS_CACHE.key_for(input_gcs_uri, mode)
+        cached = ANALYSIS_CACHE.lookup(key, mode, job_id)
+    except Exception as e:
+        logging.warning(f"Analysis cache lookup failed for {job_id}: {e}")
+        return None, False
+    if cached:
+        update_job(job_id, {**cached, "status": "done", "finishedAt": firestore.SERVER_TIMESTAMP})
+    return key, bool(cached)
+
+def cache_store(key, mode: str, job_id: str, fields: dict):
+    try:
+        ANALYSIS_CACHE.store(key, mode, job_id, fields)
+    except Exception as e:
+        logging.warning(f"Analysis cache write failed for {job_id}: {e}")
+
+
+class ShotEventPublisher:
+    """
+    Callback for streamed model output: normalises raw events into the frontend shape and
+    appends them to the job's shotEvents in batches, at most one write every min_interval_sec.
+    The final analysis overwrites shotEvents with the merged ranges once the model is done.
+    Parse retries and gateway retries re-stream the whole response, so events are keyed on
+    (timestamp, outcome) and each shot is published once however many attempts report it.
+    """
+
+    def __init__(self, job_id, min_interval_sec=STREAM_PUBLISH_SEC):
+        self.job_id = job_id
+        self.min_interval_sec = min_interval_sec
+        self.published = 0
+        self._pending = []
+        self._seen = set()
+        self._last_write = 0.0
+        self._lock = threading.Lock()
+
+    def start(self):
+        update_job(self.job_id, {"shotEvents": [], "analysisProgress": {"eventsStreamed": 0}})
+        return self
+
+    def __call__(self, events):
+        with self._lock:
+            for event in events:
+                timestamps = timestamp_maker([event])
+                if not timestamps:
+                    continue
+                key = (timestamps[0], str(event.get("Outcome", "")).lower())
+                if key not in self._seen:
+                    self._seen.add(key)
+                    self._pending.extend(format_gemini_output([event], Creator.converting_tester(timestamps)))
+            if time.monotonic() - self._last_write >= self.min_interval_sec:
+                self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        self.published += len(batch)
+        self._last_write = time.monotonic()
+        update_job(self.job_id, {
+            "shotEvents": firestore.ArrayUnion(batch),
+            "analysisProgress": {"eventsStreamed": self.published, "updatedAt": firestore.SERVER_TIMESTAMP},
+        })
+
+    def close(self):
+        with self._lock:
+            self._flush()
+        logging.info(f"Streamed {self.published} shot events for {self.job_id}")
+
+def download_from_gcs(gcs_uri: str, dest_path: str, generation=None):
     # gcs_uri like gs://bucket/path/file.mp4
     assert gcs_uri.startswith("gs://")
     _, _, rest = gcs_uri.partition("gs://")
     bucket_name, _, blob_name = rest.partition("/")
     folder_prefix = os.path.dirname(blob_name)
     bucket = storage_client.bucket(bucket_name)
-    blob   = bucket.blob(blob_name)
-    blob.download_to_filename(dest_path)
+    blob   = bucket.get_blob(blob_name, generation=generation)
+    if blob is None:
+        raise FileNotFoundError(f"Source not found: {gcs_uri}")
+    return sliced_download(blob, dest_path)
+
+def source_generation(gcs_uri: str):
+    """Current object generation of gcs_uri (part of the source cache key)."""
+    _, _, rest = gcs_uri.partition("gs://")
+    bucket_name, _, blob_name = rest.partition("/")
+    blob = storage_client.bucket(bucket_name).get_blob(blob_name)
+    if blob is None:
+        raise FileNotFoundError(f"Source not found: {gcs_uri}")
+    return blob.generation
+
+def cached_source(gcs_uri: str, generation=None):
+    """Context manager yielding a pinned local copy of gcs_uri from SOURCE_CACHE."""
+    if generation is None:
+        generation = source_generation(gcs_uri)
+    return SOURCE_CACHE.pin(
+        gcs_uri, generation,
+        lambda dest_path: download_from_gcs(gcs_uri, dest_path, generation=generation),
+    )
+
+def cached_frames(gcs_uri: str, generation=None):
+    """FrameArray for gs_uri from FRAME_CACHE, decoding a pinned source copy on a miss."""
+    if generation is None:
+        generation = source_generation(gcs_uri)
+    key = f"{gcs_uri}#{generation}"
+    if FRAME_CACHE.has(key):
+        return FRAME_CACHE.get(key, None)
+    with cached_source(gcs_uri, generation) as in_path:
+        return FRAME_CACHE.get(key, in_path)
 
 def upload_to_gcs(local_path: str, bucket_name: str, dst_key: str) -> str:
+    bucket = storage_client.bucket(bucket_name)
+    parallel_upload(local_path, bucket, dst_key, timeout=600)
+    return f"gs://{bucket_name}/{dst_key}"
+
+def upload_json_to_gcs(data, bucket_name: str, dst_key: str) -> str:
+    """Uploads data as a JSON object straight from memory (no temp file)."""
     bucket = storage_client.bucket(bucket_name)
     blob   = bucket.blob(dst_key)
-    blob.upload_from_filename(local_path, timeout=600)
+    blob.upload_from_string(json.dumps(data), content_type="application/json", timeout=600)
     return f"gs://{bucket_name}/{dst_key}"
 
 
+def edit_ranges(edits, highlighter):
+    """
+    Turns clip edits into (start, end) second ranges.
+    Accepts explicit {"start", "end"} clips, shotEvents-style {"timestamp_start", "timestamp_end"}
+    entries, or raw model events ({"TimeStamp", "Outcome"}) which are merged by converting_tester.
+    """
+    if edits and all(isinstance(e, dict) and "start" in e and "end" in e for e in edits):
+        return [(float(e["start"]), float(e["end"])) for e in edits]
+    if edits and all(isinstance(e, dict) and e.get("timestamp_start") and e.get("timestamp_end") for e in edits):
+        return [
+            (convert_timestamp_to_seconds(e["timestamp_start"]), convert_timestamp_to_seconds(e["timestamp_end"]))
+            for e in edits
+            if e.get("show", True) and not e.get("deleted", False)
+        ]
+    make_timestamps = timestamp_maker(edits) # list of make timestamps
+    print(f"[DEBUG] @ make_highlight: timestamps = {make_timestamps}")
+    return highlighter.converting_tester(make_timestamps)
+
+def load_keyframe_index(job_id: str, gcs_uri: str, generation) -> KeyframeIndex:
+    """Keyframe index cached next to the job outputs (gs://OUT_BUCKET/<job>/keyframes.json), or a fresh one."""
+    source = f"{gcs_uri}#{generation}"
+    try:
+        blob = storage_client.bucket(OUT_BUCKET).blob(f"{job_id}/keyframes.json")
+        return KeyframeIndex.from_dict(json.loads(blob.download_as_bytes()), source)
+    except Exception:
+        return KeyframeIndex(source)  # not scanned yet
+
+def save_keyframe_index(job_id: str, index: KeyframeIndex):
+    """Stores the index back if this render scanned anything new. Best effort."""
+    if not index.dirty:
+        return
+    try:
+        upload_json_to_gcs(index.to_dict(), OUT_BUCKET, f"{job_id}/keyframes.json")
+        logging.info(f"Keyframe index for {job_id}: {len(index.keyframes)} keyframes, "
+                     f"{index.scans} scan(s) in {index.scan_sec:.2f}s")
+    except Exception as e:
+        logging.warning(f"Could not store keyframe index for {job_id}: {e}")
+
 # TIP: HANDLES CREATING HIGHLIGHT JSON FROM GCS URI
-def make_highlight(in_path: str, out_path: str, gemini_output):
+def make_highlight(in_path: str, out_path: str, gemini_output, keyframes=None):
     highlighter = CreateHighlightVideo2()
     # REAL HIGHLIGHT PIPELINE:
     print(f"[DEBUG] @make_highlight: type={type(gemini_output)}")
     print(f"[DEBUG] make_highlight: first element={gemini_output[0] if gemini_output else 'None'}")
-    make_timestamps = timestamp_maker(gemini_output) # list of make timestamps
-    print(f"[DEBUG] @ make_highlight: timestamps = {make_timestamps}")
-    tuple_timestamps = highlighter.converting_tester(make_timestamps)
-    clip_files = highlighter.create_highlights_ffmpeg(tuple_timestamps, in_path, out_path) # create highlight clips
-    if not clip_files:
+    tuple_timestamps = edit_ranges(gemini_output, highlighter)
+    if RENDER_MODE == "clips":
+        rendered = highlighter.create_highlights_ffmpeg(tuple_timestamps, in_path, out_path, keyframes=keyframes) # create highlight clips
+    else:
+        rendered = highlighter.create_highlights_single_pass(tuple_timestamps, in_path, out_path, keyframes=keyframes)
+    if not rendered:
         logging.error("Highlights failed")
         raise RuntimeError("No highlight clips were created.")
+    if highlighter.render_stats:
+        logging.info(f"Render cut stats: {highlighter.render_stats}")
     return out_path
 
 def get_video_length_seconds(out_path):
@@ -84,6 +295,160 @@ def get_video_length_seconds(out_path):
     duration = float(data["format"]["duration"])    
     return math.ceil(duration) # round up to nearest second       
 
+def finalize_outputs(out_path: str, out_key: str, analysis, json_key: str):
+    """
+    Uploads the highlight video, uploads the analysis JSON from memory and probes the
+    video duration concurrently. Returns (out_gcs_uri, analysis_gcs_uri, duration_sec).
+    """
+    finalize_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        video_upload = pool.submit(upload_to_gcs, out_path, OUT_BUCKET, out_key)
+        json_upload  = pool.submit(upload_json_to_gcs, analysis, OUT_BUCKET, json_key)
+        duration     = pool.submit(get_video_length_seconds, out_path)
+        results = video_upload.result(), json_upload.result(), duration.result()
+    logging.info(f"Finalize (uploads + probe) took {time.perf_counter() - finalize_start:.2f}s")
+    return results
+
+def proxy_gcs_location(input_gcs_uri: str, generation):
+    """
+    (bucket, key) of the analysis proxy, stored next to the raw upload. The key carries the
+    source generation, so an overwritten upload never reuses the proxy of its old bytes.
+    """
+    bucket_name, _, blob_name = input_gcs_uri[len("gs://"):].partition("/")
+    return bucket_name, posixpath.join(posixpath.dirname(blob_name), f"analysis_proxy-{generation}.mp4")
+
+def vertex_analysis_source(input_gcs_uri: str, stats: dict) -> str:
+    """
+    gs:// URI the model should read. With ANALYSIS_PROXY on, a low-res proxy is built
+    (once) and stored next to the raw upload; otherwise, or when the proxy would not be
+    smaller than the upload, the raw upload is used.
+    """
+    if not ANALYSIS_PROXY:
+        stats["analysisInput"] = "source"
+        return input_gcs_uri
+    stats["analysisInput"] = "proxy"
+    generation = source_generation(input_gcs_uri)
+    bucket_name, key = proxy_gcs_location(input_gcs_uri, generation)
+    existing = storage_client.bucket(bucket_name).get_blob(key)
+    if existing is not None:
+        stats["proxyBytes"] = existing.size
+        return f"gs://{bucket_name}/{key}"
+    with tempfile.TemporaryDirectory() as td, cached_source(input_gcs_uri, generation) as in_path:
+        proxy_path = make_analysis_proxy(in_path, td, ANALYSIS_PROXY_HEIGHT, ANALYSIS_PROXY_FPS, stats)
+        if proxy_path is None:
+            stats["analysisInput"] = "source"
+            return input_gcs_uri
+        return upload_to_gcs(proxy_path, bucket_name, key)
+
+def audio_prefilter(input_gcs_uri: str, video_dur_sec, stats: dict):
+    """
+    Candidate shot windows from the upload's audio (AUDIO_PREFILTER "on" or "shadow"), with
+    coverage/timings recorded in stats["audioPrefilter"]. None means analyse the whole video:
+    pre-filter off, no audio track, a failure, or ("on" only) too little time saved.
+    """
+    if AUDIO_PREFILTER not in ("on", "shadow"):
+        return None
+    try:
+        with cached_source(input_gcs_uri) as in_path:
+            profile = candidate_windows(in_path, video_dur_sec or None)
+    except Exception as e:
+        logging.warning(f"Audio pre-filter failed, analysing the full video: {e}")
+        return None
+    if profile is None:
+        stats["audioPrefilter"] = {"mode": AUDIO_PREFILTER, "skipped": "no audio"}
+        return None
+    windows = profile.pop("windows")
+    stats["audioPrefilter"] = {"mode": AUDIO_PREFILTER, "windows": len(windows), **profile}
+    if AUDIO_PREFILTER == "on" and (not windows or profile["coverage"] > AUDIO_PREFILTER_MAX_COVERAGE):
+        stats["audioPrefilter"]["skipped"] = "coverage"
+        return None
+    return windows
+
+def shadow_recall(events, windows, stats: dict):
+    """In shadow mode, how many full-analysis events the audio windows would have kept."""
+    if AUDIO_PREFILTER != "shadow" or windows is None or not isinstance(events, list):
+        return
+    prefilter = stats["audioPrefilter"]
+    prefilter["recall"] = window_recall(events, windows)
+    prefilter["modelSecSaved"] = round(prefilter["durationSec"] - prefilter["analysedSec"], 1)
+    logging.info(f"Audio pre-filter shadow: recall {prefilter['recall']} at coverage {prefilter['coverage']}")
+
+def motion_trim(job_id: str, input_gcs_uri: str, video_dur_sec, stats: dict):
+    """
+    With MOTION_TRIM on, profiles motion in the upload, stores the profile JSON next to the
+    job outputs and the idle spans on the job (for the editor), and returns the active
+    windows to analyse. None means analyse the whole video.
+    """
+    if not MOTION_TRIM:
+        return None
+    try:
+        started = time.perf_counter()  # include the decode on a frame cache miss
+        profile = motion_profile(duration_sec=video_dur_sec or None, frames=cached_frames(input_gcs_uri),
+                                 started=started)
+        profile_uri = upload_json_to_gcs(profile, OUT_BUCKET, f"{job_id}/motion_profile.json")
+    except Exception as e:
+        logging.warning(f"Motion profile failed, analysing the full video: {e}")
+        return None
+    stats["motionTrim"] = {k: profile[k] for k in ("idleSec", "durationSec", "elapsedSec", "realtimeFactor")}
+    update_job(job_id, {
+        "idleSpans": [{"start": start, "end": end} for start, end in profile["idleSpans"]],
+        "motionProfileGcsUri": profile_uri,
+    })
+    return profile["activeWindows"] if profile["idleSpans"] else None
+
+def refine_ranges(input_gcs_uri: str, timestamps, fixed_ranges, stats: dict):
+    """
+    With SHOT_REFINE on, replaces converting_tester's fixed windows with ranges snapped to
+    the motion around each timestamp (see shot_refine), recording the rendered duration
+    before/after in stats["shotRefine"]. Falls back to fixed_ranges on any failure.
+    """
+    if not SHOT_REFINE or not timestamps:
+        return fixed_ranges
+    try:
+        frames = cached_frames(input_gcs_uri)
+        ranges, stats["shotRefine"] = refine_timestamps(timestamps, frames, clip_duration=Creator.clip_duration)
+    except Exception as e:
+        logging.warning(f"Shot refinement failed, keeping fixed clip windows: {e}")
+        return fixed_ranges
+    return ranges
+
+def analysis_windows(job_id: str, input_gcs_uri: str, video_dur_sec, stats: dict):
+    """
+    (windows to send to the model or None for the whole video, audio candidate windows for
+    the shadow recall check). Audio windows ("on") and motion-active windows are intersected.
+    """
+    audio = audio_prefilter(input_gcs_uri, video_dur_sec, stats)
+    windows = audio if AUDIO_PREFILTER == "on" else None
+    active = motion_trim(job_id, input_gcs_uri, video_dur_sec, stats)
+    if active is not None:
+        windows = active if windows is None else intersect_windows(windows, active)
+    return windows, audio
+
+def analyse_by_reference(job_id: str, input_gcs_uri: str, stats: dict):
+    """
+    Old-pipeline analysis straight from the gs:// upload (or its proxy), the same way the
+    vertex path does it, so nothing is downloaded or re-uploaded to the Files API first.
+    Returns the raw shot events (or an error dict).
+    """
+    started = time.perf_counter()
+    analysis_gcs_uri = vertex_analysis_source(input_gcs_uri, stats)
+    job_doc = firestore_client.collection(COLLECTION).document(job_id).get()
+    job_data = (job_doc.to_dict() if job_doc.exists else None) or {}
+    video_dur_sec = job_data.get("videoDurationSec") or 0
+    stats["analysisSourceSec"] = round(time.perf_counter() - started, 3)
+    windows, audio_windows = analysis_windows(job_id, input_gcs_uri, video_dur_sec, stats)
+    model_started = time.perf_counter()
+    publisher = ShotEventPublisher(job_id).start() if ANALYSIS_STREAMING else None
+    try:
+        events = vertex_shot_events(analysis_gcs_uri, video_dur_sec, on_events=publisher,
+                                    stats=stats.setdefault("parse", {}), windows=windows)
+    finally:
+        if publisher:
+            publisher.close()
+        stats["modelLatencySec"] = round(time.perf_counter() - model_started, 3)
+    shadow_recall(events, audio_windows, stats)
+    return events
+
 def handle_job_vertex(msg: pubsub_v1.subscriber.message.Message):
     try:
         payload = json.loads(msg.data.decode("utf-8"))
@@ -100,10 +465,32 @@ def handle_job_vertex(msg: pubsub_v1.subscriber.message.Message):
         job_data = job_doc.to_dict() if job_doc.exists else {}
         video_dur_sec = job_data.get("videoDurationSec") if len(job_data) != 0 else 0
 
+        cache_key, cache_hit = cache_lookup(job_id, input_gcs_uri, "vertex")
+        if cache_hit:
+            logging.info(f"===JOB DONE: analysis copied from cache, Vertex")
+            msg.ack()
+            return
+
+        analysis_stats = {}
         try:
-            print(f"Sending to HoopTuber AI: {input_gcs_uri}")
+            analysis_gcs_uri_in = vertex_analysis_source(input_gcs_uri, analysis_stats)
+            print(f"Sending to HoopTuber AI: {analysis_gcs_uri_in}")
             # this returns the FINAL formatted JSON with stat_times
-            vertex_response = vertex_data_cleaned(input_gcs_uri, video_dur_sec)
+            windows, audio_windows = analysis_windows(job_id, input_gcs_uri, video_dur_sec, analysis_stats)
+            started = time.perf_counter()
+            publisher = ShotEventPublisher(job_id).start() if ANALYSIS_STREAMING else None
+            try:
+                vertex_response = vertex_data_cleaned(analysis_gcs_uri_in, video_dur_sec, on_events=publisher,
+                                                      stats=analysis_stats.setdefault("parse", {}),
+                                                      windows=windows)
+            finally:
+                if publisher:
+                    publisher.close()
+            analysis_stats["modelLatencySec"] = round(time.perf_counter() - started, 3)
+            shadow_recall(vertex_response, audio_windows, analysis_stats)
+            logging.info(f"Analysis stats: {analysis_stats}")
+            if isinstance(vertex_response, dict) and not vertex_response.get("ok", True):
+                raise RuntimeError(vertex_response.get("error") or vertex_response)
             print(f"DEBUG: Vertex response type: {type(vertex_response)}")
             print(f"DEBUG: Vertex response content: {vertex_response}")
         except Exception as e:
@@ -111,24 +498,22 @@ def handle_job_vertex(msg: pubsub_v1.subscriber.message.Message):
             update_job(job_id, {
                 "status": "vertex_error",
                 "error": str(e),
+                "analysisStats": analysis_stats,
                 "finishedAt": firestore.SERVER_TIMESTAMP
             })
             msg.ack()
             return
-        with tempfile.TemporaryDirectory() as td:
-            local_json_path = os.path.join(td, "analysis.json")
-            with open(local_json_path, "w") as f:
-                json.dump(vertex_response, f, indent=2)
-
-            analysis_gcs_uri = upload_to_gcs(local_json_path, OUT_BUCKET, json_key)
-            update_job(job_id, {
-                "status": "done",
-                "shotEvents": vertex_response,
-                "analysisGcsUri": analysis_gcs_uri,
-                "finishedAt": firestore.SERVER_TIMESTAMP,
-            })
-            logging.info(f"===JOB DONE: analysis saved, Vertex")
-            msg.ack()
+        analysis_gcs_uri = upload_json_to_gcs(vertex_response, OUT_BUCKET, json_key)
+        update_job(job_id, {
+            "status": "done",
+            "shotEvents": vertex_response,
+            "analysisGcsUri": analysis_gcs_uri,
+            "analysisStats": analysis_stats,
+            "finishedAt": firestore.SERVER_TIMESTAMP,
+        })
+        cache_store(cache_key, "vertex", job_id, {"shotEvents": vertex_response, "analysisGcsUri": analysis_gcs_uri})
+        logging.info(f"===JOB DONE: analysis saved, Vertex")
+        msg.ack()
     except Exception as e:
         print("(HANDLE_JOB_VERTEX FUNC) ERROR processing message:", e, flush=True)
         try:
@@ -158,16 +543,44 @@ def handle_render_job(msg: pubsub_v1.subscriber.message.Message):
         update_job(job_id, {"status": "rendering", "startedAt": firestore.SERVER_TIMESTAMP})
 
         with tempfile.TemporaryDirectory() as td:
-            in_path = os.path.join(td, "original.mp4")
             out_path = os.path.join(td, "final_highlight.mp4")
-
-            # 1. Download Original Source (Heavy I/O)
-            logging.info("Downloading original source file for FFmpeg...")
-            download_from_gcs(source_gcs_uri, in_path)
-
-            # 2. Render Final Video (Heavy CPU)
-            # This function uses the user_edits (start/end times) for cutting/concatenation
-            make_highlight(in_path, out_path, user_edits)
+            generation = source_generation(source_gcs_uri)
+            keyframes = load_keyframe_index(job_id, source_gcs_uri, generation)
+
+            # in download mode a miss falls through to cached_source(), which counts it
+            with SOURCE_CACHE.pin_cached(source_gcs_uri, generation,
+                                         count_miss=RENDER_SOURCE_MODE == "ranged") as cached_path:
+                if cached_path:
+                    # 1+2. Source already on local disk from an earlier job, no transfer needed
+                    logging.info("Rendering from cached source file...")
+                    make_highlight(cached_path, out_path, user_edits, keyframes)
+                    source_stats = {"sourceFetchMode": "cache", "sourceBytesTransferred": 0}
+                elif RENDER_SOURCE_MODE == "ranged":
+                    # 1+2. Stream only the index + byte ranges the cuts need, render from them
+                    logging.info("Reading source byte ranges for FFmpeg...")
+                    with RangedSource.from_gcs_uri(storage_client, source_gcs_uri) as source:
+                        make_highlight(source.url, out_path, user_edits, keyframes)
+                    source_stats = {
+                        "sourceFetchMode": "ranged",
+                        "sourceBytesTransferred": source.bytes_transferred,
+                        "sourceBytesTotal": source.size,
+                    }
+                else:
+                    # 1. Download Original Source (Heavy I/O), kept in the cache for re-renders
+                    logging.info("Downloading original source file for FFmpeg...")
+                    with cached_source(source_gcs_uri, generation) as in_path:
+                        source_stats = {
+                            "sourceFetchMode": "download",
+                            "sourceBytesTransferred": os.path.getsize(in_path),
+                            "sourceBytesTotal": os.path.getsize(in_path),
+                        }
+
+                        # 2. Render Final Video (Heavy CPU)
+                        # This function uses the user_edits (start/end times) for cutting/concatenation
+                        make_highlight(in_path, out_path, user_edits, keyframes)
+            save_keyframe_index(job_id, keyframes)
+            logging.info(f"Source cache stats: {SOURCE_CACHE.stats()}")
+            logging.info(f"Render source I/O: {source_stats}")
 
             # 3. Upload Result to the "posts" bucket
             final_key = f"{job_id}/final_render.mp4"
@@ -177,7 +590,8 @@ def handle_render_job(msg: pubsub_v1.subscriber.message.Message):
         update_job(job_id, {
             "status": "ready",
             "finalVideoUrl": final_uri,
-            "finishedAt": firestore.SERVER_TIMESTAMP
+            "finishedAt": firestore.SERVER_TIMESTAMP,
+            **source_stats,
         })
         print(f"Render Complete. Final URL: {final_uri}")
         msg.ack()
@@ -187,7 +601,24 @@ def handle_render_job(msg: pubsub_v1.subscriber.message.Message):
         msg.ack()
 
 
+def parse_model_output(raw_gemini_output, stats=None):
+    """Normalises process_video_and_summarize output (str / dict / list) into a list of shot events."""
+    if isinstance(raw_gemini_output, dict):
+        # Check if it's an error response
+        if not raw_gemini_output.get("ok", True):
+            error_msg = raw_gemini_output.get("error", "Unknown error from Gemini")
+            logging.error(f"Gemini processing failed: {error_msg}")
+            raise RuntimeError(f"Gemini processing failed: {error_msg}")
+        raise TypeError(f"Gemini output is a dict, not a list of shot events: {list(raw_gemini_output)}")
+    if not isinstance(raw_gemini_output, (str, list)):
+        raise TypeError(f"Gemini output is neither list nor string, it is: {type(raw_gemini_output)}")
+    try:
+        return parse_shot_events(raw_gemini_output, stats=stats)
+    except ShotParseError as e:
+        raise RuntimeError(f"Gemini returned invalid JSON: {e}")
+
 def handle_job(msg: pubsub_v1.subscriber.message.Message):
+    checkpoints = None
     try:
         
         payload = json.loads(msg.data.decode("utf-8"))
@@ -200,82 +631,135 @@ def handle_job(msg: pubsub_v1.subscriber.message.Message):
         update_job(job_id, {"status": "processing", "startedAt": firestore.SERVER_TIMESTAMP})
         print(f"=== handle_job() started for jobId={payload.get('jobId')} ===", flush=True)
 
+        cache_key, cache_hit = cache_lookup(job_id, input_gcs_uri, "old")
+        if cache_hit:
+            msg.ack()
+            return
 
-        with tempfile.TemporaryDirectory() as td:
-            in_path  = os.path.join(td, "input.mp4")
-            out_path = os.path.join(td, "highlight.mp4")
-            json_path = os.path.join(td, "output.json")
+        # Resume from the first incomplete stage: analysis -> ranges -> render
+        checkpoints = JobCheckpoints(firestore_client.collection(COLLECTION).document(job_id),
+                                     storage_client.bucket(OUT_BUCKET)).begin()
+        durations = {}
+        conversion = {}
+        analysis_stats = {}
 
-            download_from_gcs(input_gcs_uri, in_path)
-            # handling .mov files, will be better in the long run
-            converted_path = convert_to_mp4(in_path, td)
-            
-            raw_gemini_output = process_video_and_summarize(converted_path) # gemini output
-            
-            print(f"DEBUG: gemini is outputting: {type(raw_gemini_output)}, coming from worker/main.py", flush=True)
-            print(f"DEBUG: Gem output: {raw_gemini_output}")
+        with tempfile.TemporaryDirectory() as td, ExitStack() as stack:
+            out_path = os.path.join(td, "highlight.mp4")
 
-            # Handle dict error responses from process_video_and_summarize
-            
-            if isinstance(raw_gemini_output, str):
+            # Stage 1 runs by gs:// reference in the background while the source downloads
+            analysis_future = None
+            analysis_started = time.perf_counter()
+            if not checkpoints.done("analysis") and OLD_ANALYSIS_SOURCE == "gcs":
+                analysis_pool = stack.enter_context(ThreadPoolExecutor(max_workers=1))
+                analysis_future = analysis_pool.submit(analyse_by_reference, job_id, input_gcs_uri, analysis_stats)
+
+            if not checkpoints.done("render"):
+                started = time.perf_counter()
+                generation = source_generation(input_gcs_uri)
+                in_path = stack.enter_context(cached_source(input_gcs_uri, generation))
+                durations["download"] = round(time.perf_counter() - started, 3)
+                logging.info(f"Source cache stats: {SOURCE_CACHE.stats()}, frame cache stats: {FRAME_CACHE.stats()}")
+
+            # Stage 1: model analysis (the paid-for Gemini call)
+            def analyse():
+                if analysis_future is not None:
+                    wait_started = time.perf_counter()
+                    raw_gemini_output = analysis_future.result()
+                    durations["analysisWait"] = round(time.perf_counter() - wait_started, 3)
+                else:
+                    # legacy Files API path: upload the local copy, wait for processing, then generate.
+                    # Only this path needs an .mp4 copy; the render reads in_path directly.
+                    converted_path = convert_to_mp4(in_path, td, stats=conversion)
+                    durations["convert"] = conversion["conversionSec"]
+                    analysis_path = converted_path
+                    analysis_stats["analysisInput"] = "source"
+                    proxy_upload = None
+                    proxy_path = make_analysis_proxy(
+                        converted_path, td, ANALYSIS_PROXY_HEIGHT, ANALYSIS_PROXY_FPS, analysis_stats
+                    ) if ANALYSIS_PROXY else None
+                    if proxy_path is not None:
+                        analysis_path = proxy_path
+                        analysis_stats["analysisInput"] = "proxy"
+                        # store the proxy next to the raw upload while the model works on it
+                        uploader = stack.enter_context(ThreadPoolExecutor(max_workers=1))
+                        proxy_upload = uploader.submit(upload_to_gcs, analysis_path,
+                                                       *proxy_gcs_location(input_gcs_uri, generation))
+                    model_started = time.perf_counter()
+                    publisher = ShotEventPublisher(job_id).start() if ANALYSIS_STREAMING else None
+                    try:
+                        raw_gemini_output = process_video_and_summarize(analysis_path, on_events=publisher,
+                                                                        stats=analysis_stats) # gemini output
+                    finally:
+                        if publisher:
+                            publisher.close()
+                    analysis_stats["modelLatencySec"] = round(time.perf_counter() - model_started, 3)
+                    if proxy_upload is not None:
+                        try:
+                            proxy_upload.result()
+                        except Exception as e:
+                            # only the stored copy is lost; the model already read the local proxy
+                            logging.warning(f"Analysis proxy upload failed for {job_id}: {e}")
+                durations["analysis"] = round(time.perf_counter() - analysis_started, 3)
+                logging.info(f"Analysis stats: {analysis_stats}")
+
+                print(f"DEBUG: gemini is outputting: {type(raw_gemini_output)}, coming from worker/main.py", flush=True)
+                print(f"DEBUG: Gem output: {raw_gemini_output}")
+                return parse_model_output(raw_gemini_output)
+
+            parsed_data = checkpoints.run("analysis", analyse, started=analysis_started)
+
+            # Stage 2: merged ranges + frontend events
+            def merge_ranges():
+                started = time.perf_counter()
+                analysis_output = parsed_data # uploaded as-is if the merge below fails
+                start_end_times = []
                 try:
-                    # Remove code fences and whitespace
-                    #clean_text = strip_code_fences(raw_gemini_output).strip()
-                    clean_text = raw_gemini_output
-                    # If the response includes ```json``` fences, extract the content inside
-                    if "```json" in raw_gemini_output:
-                        json_start = raw_gemini_output.find('[')
-                        json_end = raw_gemini_output.rfind(']') + 1
-                        clean_text = raw_gemini_output[json_start:json_end]
-
-                    # Try parsing the clean JSON string
-                    parsed_data = json.loads(clean_text)
-                    logging.info("Parsed Gemini JSON string successfully")
-
-                except json.JSONDecodeError as e:
-                    raise RuntimeError(f"Gemini returned invalid JSON: {e}")
-
-            elif isinstance(raw_gemini_output, dict):
-                # Check if it's an error response
-                if not raw_gemini_output.get("ok", True):
-                    error_msg = raw_gemini_output.get("error", "Unknown error from Gemini")
-                    logging.error(f"Gemini processing failed: {error_msg}")
-                    raise RuntimeError(f"Gemini processing failed: {error_msg}")
-                parsed_data = raw_gemini_output
-                logging.info("Gemini is returning a dict object")
-                #else:
-            elif isinstance(raw_gemini_output, list):
-                parsed_data = raw_gemini_output
-                logging.info("DEBUG: GEMINI OUTPUT is already a list")
+                    logging.info("Starting timestamp merge for frontend")
+
+                    timestamps = timestamp_maker(parsed_data)
+                    start_end_times = refine_ranges(input_gcs_uri, timestamps,
+                                                    Creator.converting_tester(timestamps), analysis_stats)
+                    logging.info("Converted to tuple timstamps")
+                    logging.info(f"Timestamps: {start_end_times}\n")
+                    formatted_output = format_gemini_output(parsed_data, start_end_times)
+
+                    logging.info("CHECK! Combined Gemini + Timestamp ranges successfully")
+                    logging.info(f"FORMATTED OUTPUT: {formatted_output}")
+                    analysis_output = formatted_output
+                except Exception as e:
+                    logging.error(f"ERROR (make_highlight function):error merging timestamps: {e}")
+                    formatted_output = [] # fallback
+                durations["ranges"] = round(time.perf_counter() - started, 3)
+                return {
+                    "ranges": start_end_times,
+                    "shotEvents": formatted_output,
+                    "analysis": analysis_output,
+                }
+
+            checkpoint = checkpoints.run("ranges", merge_ranges)
+            formatted_output = checkpoint["shotEvents"]
+            analysis_output = checkpoint["analysis"]
+            start_end_times = checkpoint.get("ranges") or []
+
+            # Stage 3: rendered highlight video
+            if checkpoints.done("render"):
+                out_gcs_uri = checkpoints.stages["render"]["uri"]
+                video_duration_sec = checkpoints.stages["render"]["videoDurationSec"]
+                analysis_gcs_uri = upload_json_to_gcs(analysis_output, OUT_BUCKET, json_key)
             else:
-                raise TypeError(f"Gemini output is neither dict nor string, it is: {type(raw_gemini_output)}")
-            if isinstance(parsed_data, list) and len(parsed_data) == 1 and isinstance(parsed_data[0], list):
-                parsed_data = parsed_data[0]  # unwrap nested list
-            
-            with open(json_path, "w") as f:
-               json.dump(parsed_data, f,indent=2)
-            
-
-            make_highlight(in_path, out_path, parsed_data)
-            try:
-                logging.info("Starting timestamp merge for frontend")
-                
-                start_end_times = Creator.converting_tester(timestamp_maker(parsed_data))
-                logging.info("Converted to tuple timstamps")
-                logging.info(f"Timestamps: {start_end_times}\n")
-                formatted_output = format_gemini_output(parsed_data, start_end_times)
-
-                logging.info("CHECK! Combined Gemini + Timestamp ranges successfully")
-                logging.info(f"FORMATTED OUTPUT: {formatted_output}")
-                with open(json_path, "w") as f:
-                    json.dump(formatted_output, f, indent=2)
-            except Exception as e:
-                logging.error(f"ERROR (make_highlight function):error merging timestamps: {e}")
-                formatted_output = [] # fallback
-            out_gcs_uri = upload_to_gcs(out_path, OUT_BUCKET, out_key)
-            analysis_gcs_uri = upload_to_gcs(json_path, OUT_BUCKET, json_key)
-
-            video_duration_sec = get_video_length_seconds(out_path) # returns int secodns length of video
+                started = time.perf_counter()
+                # render the ranges from stage 2 (refined when SHOT_REFINE is on), not a fresh merge
+                clips = [{"start": start, "end": end} for start, end in start_end_times]
+                keyframes = load_keyframe_index(job_id, input_gcs_uri, source_generation(input_gcs_uri))
+                make_highlight(in_path, out_path, clips or parsed_data, keyframes)
+                save_keyframe_index(job_id, keyframes)
+                durations["render"] = round(time.perf_counter() - started, 3)
+                finalize_started = time.perf_counter()
+                out_gcs_uri, analysis_gcs_uri, video_duration_sec = finalize_outputs(
+                    out_path, out_key, analysis_output, json_key
+                )
+                durations["finalize"] = round(time.perf_counter() - finalize_started, 3)
+                checkpoints.save("render", started, uri=out_gcs_uri, videoDurationSec=video_duration_sec)
         update_job(job_id, {
             "status": "done",
             "shotEvents": formatted_output,
@@ -283,47 +767,103 @@ def handle_job(msg: pubsub_v1.subscriber.message.Message):
             "analysisGcsUri": analysis_gcs_uri,
             "finishedAt": firestore.SERVER_TIMESTAMP,
             "videoDurationSec": video_duration_sec,
+            "stageDurations": durations,
+            "analysisStats": analysis_stats,
+            **conversion,
+        })
+        cache_store(cache_key, "old", job_id, {
+            "shotEvents": formatted_output,
+            "analysisGcsUri": analysis_gcs_uri,
+            "outputGcsUri": out_gcs_uri,
+            "videoDurationSec": video_duration_sec,
         })
         msg.ack()
     except Exception as e:
-        # Mark failed; DO NOT ack so it can be retried (or set a dead-letter topic later)
+        print("(HANDLE_JOB FUNC) ERROR processing message:", e, flush=True)
+        # While attempts remain, hand the message back after RETRY_DELAY_SEC: the next
+        # delivery resumes at the first incomplete stage. The last attempt marks it failed.
+        retry = checkpoints is not None and checkpoints.should_retry()
         try:
             job_id = json.loads(msg.data.decode("utf-8")).get("jobId")
             if job_id:
                 update_job(job_id, {
-                    "status": "error",
+                    "status": "retrying" if retry else "error",
                     "error": str(e),
-                    "finishedAt": firestore.SERVER_TIMESTAMP,
+                    **({} if retry else {"finishedAt": firestore.SERVER_TIMESTAMP}),
                 })
             
         except Exception as inner:
             logging.error(f"Failed to update job status for: {inner}")
-        finally:
-            msg.ack() # ACKNOWLEDGE TO AVOID INF LOOP
-        print("(HANDLE_JOB FUNC) ERROR processing message:", e, flush=True)
+        if retry:
+            defer(msg, RETRY_DELAY_SEC)
+            return RETRY
+        msg.ack() # ACKNOWLEDGE TO AVOID INF LOOP
+
+def leased(mode, handler):
+    """
+    Wraps a job handler with a Firestore lease on the job doc: redeliveries of a message
+    that already finished are acked without work, and deliveries that arrive while a live
+    lease is held are handed back with a DEFER_SEC ack deadline, so they only run if the
+    holder dies and don't spin on immediate redelivery. A handler that returns RETRY has
+    deferred its message for another attempt, so the lease is released as "failed" and
+    that redelivery can claim it.
+    """
+    def run(msg: pubsub_v1.subscriber.message.Message):
+        try:
+            job_id = json.loads(msg.data.decode("utf-8"))["jobId"]
+        except Exception:
+            return handler(msg)  # handler reports malformed payloads itself
+        lease = JobLease(firestore_client, firestore_client.collection(COLLECTION).document(job_id),
+                         mode, msg.message_id)
+        try:
+            outcome = lease.claim()
+        except Exception as e:
+            logging.error(f"Could not claim lease for {job_id}: {e}")
+            msg.nack()
+            return
+        if outcome == DUPLICATE_DONE:
+            msg.ack()
+            return
+        if outcome == DUPLICATE_ACTIVE:
+            defer(msg, DEFER_SEC)
+            return
+        with lease:
+            if handler(msg) == RETRY:
+                lease.release_state = "failed"  # the deferred redelivery must be able to claim it
+    return run
+
+JOB_HANDLERS = {
+    "vertex": leased("vertex", handle_job_vertex),
+    "render": leased("render", handle_render_job),
+    "old": leased("old", handle_job),   # default when no mode is specified
+}
 
-def dispatch_job(msg):
-    payload = json.loads(msg.data.decode("utf-8"))
-    mode = payload.get("mode", "old")  # default to "old" if not specified
-    
-    if mode == "vertex":
-        return handle_job_vertex(msg)
-    elif mode == "render":
-        return handle_render_job(msg)
-    else:
-        return handle_job(msg)
 def main():
+    try:
+        ANALYSIS_CACHE.publish_versions()  # the upload endpoints only reuse entries of these versions
+    except Exception as e:
+        logging.warning(f"Failed to publish analysis cache versions: {e}")
+    scheduler = LaneScheduler(JOB_HANDLERS, default_mode="old")
+    flow_control = pubsub_v1.types.FlowControl(
+        max_messages=scheduler.max_outstanding,
+        max_bytes=int(os.environ.get("WORKER_MAX_OUTSTANDING_BYTES", str(10 * 1024 * 1024))),
+        max_lease_duration=int(os.environ.get("WORKER_MAX_LEASE_SEC", "7200")),
+    )
     subscriber = pubsub_v1.SubscriberClient()
     subscription_path = subscriber.subscription_path(PROJECT_ID, SUBSCRIPTION_ID)
-    streaming_pull_future = subscriber.subscribe(subscription_path, callback=dispatch_job)
+    streaming_pull_future = subscriber.subscribe(
+        subscription_path, callback=scheduler.dispatch, flow_control=flow_control
+    )
     print("TEST PRINT MF", flush=True)
     logging.info("LOGGING TEST PRINT")
-    print(f"Worker listening on {subscription_path}", flush=True)
+    print(f"Worker listening on {subscription_path} with lanes {scheduler.stats()}", flush=True)
     try:
         while True:
             time.sleep(60)
+            logging.info(f"Worker lanes: {scheduler.stats()}, leases: {lease_stats()}, model calls: {call_stats()}, gateways: {gateway_stats()}, parsing: {parse_stats()}")
     except KeyboardInterrupt:
         streaming_pull_future.cancel()
+        scheduler.shutdown()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,170 @@
+# worker/model_gateway.py - process-wide rate limiting, classified retries and deadlines for model calls
+
+import os
+import time
+import random
+import logging
+import threading
+
+import httpx
+
+MODEL_RPM             = float(os.environ.get("MODEL_RPM", "60"))            # requests per minute per backend
+MODEL_MAX_CONCURRENT  = int(os.environ.get("MODEL_MAX_CONCURRENT", "8"))    # in-flight calls per backend
+MODEL_MAX_RETRIES     = int(os.environ.get("MODEL_MAX_RETRIES", "4"))
+MODEL_BACKOFF_BASE    = float(os.environ.get("MODEL_BACKOFF_BASE_SEC", "2"))
+MODEL_BACKOFF_MAX     = float(os.environ.get("MODEL_BACKOFF_MAX_SEC", "60"))
+MODEL_CALL_DEADLINE   = float(os.environ.get("MODEL_CALL_DEADLINE_SEC", "900"))  # whole call, retries included
+
+RETRYABLE_CODES = {429: "quota", 500: "server", 502: "unavailable", 503: "unavailable", 504: "timeout"}
+
+
+class ModelCallDeadlineExceeded(TimeoutError):
+    """The call (including waits and retries) ran past its deadline."""
+
+
+def classify_error(exc):
+    """Retry reason for a failed model call ("quota", "unavailable", "server", "timeout"), or None."""
+    code = getattr(exc, "code", None)  # google.genai.errors.APIError carries the HTTP status here
+    if isinstance(code, int) and code in RETRYABLE_CODES:
+        return RETRYABLE_CODES[code]
+    if isinstance(exc, (TimeoutError, httpx.TimeoutException)):
+        return "timeout"
+    if isinstance(exc, httpx.TransportError):
+        return "unavailable"
+    text = str(exc)
+    if "RESOURCE_EXHAUSTED" in text:
+        return "quota"
+    if "UNAVAILABLE" in text:
+        return "unavailable"
+    if "DEADLINE_EXCEEDED" in text or "timed out" in text.lower():
+        return "timeout"
+    return None
+
+
+class TokenBucket:
+    """Refills rate_per_min tokens per minute up to capacity; acquire() blocks until one is free."""
+
+    def __init__(self, rate_per_min, capacity):
+        self.rate = rate_per_min / 60.0
+        self.capacity = max(1.0, float(capacity))
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, deadline):
+        """Takes one token, returns seconds spent waiting; raises once deadline (monotonic) passes."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            if now + wait > deadline:
+                raise ModelCallDeadlineExceeded("Deadline exceeded waiting for model quota")
+            time.sleep(wait)
+            waited += wait
+
+
+class ModelGateway:
+    """
+    Single entry point for calls to one model backend. Every call takes a token from a
+    shared requests/min bucket and one of max_concurrent slots, is retried on quota,
+    availability and timeout errors with full-jitter exponential backoff, and gets a
+    per-attempt timeout so the whole call stays inside its deadline.
+    """
+
+    def __init__(self, name, rpm=MODEL_RPM, max_concurrent=MODEL_MAX_CONCURRENT, max_retries=MODEL_MAX_RETRIES,
+                 backoff_base=MODEL_BACKOFF_BASE, backoff_max=MODEL_BACKOFF_MAX):
+        self.name = name
+        self.bucket = TokenBucket(rpm, capacity=max_concurrent)
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._lock = threading.Lock()
+        self.metrics = {
+            "calls": 0, "succeeded": 0, "failed": 0,
+            "throttled": 0, "throttleWaitSec": 0.0,
+            "retried": 0, "retriesByReason": {}, "deadlineExceeded": 0,
+        }
+
+    def _record(self, key, n=1):
+        with self._lock:
+            self.metrics[key] += n
+
+    def _acquire_slot(self, deadline):
+        started = time.monotonic()
+        if not self.slots.acquire(timeout=max(0.0, deadline - started)):
+            raise ModelCallDeadlineExceeded("Deadline exceeded waiting for a free model call slot")
+        return time.monotonic() - started
+
+    def call(self, fn, label=None, deadline_sec=MODEL_CALL_DEADLINE):
+        """
+        Runs fn(timeout_sec) under the gateway's limits and returns its result. timeout_sec is
+        what is left of the deadline and should be passed on as the request timeout.
+        """
+        label = label or self.name
+        deadline = time.monotonic() + deadline_sec
+        self._record("calls")
+        attempt = 0
+        while True:
+            try:
+                waited = self.bucket.acquire(deadline)
+                waited += self._acquire_slot(deadline)
+            except ModelCallDeadlineExceeded:
+                self._record("deadlineExceeded")
+                self._record("failed")
+                raise
+            if waited > 0.01:
+                self._record("throttled")
+                self._record("throttleWaitSec", waited)
+                logging.info(f"{label}: throttled for {waited:.1f}s")
+            try:
+                result = fn(deadline - time.monotonic())
+                self._record("succeeded")
+                return result
+            except Exception as e:
+                reason = classify_error(e)
+                if reason is None or attempt >= self.max_retries:
+                    self._record("failed")
+                    raise
+                # full jitter: sleep anywhere in [0, min(cap, base * 2^attempt)]
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                if time.monotonic() + delay >= deadline:
+                    self._record("deadlineExceeded")
+                    self._record("failed")
+                    raise ModelCallDeadlineExceeded(f"{label}: no time left to retry after {reason} error: {e}") from e
+                attempt += 1
+                with self._lock:
+                    self.metrics["retried"] += 1
+                    by_reason = self.metrics["retriesByReason"]
+                    by_reason[reason] = by_reason.get(reason, 0) + 1
+                logging.warning(f"{label}: {reason} error on attempt {attempt}, retrying in {delay:.1f}s: {e}")
+            finally:
+                self.slots.release()
+            time.sleep(delay)
+
+    def stats(self):
+        with self._lock:
+            return {**self.metrics, "retriesByReason": dict(self.metrics["retriesByReason"])}
+
+
+_gateways_lock = threading.Lock()
+_gateways = {}
+
+def get_gateway(name):
+    """Shared gateway per backend ("vertex", "gemini"), so all worker threads draw on one quota."""
+    with _gateways_lock:
+        gateway = _gateways.get(name)
+        if gateway is None:
+            gateway = _gateways[name] = ModelGateway(name)
+    return gateway
+
+def gateway_stats():
+    with _gateways_lock:
+        gateways = list(_gateways.values())
+    return {gateway.name: gateway.stats() for gateway in gateways}
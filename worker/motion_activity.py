@@ -0,0 +1,113 @@
+# worker/motion_activity.py - frame-difference motion profile from tiny grayscale frames -> idle spans
+
+import os
+import time
+import logging
+
+import numpy as np
+
+from frame_cache import frame_stream
+
+MOTION_WIDTH        = int(os.environ.get("MOTION_WIDTH", "64"))
+MOTION_HEIGHT       = int(os.environ.get("MOTION_HEIGHT", "36"))
+MOTION_FPS          = float(os.environ.get("MOTION_FPS", "4"))
+MOTION_THREADS      = os.environ.get("MOTION_THREADS", "1")
+MOTION_IDLE_ABS     = float(os.environ.get("MOTION_IDLE_ABS", "1.0"))     # mean |diff| (0-255) always counted as idle
+MOTION_IDLE_RATIO   = float(os.environ.get("MOTION_IDLE_RATIO", "0.3"))   # ... or below this fraction of the median
+MOTION_MIN_IDLE_SEC = int(os.environ.get("MOTION_MIN_IDLE_SEC", "20"))
+MOTION_IDLE_MARGIN  = int(os.environ.get("MOTION_IDLE_MARGIN_SEC", "3"))  # kept on both sides of an idle span
+
+
+def per_second_activity(batches, fps=MOTION_FPS):
+    """Mean absolute frame-to-frame difference per second of video (float32 array)."""
+    diffs = []
+    prev = None
+    for frames in batches:
+        frames = frames.astype(np.int16)
+        if prev is not None:
+            frames = np.concatenate((prev[None], frames))  # carry the last frame across batches
+        if len(frames) > 1:
+            diffs.append(np.abs(np.diff(frames, axis=0)).mean(axis=(1, 2)))
+        prev = frames[-1]
+    if not diffs:
+        return np.zeros(0, np.float32)
+    diff = np.concatenate(diffs).astype(np.float32)
+    frame_second = ((np.arange(len(diff)) + 1) / fps).astype(np.int64)  # diff i ends at frame i+1
+    n_seconds = int(frame_second[-1]) + 1
+    totals = np.bincount(frame_second, weights=diff, minlength=n_seconds)
+    counts = np.bincount(frame_second, minlength=n_seconds)
+    return (totals / np.maximum(counts, 1)).astype(np.float32)
+
+def idle_spans(activity, min_idle_sec=MOTION_MIN_IDLE_SEC, margin=MOTION_IDLE_MARGIN):
+    """(start, end) runs of low-motion seconds at least min_idle_sec long, shrunk by margin on both sides."""
+    if len(activity) == 0:
+        return []
+    threshold = max(MOTION_IDLE_ABS, float(np.median(activity)) * MOTION_IDLE_RATIO)
+    idle = np.concatenate(([False], activity < threshold, [False]))
+    edges = np.flatnonzero(np.diff(idle.astype(np.int8)))
+    spans = []
+    for start, end in zip(edges[::2], edges[1::2]):
+        if end - start >= min_idle_sec:
+            spans.append((int(start) + margin, int(end) - margin))
+    return [(s, e) for s, e in spans if e > s]
+
+def active_windows(spans, duration_sec):
+    """Complement of the idle spans over [0, duration_sec]."""
+    windows = []
+    cursor = 0
+    for start, end in spans:
+        if start > cursor:
+            windows.append((cursor, start))
+        cursor = max(cursor, end)
+    if cursor < duration_sec:
+        windows.append((cursor, int(np.ceil(duration_sec))))
+    return windows
+
+def intersect_windows(a, b):
+    """Overlap of two sorted lists of (start, end) windows."""
+    out, i, j = [], 0, 0
+    while i < len(a) and j < len(b):
+        start, end = max(a[i][0], b[j][0]), min(a[i][1], b[j][1])
+        if start < end:
+            out.append((start, end))
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return out
+
+
+def motion_profile(in_path=None, duration_sec=None, frames=None, started=None):
+    """
+    Per-second motion activity, idle spans and the remaining active windows, with decode
+    speed (realtimeFactor = video seconds processed per wall second). Reads frames (a
+    frame_cache.FrameArray) when given, otherwise streams its own decode of in_path.
+    started is the perf_counter() reading from before the caller fetched frames, so a
+    cache-miss decode counts towards elapsedSec.
+    """
+    if started is None:
+        started = time.perf_counter()
+    if frames is not None:
+        fps, frame_size = frames.fps, [frames.width, frames.height]
+        activity = per_second_activity(frames.batches(), fps)
+    else:
+        fps, frame_size = MOTION_FPS, [MOTION_WIDTH, MOTION_HEIGHT]
+        activity = per_second_activity(frame_stream(in_path, MOTION_WIDTH, MOTION_HEIGHT, MOTION_FPS, threads=MOTION_THREADS), fps)
+    elapsed = time.perf_counter() - started
+    duration_sec = duration_sec or len(activity)
+    spans = idle_spans(activity)
+    idle_sec = sum(end - start for start, end in spans)
+    profile = {
+        "activity": [round(float(a), 2) for a in activity],
+        "idleSpans": spans,
+        "activeWindows": active_windows(spans, duration_sec),
+        "idleSec": idle_sec,
+        "durationSec": round(float(duration_sec), 3),
+        "elapsedSec": round(elapsed, 3),
+        "realtimeFactor": round(len(activity) / elapsed, 1) if elapsed > 0 else None,
+        "frameSize": frame_size,
+        "fps": fps,
+    }
+    logging.info(f"Motion profile: {len(spans)} idle spans ({idle_sec}s of {duration_sec:.0f}s) in "
+                 f"{elapsed:.2f}s, {profile['realtimeFactor']}x realtime")
+    return profile
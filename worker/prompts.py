@@ -204,6 +204,8 @@ def prompt_shot_outcomes_only():
 # shotType
 # timestamp (have)
 # make / miss (have)
+# Paired with shot_schema.ShotEvent as the response schema (ANALYSIS_STRUCTURED_OUTPUT=1):
+# keep the field names, integer seconds and outcome values in sync with it.
 def prompt_shot_outcomes_only2(video_duration_sec):
     video_duration_min = video_duration_sec / 60
 
@@ -238,4 +240,13 @@ def prompt_shot_outcomes_only2(video_duration_sec):
         {desired_output}
     Analyze the video now and return the JSON array:
     """
-    return prompt
\ No newline at end of file
+    return prompt
+def prompt_shot_outcomes_segment(segment_start_sec, segment_end_sec):
+    # same task as prompt_shot_outcomes_only2, for one time window of a longer video
+    segment_note = f"""
+    SEGMENT INSTRUCTIONS:
+    - You are only seeing the part of a longer video from {segment_start_sec} to {segment_end_sec} seconds.
+    - Report every "TimeStamp" in seconds from the START OF THE FULL VIDEO, i.e. between {segment_start_sec} and {segment_end_sec}.
+    - Do NOT count from the start of the segment: a shot {segment_start_sec} seconds into the full video is "TimeStamp" {segment_start_sec}, not 0.
+    """
+    return segment_note + prompt_shot_outcomes_only2(0)
@@ -0,0 +1,152 @@
+# worker/range_source.py - serves a video object to ffmpeg over local HTTP using ranged reads,
+# so render jobs only pull the container index plus the byte ranges the cuts actually touch
+
+import os
+import logging
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+READ_CHUNK_BYTES = int(float(os.environ.get("RANGED_READ_CHUNK_MB", "2")) * 1024 * 1024)
+
+
+class RangedSource:
+    """
+    Local HTTP endpoint backed by a read_range(start, end) callable (end inclusive).
+
+    ffmpeg opens the URL, reads the index and seeks with Range requests; each request is
+    answered by reading the object in READ_CHUNK_BYTES pieces until ffmpeg hangs up, so at
+    most one chunk is over-read per seek. bytes_transferred counts bytes pulled from the
+    backing store.
+
+    Usage:
+        with RangedSource.from_gcs_uri(storage_client, "gs://bucket/key.mp4") as source:
+            subprocess.run(["ffprobe", source.url])
+            print(source.bytes_transferred)
+    """
+
+    def __init__(self, size, read_range, name="source.mp4", chunk_size=READ_CHUNK_BYTES):
+        self.size = size
+        self.name = name
+        self.chunk_size = chunk_size
+        self._read_range = read_range
+        self._lock = threading.Lock()
+        self.bytes_transferred = 0
+        self.requests = 0
+        self._server = None
+        self._thread = None
+
+    @classmethod
+    def from_gcs_uri(cls, storage_client, gcs_uri, **kwargs):
+        """Ranged reads of a GCS object, pinned to the generation seen when opened.
+        Works against a local GCS stand-in through STORAGE_EMULATOR_HOST."""
+        assert gcs_uri.startswith("gs://")
+        bucket_name, _, blob_name = gcs_uri[len("gs://"):].partition("/")
+        bucket = storage_client.bucket(bucket_name)
+        blob = bucket.get_blob(blob_name)
+        if blob is None:
+            raise FileNotFoundError(f"Source not found: {gcs_uri}")
+        pinned = bucket.blob(blob_name, generation=blob.generation)
+
+        def read_range(start, end):
+            return pinned.download_as_bytes(start=start, end=end, checksum=None)
+
+        return cls(blob.size, read_range, name=os.path.basename(blob_name) or "source.mp4", **kwargs)
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        """Ranged reads of a local file (handy for exercising the ffmpeg side locally)."""
+        def read_range(start, end):
+            with open(path, "rb") as f:
+                f.seek(start)
+                return f.read(end - start + 1)
+
+        return cls(os.path.getsize(path), read_range, name=os.path.basename(path), **kwargs)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/{self.name}"
+
+    def read(self, start, end):
+        data = self._read_range(start, end)
+        with self._lock:
+            self.bytes_transferred += len(data)
+        return data
+
+    def __enter__(self):
+        source = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass  # ffmpeg issues a request per seek; keep worker logs readable
+
+            def _range(self):
+                """(start, end) of the first requested range, None without one; ValueError if malformed."""
+                header = self.headers.get("Range")
+                if not header or not header.startswith("bytes="):
+                    return None
+                first, dash, last = header[len("bytes="):].split(",")[0].strip().partition("-")
+                if not dash or (first == "" and last == ""):
+                    raise ValueError(f"Malformed Range header: {header!r}")
+                if first == "":
+                    start = max(0, source.size - int(last))
+                    end = source.size - 1
+                else:
+                    start = int(first)
+                    end = min(int(last), source.size - 1) if last else source.size - 1
+                if end < start and start < source.size:
+                    raise ValueError(f"Malformed Range header: {header!r}")
+                return start, end
+
+            def _send_headers(self):
+                try:
+                    byte_range = self._range()
+                    unsatisfiable = byte_range is not None and byte_range[0] >= source.size
+                except ValueError:
+                    unsatisfiable = True
+                if unsatisfiable:
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{source.size}")
+                    self.end_headers()
+                    return None
+                start, end = byte_range or (0, source.size - 1)
+                self.send_response(206 if byte_range else 200)
+                self.send_header("Accept-Ranges", "bytes")
+                self.send_header("Content-Type", "video/mp4")
+                self.send_header("Content-Length", str(end - start + 1))
+                if byte_range:
+                    self.send_header("Content-Range", f"bytes {start}-{end}/{source.size}")
+                self.end_headers()
+                return start, end
+
+            def do_HEAD(self):
+                self._send_headers()
+
+            def do_GET(self):
+                with source._lock:
+                    source.requests += 1
+                byte_range = self._send_headers()
+                if byte_range is None:
+                    return
+                pos, end = byte_range
+                try:
+                    while pos <= end:
+                        chunk_end = min(end, pos + source.chunk_size - 1)
+                        self.wfile.write(source.read(pos, chunk_end))
+                        pos = chunk_end + 1
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # ffmpeg seeked elsewhere or finished reading
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        logging.info(f"Ranged source serving {self.name} ({self.size} bytes) at {self.url}")
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._server.shutdown()
+        self._server.server_close()
+        logging.info(f"Ranged source read {self.bytes_transferred}/{self.size} bytes "
+                     f"in {self.requests} requests")
+        return False
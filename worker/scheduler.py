@@ -0,0 +1,149 @@
+# worker/scheduler.py - per-mode concurrency lanes for Pub/Sub jobs ("vertex", "render", "old")
+
+import os
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Rough peak memory per job, used to size the CPU-heavy lanes
+LANE_MEM_GB = {"render": 2.0, "old": 3.0, "vertex": 0.25}
+LANE_DEFER_SEC = int(os.environ.get("WORKER_LANE_DEFER_SEC", "30"))  # redelivery delay for a message its lane can't take
+
+
+def _memory_gb():
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024**3
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def default_lane_slots():
+    """
+    Slots per lane from cores and memory; WORKER_SLOTS_<MODE> overrides any of them.
+    ffmpeg-heavy lanes get about half the cores each (bounded by memory), while the
+    I/O-bound vertex lane mostly waits on the model and can run more calls at once.
+    """
+    cores = os.cpu_count() or 1
+    mem_gb = _memory_gb()
+
+    def bounded(mode, by_cpu):
+        if mem_gb is not None:
+            by_cpu = min(by_cpu, int(mem_gb // LANE_MEM_GB[mode]))
+        return max(1, by_cpu)
+
+    slots = {
+        "vertex": bounded("vertex", min(16, cores * 2)),
+        "render": bounded("render", cores // 2),
+        "old":    bounded("old", cores // 2),
+    }
+    for mode in slots:
+        override = os.environ.get(f"WORKER_SLOTS_{mode.upper()}")
+        if override:
+            slots[mode] = max(1, int(override))
+    return slots
+
+
+def defer(msg, delay_sec):
+    """
+    Hands a message back for redelivery after about delay_sec (at most 600, the Pub/Sub
+    limit). Unlike nack(), which is redelivered at once, this can't spin: the ack deadline
+    is set, then the message leaves lease management and its flow-control slot.
+    """
+    msg.modify_ack_deadline(min(600, max(0, int(delay_sec))))
+    msg.drop()
+
+
+class Lane:
+    """Fixed-size executor for one job mode plus a bounded wait queue."""
+
+    def __init__(self, name, slots, max_queue=None):
+        self.name = name
+        self.slots = slots
+        self.max_queue = slots if max_queue is None else max_queue
+        self._executor = ThreadPoolExecutor(max_workers=slots, thread_name_prefix=f"lane-{name}")
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def submit(self, handler, msg):
+        """Queues handler(msg); returns False (message untouched) if the lane queue is full."""
+        with self._lock:
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                return False
+            self.queued += 1
+        self._executor.submit(self._run, handler, msg)
+        return True
+
+    def _run(self, handler, msg):
+        with self._lock:
+            self.queued -= 1
+            self.in_flight += 1
+        try:
+            handler(msg)
+        except Exception as e:
+            logging.exception(f"Lane {self.name}: unhandled job error: {e}")
+            with self._lock:
+                self.failed += 1
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self.completed += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "slots": self.slots,
+                "queued": self.queued,
+                "inFlight": self.in_flight,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class LaneScheduler:
+    """
+    Routes Pub/Sub messages to a lane by payload "mode" so CPU-heavy render/old jobs
+    can't crowd out (or be crowded out by) long I/O-bound vertex jobs. Messages that
+    arrive while their lane queue is full are deferred (see defer) and redelivered after
+    LANE_DEFER_SEC. This frees their flow-control slot, so a backlog in one mode can't
+    hold the subscriber's whole max_outstanding budget in a nack/redeliver loop.
+    """
+
+    def __init__(self, handlers, slots=None, default_mode="old"):
+        slots = slots or default_lane_slots()
+        self.handlers = handlers
+        self.default_mode = default_mode
+        self.lanes = {mode: Lane(mode, slots[mode]) for mode in handlers}
+
+    @property
+    def max_outstanding(self):
+        """Running plus queued messages across all lanes (subscriber FlowControl max_messages)."""
+        return sum(lane.slots + lane.max_queue for lane in self.lanes.values())
+
+    def dispatch(self, msg):
+        try:
+            mode = json.loads(msg.data.decode("utf-8")).get("mode", self.default_mode)
+        except Exception as e:
+            logging.error(f"Dropping unparseable message {getattr(msg, 'message_id', '?')}: {e}")
+            msg.ack()
+            return
+        if mode not in self.lanes:
+            mode = self.default_mode
+        if not self.lanes[mode].submit(self.handlers[mode], msg):
+            logging.warning(f"Lane {mode} is full, deferring message for {LANE_DEFER_SEC}s")
+            defer(msg, LANE_DEFER_SEC)
+
+    def stats(self):
+        return {mode: lane.stats() for mode, lane in self.lanes.items()}
+
+    def shutdown(self):
+        for lane in self.lanes.values():
+            lane.shutdown()
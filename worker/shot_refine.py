@@ -0,0 +1,109 @@
+# worker/shot_refine.py - tightens clip boundaries around model timestamps using low-res frame motion
+
+import os
+import time
+import logging
+
+import numpy as np
+
+from intervals import merge_intervals, to_ranges
+
+REFINE_SEARCH_SEC   = float(os.environ.get("SHOT_REFINE_SEARCH_SEC", "2"))     # look this far either side of the model timestamp
+REFINE_SMOOTH_SEC   = float(os.environ.get("SHOT_REFINE_SMOOTH_SEC", "0.5"))
+REFINE_MIN_PEAK     = float(os.environ.get("SHOT_REFINE_MIN_PEAK", "2.0"))     # mean |diff| (0-255) below which we keep the fixed window
+REFINE_CALM_RATIO   = float(os.environ.get("SHOT_REFINE_CALM_RATIO", "0.35"))  # motion below this fraction of the peak = play settled
+REFINE_LEAD_MIN     = float(os.environ.get("SHOT_REFINE_LEAD_MIN_SEC", "1.0"))
+REFINE_LEAD_MAX     = float(os.environ.get("SHOT_REFINE_LEAD_MAX_SEC", "2.5"))
+REFINE_TAIL_MIN     = float(os.environ.get("SHOT_REFINE_TAIL_MIN_SEC", "1.5"))
+REFINE_TAIL_MAX     = float(os.environ.get("SHOT_REFINE_TAIL_MAX_SEC", "3.5"))
+
+
+def motion_curve(frames, start_sec, end_sec):
+    """
+    (first frame index, smoothed mean absolute frame difference per frame) over
+    [start_sec, end_sec) of a FrameArray. Only that slice of the memmap is read.
+    """
+    first, window = frames.window(start_sec, end_sec)
+    curve = np.zeros(len(window), np.float32)
+    if len(window) > 1:
+        curve[1:] = np.abs(np.diff(window.astype(np.int16), axis=0)).mean(axis=(1, 2))
+    width = max(1, int(round(REFINE_SMOOTH_SEC * frames.fps)))
+    if len(curve) >= width:
+        curve = np.convolve(curve, np.ones(width, np.float32) / width, mode="same").astype(np.float32)
+    return first, curve
+
+def refine_range(frames, timestamp, clip_duration, start_before):
+    """
+    (start, end, refined) for one model timestamp. Finds the motion peak within
+    REFINE_SEARCH_SEC of the timestamp (the release / rim contact), then extends back to
+    where motion built up and forward to where it settled, within the lead/tail bounds.
+    Falls back to the fixed (timestamp - start_before, + clip_duration) window when the
+    search window has no clear motion.
+    """
+    fixed_start = max(0.0, timestamp - start_before)
+    fallback = (fixed_start, fixed_start + clip_duration, False)
+    fps = frames.fps
+    # timestamps are whole seconds, so the event is somewhere in [timestamp, timestamp + 1)
+    search_lo, search_hi = timestamp - REFINE_SEARCH_SEC, timestamp + 1 + REFINE_SEARCH_SEC
+    first, curve = motion_curve(frames, max(0.0, search_lo - REFINE_LEAD_MAX), search_hi + REFINE_TAIL_MAX)
+    lo = max(0, int(search_lo * fps) - first)
+    hi = min(len(curve), int(np.ceil(search_hi * fps)) - first)
+    if hi - lo < 2:
+        return fallback
+    peak = lo + int(np.argmax(curve[lo:hi]))
+    peak_level = float(curve[peak])
+    if peak_level < REFINE_MIN_PEAK:
+        return fallback
+    calm = peak_level * REFINE_CALM_RATIO
+
+    # walk back to the last calm frame before the peak, bounded by the lead limits
+    lead_lo = max(0, peak - int(REFINE_LEAD_MAX * fps))
+    before = np.flatnonzero(curve[lead_lo:peak] < calm)
+    start_idx = lead_lo + int(before[-1]) if len(before) else lead_lo
+    start_idx = max(0, min(start_idx, peak - int(REFINE_LEAD_MIN * fps)))
+
+    # walk forward to the first calm frame after the peak, bounded by the tail limits
+    tail_hi = min(len(curve), peak + int(REFINE_TAIL_MAX * fps) + 1)
+    after = np.flatnonzero(curve[peak:tail_hi] < calm)
+    end_idx = peak + int(after[0]) if len(after) else tail_hi
+    end_idx = max(end_idx, peak + int(REFINE_TAIL_MIN * fps))
+
+    return (first + start_idx) / fps, min(frames.duration, (first + end_idx) / fps), True
+
+def merge_ranges(ranges, merge_gap=0.0):
+    """Sorts and merges overlapping (start, end) ranges, like converting_tester does."""
+    if not ranges:
+        return []
+    starts, ends, _ = merge_intervals([s for s, _ in ranges], [e for _, e in ranges], merge_gap)
+    return to_ranges(starts.round(3), ends.round(3))
+
+def refine_timestamps(timestamps, frames, clip_duration=5, start_before=1, merge_gap=0):
+    """
+    Merged (start, end) ranges for the model's timestamps (seconds), snapped to the motion
+    around each one in frames (a frame_cache.FrameArray), plus stats comparing the total
+    rendered duration with the fixed-window ranges converting_tester would produce.
+    """
+    started = time.perf_counter()
+    refined_count = 0
+    ranges = []
+    for timestamp in timestamps:
+        start, end, refined = refine_range(frames, float(timestamp), clip_duration, start_before)
+        refined_count += refined
+        ranges.append((start, end))
+    merged = merge_ranges(ranges, merge_gap)
+    fixed = merge_ranges([(max(0, t - start_before), max(0, t - start_before) + clip_duration) for t in timestamps], merge_gap)
+    before_sec = sum(end - start for start, end in fixed)
+    after_sec = sum(end - start for start, end in merged)
+    stats = {
+        "events": len(timestamps),
+        "refined": refined_count,
+        "fallback": len(timestamps) - refined_count,
+        "clipsBefore": len(fixed),
+        "clipsAfter": len(merged),
+        "durationBeforeSec": round(before_sec, 3),
+        "durationAfterSec": round(after_sec, 3),
+        "elapsedSec": round(time.perf_counter() - started, 3),
+    }
+    logging.info(f"Shot refine: {refined_count}/{len(timestamps)} timestamps snapped to motion, "
+                 f"rendered duration {before_sec:.1f}s -> {after_sec:.1f}s")
+    return merged, stats
@@ -0,0 +1,104 @@
+# worker/shot_schema.py - typed shot events + structured (JSON schema) output config for the analysis prompts
+
+import os
+import re
+import logging
+import threading
+from typing import Literal
+
+from pydantic import BaseModel, TypeAdapter, ValidationError, field_validator
+from google.genai import types
+
+STRUCTURED_OUTPUT = os.environ.get("ANALYSIS_STRUCTURED_OUTPUT", "1") == "1"
+PARSE_RETRIES     = int(os.environ.get("ANALYSIS_PARSE_RETRIES", "1"))  # extra model calls after unparseable output
+
+OUTCOMES = {"make": "Make", "made": "Make", "miss": "Miss", "missed": "Miss", "undetermined": "Undetermined"}
+
+
+class ShotEvent(BaseModel):
+    """One shot attempt as returned by the shot-outcome prompts."""
+    TimeStamp: int                                   # seconds from the start of the video
+    Outcome: Literal["Make", "Miss", "Undetermined"]
+
+    @field_validator("TimeStamp", mode="before")
+    @classmethod
+    def _seconds(cls, value):
+        # older prompts answer "HH:MM:SS" / "MM:SS" / "105"
+        if isinstance(value, str) and ":" in value:
+            total = 0
+            for part in value.strip().split(":"):
+                total = total * 60 + int(float(part))
+            return total
+        if isinstance(value, (str, float)):
+            return int(float(value))
+        return value
+
+    @field_validator("Outcome", mode="before")
+    @classmethod
+    def _outcome(cls, value):
+        if isinstance(value, str):
+            return OUTCOMES.get(value.strip().lower(), value)
+        return value
+
+
+class ShotParseError(ValueError):
+    """Model output that could not be read as a JSON array of shot events."""
+
+
+_ARRAY = TypeAdapter(list)
+_FENCE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$", re.IGNORECASE)
+
+_stats_lock = threading.Lock()
+PARSE_STATS = {"parsed": 0, "failures": 0, "retries": 0, "invalidEvents": 0}
+
+def _count(key, n=1, stats=None):
+    with _stats_lock:
+        PARSE_STATS[key] += n
+        if stats is not None:
+            stats[key] = stats.get(key, 0) + n
+
+def count_retry(stats=None):
+    """Records one model re-run caused by unparseable output (process-wide and in stats)."""
+    _count("retries", stats=stats)
+
+def parse_stats():
+    with _stats_lock:
+        return dict(PARSE_STATS)
+
+
+def structured_output_config():
+    """GenerateContentConfig that makes the model answer with a JSON array of ShotEvent."""
+    if not STRUCTURED_OUTPUT:
+        return None
+    return types.GenerateContentConfig(
+        response_mime_type="application/json",
+        response_schema=list[ShotEvent],
+    )
+
+def parse_shot_events(raw, stats=None):
+    """
+    Validates model output (JSON text or an already-decoded list) into a list of ShotEvent
+    dicts. Individual events that fail validation are dropped and counted; output that is
+    not a JSON array at all raises ShotParseError.
+    """
+    try:
+        if isinstance(raw, (str, bytes)):
+            text = _FENCE.sub("", raw.decode("utf-8") if isinstance(raw, bytes) else raw)
+            items = _ARRAY.validate_json(text)
+        else:
+            items = _ARRAY.validate_python(raw)
+    except ValidationError as e:
+        _count("failures", stats=stats)
+        raise ShotParseError(f"Model output is not a JSON array of shot events: {e.errors()[0]['msg']}") from e
+
+    if len(items) == 1 and isinstance(items[0], list):
+        items = items[0]  # unwrap [[...]]
+    events = []
+    for item in items:
+        try:
+            events.append(ShotEvent.model_validate(item).model_dump())
+        except ValidationError as e:
+            _count("invalidEvents", stats=stats)
+            logging.warning(f"Dropping invalid shot event {str(item)[:200]}: {e.errors()[0]['msg']}")
+    _count("parsed", stats=stats)
+    return events
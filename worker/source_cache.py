@@ -0,0 +1,170 @@
+# worker/source_cache.py - size-bounded on-disk LRU cache for source videos pulled from GCS
+
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from uuid import uuid4
+
+
+class _Entry:
+    def __init__(self, path, size, pins=0):
+        self.path = path
+        self.size = size
+        self.pins = pins
+
+
+class SourceCache:
+    """
+    Keeps downloaded sources on local disk, keyed by gs:// URI plus object generation,
+    so a re-upload under the same name never serves stale bytes.
+
+    Entries are pinned (reference-counted) while a job uses them and only unpinned
+    entries are evicted, least recently used first, once the cache exceeds max_bytes.
+    Concurrent jobs asking for the same source share a single download.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> _Entry, least recently used first
+        self._loading = {}             # key -> threading.Event for in-flight downloads
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(root, exist_ok=True)
+        self._adopt_existing()
+
+    @staticmethod
+    def cache_key(gcs_uri, generation):
+        return hashlib.sha256(f"{gcs_uri}#{generation}".encode("utf-8")).hexdigest()[:32]
+
+    def _path_for(self, key, gcs_uri):
+        ext = os.path.splitext(gcs_uri)[1].lower() or ".mp4"
+        return os.path.join(self.root, f"{key}{ext}")
+
+    def _adopt_existing(self):
+        """Re-index files left by a previous worker process (oldest access first)."""
+        found = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if ".part-" in name:
+                os.remove(path)  # interrupted download
+                continue
+            stat = os.stat(path)
+            found.append((stat.st_atime, os.path.splitext(name)[0], path, stat.st_size))
+        for _, key, path, size in sorted(found):
+            self._entries[key] = _Entry(path, size)
+        with self._lock:
+            self._evict_locked()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": sum(e.size for e in self._entries.values()),
+                "maxBytes": self.max_bytes,
+            }
+
+    @contextmanager
+    def pin(self, gcs_uri, generation, fetch):
+        """
+        Yields a local path for (gcs_uri, generation), calling fetch(dest_path) on a miss.
+        The file stays pinned (never evicted) until the with-block exits.
+        """
+        key = self.cache_key(gcs_uri, generation)
+        path = self._acquire(key, gcs_uri, fetch)
+        try:
+            yield path
+        finally:
+            self._release(key)
+
+    @contextmanager
+    def pin_cached(self, gcs_uri, generation, count_miss=True):
+        """
+        Like pin() but never downloads: yields the cached path, or None if not cached.
+        Callers that fall through to pin() on None pass count_miss=False, so a cold source
+        is counted as one miss (by pin) rather than two.
+        """
+        key = self.cache_key(gcs_uri, generation)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.pins += 1
+                self.hits += 1
+                self._entries.move_to_end(key)
+            elif count_miss:
+                self.misses += 1
+        if entry is None:
+            yield None
+            return
+        try:
+            yield entry.path
+        finally:
+            self._release(key)
+
+    def _acquire(self, key, gcs_uri, fetch):
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry.pins += 1
+                    self.hits += 1
+                    self._entries.move_to_end(key)
+                    logging.info(f"Source cache hit for {gcs_uri}")
+                    return entry.path
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = threading.Event()
+                    self.misses += 1
+                    break
+            loading.wait()  # another job is downloading this source; reuse its result
+
+        path = self._path_for(key, gcs_uri)
+        tmp_path = f"{path}.part-{uuid4().hex[:8]}"
+        try:
+            logging.info(f"Source cache miss for {gcs_uri}, downloading...")
+            fetch(tmp_path)
+            os.replace(tmp_path, path)
+            with self._lock:
+                self._entries[key] = _Entry(path, os.path.getsize(path), pins=1)
+                self._evict_locked()
+            return path
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+            loading.set()
+
+    def _release(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.pins = max(0, entry.pins - 1)
+            self._evict_locked()
+
+    def _evict_locked(self):
+        total = sum(e.size for e in self._entries.values())
+        for key in list(self._entries):
+            if total <= self.max_bytes:
+                break
+            entry = self._entries[key]
+            if entry.pins:
+                continue
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+            del self._entries[key]
+            total -= entry.size
+            self.evictions += 1
+            logging.info(f"Source cache evicted {entry.path} ({entry.size} bytes)")
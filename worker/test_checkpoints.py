@@ -0,0 +1,118 @@
+# worker/test_checkpoints.py - a redelivered job resumes at its first incomplete stage
+# run from worker/: python -m pytest test_checkpoints.py
+
+import sys
+import types
+
+import pytest
+
+try:
+    from google.cloud import firestore
+except ImportError:  # the checks below only need firestore.Increment
+    class _Increment:
+        def __init__(self, value):
+            self.value = value
+    firestore = types.SimpleNamespace(Increment=_Increment)
+    google = sys.modules.setdefault("google", types.ModuleType("google"))
+    cloud = sys.modules.setdefault("google.cloud", types.ModuleType("google.cloud"))
+    google.cloud = cloud
+    cloud.firestore = sys.modules["google.cloud.firestore"] = firestore
+
+import checkpoints
+from checkpoints import JobCheckpoints
+
+
+def merge_fields(target, fields):
+    for key, value in fields.items():
+        if isinstance(value, dict):
+            merge_fields(target.setdefault(key, {}), value)
+        elif isinstance(value, type(firestore.Increment(1))):
+            target[key] = target.get(key, 0) + value.value
+        else:
+            target[key] = value
+
+
+class FakeDoc:
+    """Job document: set(merge=True) and get() as far as JobCheckpoints uses them."""
+
+    def __init__(self, doc_id):
+        self.id = doc_id
+        self.data = {}
+
+    def set(self, fields, merge=False):
+        merge_fields(self.data, fields)
+
+    def get(self):
+        return types.SimpleNamespace(exists=bool(self.data), to_dict=lambda: dict(self.data))
+
+
+class FakeBlob:
+    def __init__(self, objects, name):
+        self.objects = objects
+        self.name = name
+
+    def upload_from_string(self, data, content_type=None, timeout=None):
+        self.objects[self.name] = data
+
+    def download_as_text(self):
+        return self.objects[self.name]
+
+
+class FakeBucket:
+    name = "out"
+
+    def __init__(self):
+        self.objects = {}
+
+    def blob(self, name):
+        return FakeBlob(self.objects, name)
+
+
+def deliver(doc, bucket, calls, fail_ranges):
+    """One delivery of an old-pipeline job, staged the way handle_job runs it."""
+    job = JobCheckpoints(doc, bucket).begin()
+
+    def analyse():
+        calls.append("analysis")
+        return [{"TimeStamp": 12, "Outcome": "Make"}]
+
+    def merge_ranges():
+        calls.append("ranges")
+        if fail_ranges:
+            raise RuntimeError("merge failed")
+        return {"ranges": [[11, 16]], "shotEvents": [], "analysis": []}
+
+    try:
+        parsed = job.run("analysis", analyse)
+        job.run("ranges", merge_ranges)
+    except RuntimeError:
+        return job, None
+    return job, parsed
+
+
+def test_second_delivery_skips_completed_analysis(monkeypatch):
+    monkeypatch.setattr(checkpoints, "MAX_ATTEMPTS", 3)
+    doc, bucket, calls = FakeDoc("job-1"), FakeBucket(), []
+
+    first, parsed = deliver(doc, bucket, calls, fail_ranges=True)
+    assert parsed is None
+    assert calls == ["analysis", "ranges"]
+    assert first.attempts == 1 and first.should_retry()
+    assert doc.data["stages"]["analysis"]["done"]
+    assert "ranges" not in doc.data["stages"]
+
+    second, parsed = deliver(doc, bucket, calls, fail_ranges=False)
+    assert calls == ["analysis", "ranges", "ranges"]  # the model stage was not run again
+    assert parsed == [{"TimeStamp": 12, "Outcome": "Make"}]
+    assert second.attempts == 2
+    assert second.completed() == ["analysis", "ranges"]
+    assert bucket.objects.keys() == {"job-1/checkpoints/analysis.json", "job-1/checkpoints/ranges.json"}
+
+
+def test_retries_stop_at_max_attempts(monkeypatch):
+    monkeypatch.setattr(checkpoints, "MAX_ATTEMPTS", 2)
+    doc, bucket, calls = FakeDoc("job-2"), FakeBucket(), []
+    assert deliver(doc, bucket, calls, fail_ranges=True)[0].should_retry()
+    assert not deliver(doc, bucket, calls, fail_ranges=True)[0].should_retry()
+    assert doc.data["attempts"] == 2
+    assert calls == ["analysis", "ranges", "ranges"]
@@ -0,0 +1,37 @@
+# worker/test_intervals.py - range outcomes when several model events merge into one clip range
+# run from worker/: python -m pytest test_intervals.py
+
+import pytest
+
+from intervals import merge_timestamps, events_by_range
+
+# a Miss then a Make two seconds apart (their clip windows overlap and merge), then a lone Make
+EVENTS = [
+    {"TimeStamp": "00:00:10", "Outcome": "Miss"},
+    {"TimeStamp": "00:00:12", "Outcome": "Make"},
+    {"TimeStamp": "00:01:00", "Outcome": "Make"},
+]
+
+
+@pytest.fixture
+def ranges():
+    return merge_timestamps([10, 12, 60], clip_duration=5, start_before=1)
+
+
+def test_miss_and_make_merge_into_one_range(ranges):
+    assert ranges == [(9, 16), (59, 64)]
+
+
+def test_events_by_range(ranges):
+    merged, after = events_by_range(EVENTS, ranges)
+    assert merged == ("Make", {"Make": 1, "Miss": 1})
+    assert after == ("Make", {"Make": 1})
+
+
+def test_format_gemini_output(ranges):
+    utils = pytest.importorskip("utils")  # needs the worker's full requirements
+    clips = utils.format_gemini_output(EVENTS, ranges)
+    assert [(c["timestamp_start"], c["timestamp_end"]) for c in clips] == [("00:00:09", "00:00:16"),
+                                                                         ("00:00:59", "00:01:04")]
+    assert [c["outcome"] for c in clips] == ["Make", "Make"]
+    assert [c["outcomes"] for c in clips] == [{"Make": 1, "Miss": 1}, {"Make": 1}]
@@ -0,0 +1,116 @@
+# worker/test_range_source.py - byte-exact Range responses from RangedSource over a fake GCS blob
+# run from worker/: python -m pytest test_range_source.py
+
+import os
+import urllib.request
+import urllib.error
+
+import pytest
+
+from range_source import RangedSource
+
+DATA = os.urandom(10_000)
+
+
+class FakeBlob:
+    def __init__(self, name, data, generation=1):
+        self.name = name
+        self.data = data
+        self.size = len(data)
+        self.generation = generation
+
+    def download_as_bytes(self, start, end, checksum=None):
+        return self.data[start:end + 1]
+
+
+class FakeBucket:
+    def __init__(self, blobs):
+        self.blobs = blobs
+
+    def get_blob(self, name):
+        return self.blobs.get(name)
+
+    def blob(self, name, generation=None):
+        blob = self.blobs[name]
+        assert generation in (None, blob.generation)
+        return blob
+
+
+class FakeStorageClient:
+    def __init__(self, blobs):
+        self._bucket = FakeBucket(blobs)
+
+    def bucket(self, name):
+        return self._bucket
+
+
+@pytest.fixture
+def source():
+    client = FakeStorageClient({"uploads/clip.mp4": FakeBlob("uploads/clip.mp4", DATA)})
+    # small chunks so a single response spans several backing reads
+    with RangedSource.from_gcs_uri(client, "gs://raw/uploads/clip.mp4", chunk_size=1024) as source:
+        yield source
+
+
+def fetch(source, range_header=None, method="GET"):
+    request = urllib.request.Request(source.url, method=method)
+    if range_header is not None:
+        request.add_header("Range", range_header)
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, dict(response.headers), response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, dict(e.headers), e.read()
+
+
+def test_full_object_without_range(source):
+    status, headers, body = fetch(source)
+    assert status == 200
+    assert headers["Content-Length"] == str(len(DATA))
+    assert body == DATA
+
+
+@pytest.mark.parametrize("header, start, end", [
+    ("bytes=0-0", 0, 0),
+    ("bytes=100-2099", 100, 2099),
+    ("bytes=9000-", 9000, 9999),
+    ("bytes=9500-20000", 9500, 9999),   # end clamped to the object size
+    ("bytes=-300", 9700, 9999),         # suffix range
+    ("bytes=-20000", 0, 9999),          # suffix longer than the object
+    ("bytes=10-19, 30-39", 10, 19),     # only the first range is served
+])
+def test_byte_exact_ranges(source, header, start, end):
+    status, headers, body = fetch(source, header)
+    assert status == 206
+    assert headers["Content-Range"] == f"bytes {start}-{end}/{len(DATA)}"
+    assert headers["Content-Length"] == str(end - start + 1)
+    assert body == DATA[start:end + 1]
+
+
+def test_head_reports_range_without_body(source):
+    status, headers, body = fetch(source, "bytes=100-199", method="HEAD")
+    assert status == 206
+    assert headers["Content-Length"] == "100"
+    assert body == b""
+
+
+@pytest.mark.parametrize("header", [
+    "bytes=10000-",       # starts past the end
+    "bytes=abc-def",
+    "bytes=5",
+    "bytes=-",
+    "bytes=500-100",
+    "bytes=-x",
+])
+def test_unsatisfiable_or_malformed_range_is_416(source, header):
+    status, headers, body = fetch(source, header)
+    assert status == 416
+    assert headers["Content-Range"] == f"bytes */{len(DATA)}"
+    assert body == b""
+
+
+def test_counts_backing_bytes(source):
+    fetch(source, "bytes=0-4095")
+    fetch(source, "bytes=-96")
+    assert source.requests == 2
+    assert source.bytes_transferred == 4096 + 96
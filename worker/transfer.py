@@ -0,0 +1,141 @@
+# worker/transfer.py - concurrent sliced downloads and parallel composite uploads for GCS
+
+import os
+import base64
+import logging
+import mimetypes
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from uuid import uuid4
+
+import google_crc32c
+
+MB = 1024 * 1024
+CHUNK_BYTES        = int(float(os.environ.get("GCS_TRANSFER_CHUNK_MB", "32")) * MB)
+TRANSFER_WORKERS   = int(os.environ.get("GCS_TRANSFER_WORKERS", "8"))
+PARALLEL_THRESHOLD = int(float(os.environ.get("GCS_PARALLEL_THRESHOLD_MB", "64")) * MB)
+COMPOSE_LIMIT      = 32  # max source objects per GCS compose request
+
+
+def _chunks(size, chunk_size):
+    return [(start, min(size, start + chunk_size) - 1) for start in range(0, size, chunk_size)]
+
+def file_crc32c(path, block_size=8 * MB):
+    """Base64 big-endian CRC32C of a local file, the same encoding GCS uses for blob.crc32c."""
+    checksum = google_crc32c.Checksum()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            checksum.update(block)
+    return base64.b64encode(checksum.digest()).decode("utf-8")
+
+def _log_throughput(action, name, size, elapsed, parts, workers):
+    rate = (size / MB) / elapsed if elapsed > 0 else 0.0
+    logging.info(f"{action} {name}: {size / MB:.1f} MB in {elapsed:.2f}s "
+                 f"({rate:.1f} MB/s, {parts} part(s), {workers} worker(s))")
+    return {"bytes": size, "seconds": round(elapsed, 3), "mbPerSec": round(rate, 2), "parts": parts}
+
+
+def sliced_download(blob, dest_path, chunk_size=CHUNK_BYTES, workers=TRANSFER_WORKERS):
+    """
+    Downloads blob (with size/crc32c metadata loaded, e.g. from bucket.get_blob) into dest_path
+    as concurrent ranged reads written in place, then verifies the whole-file CRC32C.
+    Small objects fall back to a single stream.
+    """
+    start_time = time.perf_counter()
+    if blob.size is None or blob.size < max(chunk_size, PARALLEL_THRESHOLD):
+        blob.download_to_filename(dest_path)
+        return _log_throughput("Downloaded", blob.name, os.path.getsize(dest_path),
+                               time.perf_counter() - start_time, 1, 1)
+
+    ranges = _chunks(blob.size, chunk_size)
+    with open(dest_path, "wb") as f:
+        f.truncate(blob.size)
+    fd = os.open(dest_path, os.O_WRONLY)
+    try:
+        def fetch(byte_range):
+            start, end = byte_range
+            data = blob.download_as_bytes(start=start, end=end, checksum=None)
+            if len(data) != end - start + 1:
+                raise IOError(f"Short read for {blob.name} bytes {start}-{end}: got {len(data)}")
+            os.pwrite(fd, data, start)
+
+        with ThreadPoolExecutor(max_workers=min(workers, len(ranges))) as pool:
+            list(pool.map(fetch, ranges))
+    finally:
+        os.close(fd)
+
+    if blob.crc32c and file_crc32c(dest_path) != blob.crc32c:
+        os.remove(dest_path)
+        raise IOError(f"CRC32C mismatch downloading gs://{blob.bucket.name}/{blob.name}")
+    return _log_throughput("Downloaded", blob.name, blob.size,
+                           time.perf_counter() - start_time, len(ranges), min(workers, len(ranges)))
+
+
+def parallel_upload(local_path, bucket, dst_key, chunk_size=CHUNK_BYTES, workers=TRANSFER_WORKERS, timeout=600):
+    """
+    Uploads local_path to gs://bucket/dst_key. Files above the parallel threshold are sent
+    as concurrent part objects, stitched with compose and checked against the local CRC32C;
+    the temporary parts are deleted afterwards. Small files use a single stream.
+    """
+    start_time = time.perf_counter()
+    size = os.path.getsize(local_path)
+    blob = bucket.blob(dst_key)
+    if size < max(chunk_size, PARALLEL_THRESHOLD):
+        blob.upload_from_filename(local_path, timeout=timeout)
+        return _log_throughput("Uploaded", dst_key, size, time.perf_counter() - start_time, 1, 1)
+
+    ranges = _chunks(size, chunk_size)
+    prefix = f"{dst_key}.parts-{uuid4().hex[:8]}"
+    content_type = mimetypes.guess_type(local_path)[0] or "application/octet-stream"
+
+    def send(indexed_range):
+        i, (start, end) = indexed_range
+        part = bucket.blob(f"{prefix}/{i:05d}")
+        with open(local_path, "rb") as f:
+            f.seek(start)
+            part.upload_from_file(f, size=end - start + 1, content_type=content_type, timeout=timeout)
+        return part
+
+    parts = []
+    try:
+        # record every part that lands, even when a sibling fails, so the cleanup below sees it
+        errors = []
+        with ThreadPoolExecutor(max_workers=min(workers, len(ranges))) as pool:
+            futures = [pool.submit(send, indexed) for indexed in enumerate(ranges)]
+            for future in as_completed(futures):
+                try:
+                    parts.append(future.result())
+                except Exception as e:
+                    errors.append(e)
+        if errors:
+            raise errors[0]
+        parts.sort(key=lambda part: part.name)  # zero-padded index -> compose order
+
+        # compose accepts at most 32 sources, so stitch in rounds for very large files
+        level = 0
+        sources = list(parts)
+        while len(sources) > COMPOSE_LIMIT:
+            merged = []
+            for i in range(0, len(sources), COMPOSE_LIMIT):
+                intermediate = bucket.blob(f"{prefix}/compose-{level}-{i // COMPOSE_LIMIT:05d}")
+                intermediate.content_type = content_type
+                intermediate.compose(sources[i:i + COMPOSE_LIMIT], timeout=timeout)
+                parts.append(intermediate)  # cleaned up even if a later compose in this round fails
+                merged.append(intermediate)
+            sources = merged
+            level += 1
+        blob.content_type = content_type
+        blob.compose(sources, timeout=timeout)
+    finally:
+        for part in parts:
+            try:
+                part.delete()
+            except Exception as e:
+                logging.warning(f"Failed to delete upload part {part.name}: {e}")
+
+    blob.reload()
+    if blob.crc32c != file_crc32c(local_path):
+        blob.delete()  # never leave a corrupt object where readers expect the upload
+        raise IOError(f"CRC32C mismatch uploading gs://{bucket.name}/{dst_key}")
+    return _log_throughput("Uploaded", dst_key, size, time.perf_counter() - start_time,
+                           len(ranges), min(workers, len(ranges)))
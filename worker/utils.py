@@ -6,15 +6,16 @@ import google.genai as genai
 from dotenv import load_dotenv
 import time
 import json, re
+import struct
 import glob
 import tempfile
 import logging
 load_dotenv()
-from moviepy.editor import VideoFileClip, vfx, concatenate_videoclips
 from prompts import prompt_4, json_input, prompt_shot_outcomes_only
 from uuid import uuid4 
-from moviepy.editor import VideoFileClip, TextClip, CompositeVideoClip
 import uuid
+from intervals import event_timestamps, merge_intervals, to_numbers, to_ranges, events_by_range
+from watermark import watermark_png, overlay_filter
 
 def add_watermark(
     video_path,
@@ -26,18 +27,19 @@ def add_watermark(
     position=("right", "bottom"),
     opacity=0.5
 ):
-    video = VideoFileClip(video_path)
-
-    # Use the built-in 'caption' method instead of ImageMagick
-    watermark = (
-        TextClip(text, fontsize=fontsize, color=color, font=font, method="caption")  # <── add method="caption"
-        .set_opacity(opacity)
-        .set_position(position)
-        .set_duration(video.duration)
-    )
-
-    final = CompositeVideoClip([video, watermark])
-    final.write_videofile(output_path, codec="libx264", fps=video.fps, preset="ultrafast", threads=4, logger=None)
+    # Standalone watermark pass for an already-rendered video. Highlight renders apply the
+    # same overlay inside their own encode instead (WATERMARK_TEXT), which avoids this second encode.
+    png = watermark_png(text, font if os.path.isfile(font) else None, fontsize, color, opacity)
+    subprocess.run([
+        "ffmpeg", "-v", "error",
+        "-i", video_path,
+        "-i", png,
+        "-filter_complex", overlay_filter("0:v", 1, "v", position),
+        "-map", "[v]", "-map", "0:a?",
+        "-c:v", "libx264", "-preset", "ultrafast", "-c:a", "copy",
+        "-movflags", "+faststart",
+        "-y", output_path
+    ], check=True, capture_output=True)
     return output_path
 
 
@@ -74,38 +76,25 @@ def timestamp_maker_2(gem_output, buffer=5):
     #if isinstance(parsed, list):
     highlights = [] # ALL TIMESTAMPS
 
-    for shot in parsed:
-        if "TimeStamp" in shot and "Outcome" in shot:
-            start = (shot["TimeStamp"])
-            end = start + buffer  # add buffer to define end time
-            outcome = shot["Outcome"].lower()
-            
-            highlights.append({
-                "start": start,
-                "end": end,
-                "outcome": outcome
-            })
+    seconds, kept = event_timestamps(parsed)  # "HH:MM:SS" strings as well as plain seconds
+    for start, i in zip(to_numbers(seconds), kept.tolist()):
+        highlights.append({
+            "start": start,
+            "end": start + buffer,  # add buffer to define end time
+            "outcome": parsed[i]["Outcome"].lower()
+        })
     return highlights
 def merge_overlapping(highlights):
     if not highlights:
         return []
 
-    # sort by start time
-    highlights.sort(key=lambda x: x["start"])
-    merged = [highlights[0]]
-
-    for current in highlights[1:]:
-        last = merged[-1]
-
-        # if overlap or touch (<=)
-        if current["start"] <= last["end"]:
-            # merge end times (take the max)
-            last["end"] = max(last["end"], current["end"])
-            # optionally combine outcomes if you want to store them
-            last["outcome"] += f", {current['outcome']}"
-        else:
-            merged.append(current)
-
+    # overlapping or touching (<=) highlights merge; their outcomes are combined in start order
+    starts, ends, membership = merge_intervals([h["start"] for h in highlights], [h["end"] for h in highlights])
+    merged = [{"start": s, "end": e, "outcome": []} for s, e in to_ranges(starts, ends)]
+    for i in sorted(range(len(highlights)), key=lambda i: highlights[i]["start"]):
+        merged[membership[i]]["outcome"].append(highlights[i]["outcome"])
+    for m in merged:
+        m["outcome"] = ", ".join(m["outcome"])
     return merged
 
 def process_highlights(parsed):
@@ -160,34 +149,162 @@ def return_enhanced_timestamps(gem_output):
     except Exception as e:
         return {"ok": False, "error": str(e)}
 
-def convert_to_mp4(in_path, td):
+# Codecs an .mp4 container can carry as-is (stream copy); anything else is transcoded
+MP4_VIDEO_CODECS = {"h264", "hevc", "mpeg4"}
+MP4_AUDIO_CODECS = {"aac", "mp3"}
+
+def probe_codecs(in_path):
+    """Returns (video codec names, audio codec names) via ffprobe."""
+    result = subprocess.run([
+        "ffprobe", "-v", "error",
+        "-show_entries", "stream=codec_type,codec_name",
+        "-of", "json",
+        in_path
+    ], capture_output=True, text=True, check=True)
+    streams = json.loads(result.stdout).get("streams", [])
+    video = [st.get("codec_name") for st in streams if st.get("codec_type") == "video"]
+    audio = [st.get("codec_name") for st in streams if st.get("codec_type") == "audio"]
+    return video, audio
+
+def is_faststart(path):
+    """True if the moov atom comes before mdat (players/Gemini can start without reading to the end)."""
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return False
+            size, box = struct.unpack(">I4s", header)
+            if box == b"moov":
+                return True
+            if box == b"mdat":
+                return False
+            if size == 1:  # 64-bit box size follows the header
+                size = struct.unpack(">Q", f.read(8))[0]
+                f.seek(size - 16, 1)
+            elif size < 8:
+                return False
+            else:
+                f.seek(size - 8, 1)
+
+def convert_to_mp4(in_path, td, stats=None):
+    """
+    Probe-driven conversion to a faststart .mp4:
+      - "none":       already .mp4 with compatible codecs and faststart, used as-is
+      - "faststart":  .mp4 with compatible codecs, remuxed to move the moov atom up front
+      - "remux":      compatible codecs in another container (e.g. iPhone .mov), stream copied
+      - "partial":    only the incompatible stream (video or audio) is transcoded
+      - "transcode":  full libx264/aac re-encode
+    stats (optional dict) receives conversionMode and conversionSec.
+    """
+    started = time.perf_counter()
     converted_path = in_path
+    mode = "none"
     try:
-        # Detect by extension or FFmpeg probing
         ext = os.path.splitext(in_path)[1].lower()
-        if ext != ".mp4":
+        video, audio = probe_codecs(in_path)
+        video_ok = bool(video) and video[0] in MP4_VIDEO_CODECS
+        audio_ok = not audio or audio[0] in MP4_AUDIO_CODECS
+
+        if ext == ".mp4" and video_ok and audio_ok and is_faststart(in_path):
+            logging.info(f"File already in faststart .mp4 format: {in_path}")
+        else:
+            if video_ok and audio_ok:
+                mode = "faststart" if ext == ".mp4" else "remux"
+            elif video_ok or audio_ok:
+                mode = "partial"
+            else:
+                mode = "transcode"
             converted_path = os.path.join(td, "converted.mp4")
-            logging.info(f"Converting {ext} to .mp4 ...")
-            print(f"Converting {ext} to .mp4 file...")
-            subprocess.run([
-                "ffmpeg",
-                "-i", in_path,
-                "-c:v", "libx264",
-                "-c:a", "aac",
-                "-movflags", "+faststart",
-                "-y", converted_path
-            ], check=True)
+            logging.info(f"Converting {ext} ({video}/{audio}) to .mp4, mode={mode} ...")
+            print(f"Converting {ext} to .mp4 file ({mode})...")
+
+            cmd = ["ffmpeg", "-i", in_path, "-map", "0:v:0", "-map", "0:a:0?"]
+            if video_ok:
+                cmd += ["-c:v", "copy"] + (["-tag:v", "hvc1"] if video[0] == "hevc" else [])
+            else:
+                cmd += ["-c:v", "libx264"]
+            cmd += ["-c:a", "copy" if audio_ok else "aac"]
+            cmd += ["-movflags", "+faststart", "-y", converted_path]
+            try:
+                subprocess.run(cmd, check=True, capture_output=True)
+            except subprocess.CalledProcessError:
+                if mode == "transcode":
+                    raise
+                logging.warning(f"Stream copy ({mode}) failed, falling back to full transcode")
+                mode = "transcode"
+                subprocess.run([
+                    "ffmpeg",
+                    "-i", in_path,
+                    "-c:v", "libx264",
+                    "-c:a", "aac",
+                    "-movflags", "+faststart",
+                    "-y", converted_path
+                ], check=True)
 
             logging.info(f"Conversion successful: {converted_path}")
-        else:
-            logging.info(f"File already in .mp4 format: {in_path}")
     except subprocess.CalledProcessError as e:
         logging.error(f"FFmpeg conversion failed: {e}")
         logging.info("Continuing with original file.")
         converted_path = in_path
-    
+        mode = "failed"
+
+    elapsed = time.perf_counter() - started
+    logging.info(f"Conversion mode={mode} took {elapsed:.2f}s")
+    if stats is not None:
+        stats["conversionMode"] = mode
+        stats["conversionSec"] = round(elapsed, 3)
     return converted_path
 
+def has_audio_stream(in_path):
+    """True if ffprobe finds at least one audio stream in in_path."""
+    result = subprocess.run([
+        "ffprobe", "-v", "error",
+        "-select_streams", "a",
+        "-show_entries", "stream=index",
+        "-of", "csv=p=0",
+        in_path
+    ], capture_output=True, text=True)
+    return result.returncode == 0 and bool(result.stdout.strip())
+
+def make_analysis_proxy(in_path, td, height=360, fps=5, stats=None):
+    """
+    Writes a reduced-resolution, reduced-frame-rate copy of in_path for model analysis.
+    Audio is kept (mono AAC) and no speed change or offset is applied, so proxy timestamps
+    map 1:1 to the source. Sources shorter than height are never upscaled. Returns None
+    (and removes the copy) when it isn't smaller than the source, which the caller should
+    then send as-is. stats (optional dict) receives proxyBytes/sourceBytes/proxySec.
+    """
+    started = time.perf_counter()
+    proxy_path = os.path.join(td, "analysis_proxy.mp4")
+    subprocess.run([
+        "ffmpeg",
+        "-i", in_path,
+        "-map", "0:v:0", "-map", "0:a:0?",
+        "-vf", f"scale=-2:'min(ih,{height})',fps={fps}",
+        "-c:v", "libx264", "-preset", "veryfast", "-crf", "28",
+        "-c:a", "aac", "-b:a", "64k", "-ac", "1",
+        "-movflags", "+faststart",
+        "-y", proxy_path
+    ], check=True, capture_output=True)
+    elapsed = time.perf_counter() - started
+    proxy_bytes, source_bytes = os.path.getsize(proxy_path), os.path.getsize(in_path)
+    logging.info(f"Analysis proxy: {source_bytes} -> {proxy_bytes} bytes "
+                 f"({proxy_bytes / max(1, source_bytes):.1%}) in {elapsed:.2f}s")
+    if stats is not None:
+        stats.update({
+            "proxyBytes": proxy_bytes,
+            "sourceBytes": source_bytes,
+            "proxySizeRatio": round(proxy_bytes / max(1, source_bytes), 4),
+            "proxySec": round(elapsed, 3),
+        })
+    if proxy_bytes >= source_bytes:
+        logging.info("Analysis proxy is not smaller than the source, using the source")
+        os.remove(proxy_path)
+        if stats is not None:
+            stats["proxySkipped"] = "not smaller"
+        return None
+    return proxy_path
+
 # NEW: CHANGE GEMINI OUTPUT INTO EXPECTED JSON OUTPUT FOR FRONTEND
 
 def sec_to_timestamp(seconds):
@@ -203,10 +320,11 @@ def format_gemini_output(gem_output, start_end_times):
     try:
     
 
+        # each range gets the outcomes of the events whose timestamps fall in it (not the event
+        # at the same list index, which goes wrong as soon as two events merge into one range)
+        range_outcomes = events_by_range(gem_output, start_end_times)
         for idx, (start_time, end_time) in enumerate(start_end_times):
-            gem = gem_output[idx] if idx < len(gem_output) else {}
-
-            outcome = gem.get("Outcome") or gem.get("outcome")
+            outcome, outcome_counts = range_outcomes[idx]
             start_ts = sec_to_timestamp(start_time)
             end_ts = sec_to_timestamp(end_time)
 
@@ -215,6 +333,7 @@ def format_gemini_output(gem_output, start_end_times):
                 "timestamp_start": start_ts,
                 "timestamp_end": end_ts,
                 "outcome": outcome,
+                "outcomes": outcome_counts,
                 "subject": None,
                 "shot_type": None,
                 "shot_location": None,
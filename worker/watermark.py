@@ -0,0 +1,74 @@
+# worker/watermark.py - pre-rendered watermark PNGs (Pillow, cached per style) applied as an ffmpeg overlay
+
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+from uuid import uuid4
+
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+
+WATERMARK_TEXT     = os.environ.get("WATERMARK_TEXT", "")          # empty = no watermark on rendered highlights
+WATERMARK_FONT     = os.environ.get("WATERMARK_FONT", "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf")
+WATERMARK_FONTSIZE = int(os.environ.get("WATERMARK_FONTSIZE", "30"))
+WATERMARK_COLOR    = os.environ.get("WATERMARK_COLOR", "white")
+WATERMARK_OPACITY  = float(os.environ.get("WATERMARK_OPACITY", "0.5"))
+WATERMARK_POSITION = os.environ.get("WATERMARK_POSITION", "right,bottom")
+WATERMARK_MARGIN   = int(os.environ.get("WATERMARK_MARGIN", "10"))
+WATERMARK_CACHE_DIR = os.environ.get("WATERMARK_CACHE_DIR", os.path.join(tempfile.gettempdir(), "hooptuber-watermarks"))
+
+_lock = threading.Lock()
+
+
+def watermark_enabled():
+    return bool(WATERMARK_TEXT)
+
+def _load_font(font, fontsize):
+    try:
+        return ImageFont.truetype(font, fontsize)
+    except OSError:
+        logging.warning(f"Watermark font {font} not found, using Pillow's default font")
+        return ImageFont.load_default(size=fontsize)
+
+def watermark_png(text=None, font=None, fontsize=None, color=None, opacity=None):
+    """
+    Path to a transparent PNG of the watermark text, rendered once per style and reused by
+    every later render (the file name is a hash of the style). Defaults come from WATERMARK_*.
+    """
+    text = WATERMARK_TEXT if text is None else text
+    font = font or WATERMARK_FONT
+    fontsize = fontsize or WATERMARK_FONTSIZE
+    color = color or WATERMARK_COLOR
+    opacity = WATERMARK_OPACITY if opacity is None else opacity
+    key = hashlib.sha256(f"{text}|{font}|{fontsize}|{color}|{opacity}".encode("utf-8")).hexdigest()[:24]
+    path = os.path.join(WATERMARK_CACHE_DIR, f"{key}.png")
+    if os.path.exists(path):
+        return path
+    with _lock:
+        if os.path.exists(path):
+            return path
+        os.makedirs(WATERMARK_CACHE_DIR, exist_ok=True)
+        pil_font = _load_font(font, fontsize)
+        left, top, right, bottom = ImageDraw.Draw(Image.new("RGBA", (1, 1))).textbbox((0, 0), text, font=pil_font)
+        image = Image.new("RGBA", (max(1, right - left), max(1, bottom - top)), (0, 0, 0, 0))
+        r, g, b = ImageColor.getrgb(color)[:3]
+        ImageDraw.Draw(image).text((-left, -top), text, font=pil_font, fill=(r, g, b, round(255 * opacity)))
+        tmp_path = f"{path}.{uuid4().hex[:8]}.tmp"
+        image.save(tmp_path, format="PNG")
+        os.replace(tmp_path, path)
+        logging.info(f"Rendered watermark '{text}' ({image.width}x{image.height}) to {path}")
+    return path
+
+def overlay_position(position=None, margin=None):
+    """ffmpeg overlay x:y for a ("left"|"center"|"right", "top"|"center"|"bottom") position."""
+    position = position or WATERMARK_POSITION
+    margin = WATERMARK_MARGIN if margin is None else margin
+    horizontal, vertical = position.split(",") if isinstance(position, str) else position
+    x = {"left": f"{margin}", "center": "(main_w-overlay_w)/2", "right": f"main_w-overlay_w-{margin}"}[horizontal.strip()]
+    y = {"top": f"{margin}", "center": "(main_h-overlay_h)/2", "bottom": f"main_h-overlay_h-{margin}"}[vertical.strip()]
+    return f"{x}:{y}"
+
+def overlay_filter(video_label, image_input, out_label, position=None, margin=None):
+    """Filter graph fragment that draws input image_input (the PNG) over video_label."""
+    return f"[{video_label}][{image_input}:v]overlay={overlay_position(position, margin)}:format=auto[{out_label}]"